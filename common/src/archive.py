@@ -0,0 +1,223 @@
+import mmap
+import shutil
+import time
+import zlib
+from collections import namedtuple
+from pathlib import Path
+
+
+DATA_DIR = Path("../data")
+ARCHIVE_DIR = DATA_DIR / "archive"
+ARCHIVE_RACE_DIR = ARCHIVE_DIR / "race"
+ARCHIVE_HORSE_DIR = ARCHIVE_DIR / "horse"
+
+# 1つのセグメントファイルの上限サイズ。これを超えたら次のセグメントに書く
+SEGMENT_SIZE = 1 << 30
+INDEX_FILE_NAME = "index.tsv"
+
+
+IndexEntry = namedtuple("IndexEntry", ["segment", "offset", "length", "mtime_ns"])
+PageStat = namedtuple("PageStat", ["st_size", "st_mtime_ns"])
+
+
+class ArchivePage(namedtuple("ArchivePage", ["directory", "stem", "entry"])):
+    """
+    アーカイブ内の1ページを指す参照。
+    Pathと同じようにstem, read_bytes(), stat()が使えるので、create_rawでは.binファイルと同じように扱えます。
+    プロセス間で受け渡しても、読み込み先のプロセスでアーカイブを開いて読みます。
+    """
+
+    def read_bytes(self):
+        return open_archive(self.directory).read_entry(self.entry)
+
+    def stat(self):
+        # サイズは圧縮後のサイズ、更新時刻はアーカイブに書き込んだ時刻
+        return PageStat(self.entry.length, self.entry.mtime_ns)
+
+    def __str__(self):
+        return f"{self.directory}:{self.stem}"
+
+
+class PageArchive:
+    """
+    _クラスの意味と使い方_
+    ページのhtmlを1つずつ.binファイルにする代わりに、zlibで圧縮して
+    少数の大きなセグメントファイルに追記していくアーカイブです。
+    race_id, horse_idからセグメント内の位置を引くインデックス（index.tsv）も追記式で持ちます。
+    読み込みはセグメントをmmapしてランダムアクセスします。
+    同じidを書き直すと新しい位置を追記し、古いデータはcompact()で取り除きます。
+    idはindex.tsvに文字列で保存するので、intのidを渡しても文字列に直して引きます。
+    書き込みは1プロセスから行う前提です。
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._index = {}
+        self._mmaps = {}
+        self._writer = None
+        self._index_writer = None
+        self._load_index()
+
+    def _segment_path(self, segment):
+        return self.directory / f"segment_{segment:05d}.seg"
+
+    def _load_index(self):
+        index_path = self.directory / INDEX_FILE_NAME
+        if not index_path.exists():
+            return
+        with open(index_path, encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                # 書き込み途中で終わった最後の行は無視する
+                if len(fields) != 5:
+                    continue
+                key, segment, offset, length, mtime_ns = fields
+                if int(segment) < 0:
+                    self._index.pop(key, None)
+                else:
+                    self._index[key] = IndexEntry(
+                        int(segment), int(offset), int(length), int(mtime_ns)
+                    )
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return str(key) in self._index
+
+    def keys(self):
+        return sorted(self._index)
+
+    def pages(self):
+        """idの昇順に並べたArchivePageのリストを返す"""
+        return [ArchivePage(str(self.directory), key, self._index[key]) for key in self.keys()]
+
+    def read_entry(self, entry):
+        mm = self._mmaps.get(entry.segment)
+        if mm is None or entry.offset + entry.length > len(mm):
+            # セグメントが追記で伸びていたらmmapし直す
+            if self._writer is not None:
+                self._writer.flush()
+            with open(self._segment_path(entry.segment), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmaps[entry.segment] = mm
+        return zlib.decompress(mm[entry.offset:entry.offset + entry.length])
+
+    def get(self, key):
+        """idのhtmlを返す。なければKeyError"""
+        return self.read_entry(self._index[str(key)])
+
+    def _open_writer(self, size):
+        if self._index_writer is None:
+            self._index_writer = open(self.directory / INDEX_FILE_NAME, "a", encoding="utf-8")
+        if self._writer is None:
+            # 既存の最後のセグメントの続きに追記する
+            segment_list = sorted(self.directory.glob("segment_*.seg"))
+            self._writer_segment = int(segment_list[-1].stem.split("_")[1]) if segment_list else 0
+            self._writer = open(self._segment_path(self._writer_segment), "ab")
+        if self._writer.tell() > 0 and self._writer.tell() + size > SEGMENT_SIZE:
+            self._writer.close()
+            self._writer_segment += 1
+            self._writer = open(self._segment_path(self._writer_segment), "ab")
+
+    def _append_index(self, key, entry):
+        self._index_writer.write(
+            f"{key}\t{entry.segment}\t{entry.offset}\t{entry.length}\t{entry.mtime_ns}\n"
+        )
+
+    def put(self, key, html):
+        """htmlを圧縮してセグメントに追記し、インデックスを更新する"""
+        key = str(key)
+        blob = zlib.compress(html, 6)
+        self._open_writer(len(blob))
+        offset = self._writer.tell()
+        self._writer.write(blob)
+        # インデックスが先に書き出されて、存在しないデータを指すことがないようにする
+        self._writer.flush()
+        entry = IndexEntry(self._writer_segment, offset, len(blob), time.time_ns())
+        self._append_index(key, entry)
+        self._index[key] = entry
+
+    def delete(self, key):
+        key = str(key)
+        if key not in self._index:
+            return
+        self._open_writer(0)
+        self._append_index(key, IndexEntry(-1, 0, 0, 0))
+        del self._index[key]
+
+    def flush(self):
+        """書き込み途中のインデックスをファイルに書き出す"""
+        if self._writer is not None:
+            self._writer.flush()
+        if self._index_writer is not None:
+            self._index_writer.flush()
+
+    def close(self):
+        self.flush()
+        for f in (self._writer, self._index_writer):
+            if f is not None:
+                f.close()
+        self._writer = None
+        self._index_writer = None
+        for mm in self._mmaps.values():
+            mm.close()
+        self._mmaps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def compact(self):
+        """
+        書き直しで使われなくなったデータを取り除き、セグメントとインデックスを作り直す。
+        新しいアーカイブを隣に作ってから置き換えます。
+        前回中断したときの作りかけのディレクトリが残っていたら、消してから作ります。
+        """
+        tmp_dir = self.directory.with_name(self.directory.name + ".compact")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        with PageArchive(tmp_dir) as new_archive:
+            for key in self.keys():
+                new_archive.put(key, self.get(key))
+        self.close()
+        for path in self.directory.iterdir():
+            path.unlink()
+        for path in tmp_dir.iterdir():
+            path.rename(self.directory / path.name)
+        tmp_dir.rmdir()
+        self._index = {}
+        self._load_index()
+
+
+_archives = {}
+
+
+def open_archive(directory):
+    """
+    ディレクトリごとにPageArchiveを1つだけ開いて使い回す。
+    ProcessPoolExecutorのワーカーでも、プロセスごとに1回だけ開きます。
+    """
+    directory = str(directory)
+    if directory not in _archives:
+        _archives[directory] = PageArchive(directory)
+    return _archives[directory]
+
+
+def pack_html_dir(html_dir, archive_dir, remove=False):
+    """
+    _関数の意味と使い方_
+    html_dirにある.binファイルをアーカイブに詰め替える関数です。
+    removeがTrueなら、詰め替えたあとに.binファイルを削除します。
+    """
+    html_path_list = sorted(Path(html_dir).glob("*.bin"))
+    archive = open_archive(archive_dir)
+    for html_path in html_path_list:
+        archive.put(html_path.stem, html_path.read_bytes())
+    archive.flush()
+    if remove:
+        for html_path in html_path_list:
+            html_path.unlink()
+    return len(html_path_list)
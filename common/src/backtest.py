@@ -0,0 +1,261 @@
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from metrics import metrics, stage
+
+DATA_DIR = Path("../data")
+DF_CSV_DIR = DATA_DIR / "df_csv"
+
+# 券種ごとのコードと、着順どおりに当てる必要があるか（Trueなら順番も一致が必要）
+BET_TYPES = {
+    "単勝": (1, True),
+    "複勝": (2, True),
+    "馬連": (3, False),
+    "ワイド": (4, False),
+    "馬単": (5, True),
+    "三連複": (6, False),
+    "三連単": (7, True),
+}
+BET_TYPE_ALIASES = {"3連複": "三連複", "3連単": "三連単"}
+# 組み合わせの馬番は最大3頭、1頭5ビット（1〜18番）で1つの整数にまとめる
+MAX_HORSES = 3
+UMABAN_BITS = 5
+COMBINATION_BITS = UMABAN_BITS * MAX_HORSES
+BET_TYPE_BITS = 3
+DIGITS_PATTERN = re.compile(r"\d+")
+
+
+def _combination(value):
+    """組み合わせ1つを馬番のリストにする。形式は要素ごとに判定します"""
+    if isinstance(value, str):
+        return DIGITS_PATTERN.findall(value)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return value
+    if isinstance(value, (int, np.integer)):
+        return [value]
+    raise TypeError(f"馬番の組み合わせは、リスト・タプルか文字列で指定してください: {value!r}")
+
+
+def _umaban_array(umaban):
+    """
+    馬番の組み合わせの列を、(行数, 3) のint配列にする。足りない分は0で埋めます。
+    要素は [5, 10] のようなリスト・タプル、"5-10"（df_race_return.csvの形式）や
+    "5→10" "['5', '10']" のような文字列、単勝・複勝の 5 のような整数のどれでも構いません。
+    形式は要素ごとに判定するので、混ざっていても構いません。それ以外の要素はTypeErrorです。
+    """
+    umaban = pd.Series(umaban, dtype=object).map(_combination)
+    array = np.zeros((len(umaban), MAX_HORSES), dtype=np.int64)
+    lengths = umaban.map(len).to_numpy(dtype=np.int64)
+    if (lengths > MAX_HORSES).any():
+        raise ValueError(f"組み合わせは{MAX_HORSES}頭までです")
+    values = np.fromiter(
+        (int(number) for combination in umaban for number in combination),
+        dtype=np.int64,
+        count=int(lengths.sum()),
+    )
+    rows = np.repeat(np.arange(len(umaban)), lengths)
+    cols = np.arange(len(values)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    array[rows, cols] = values
+    return array
+
+
+def _bet_type_codes(bet_type):
+    bet_type = pd.Series(bet_type).replace(BET_TYPE_ALIASES)
+    codes = bet_type.map({name: code for name, (code, _) in BET_TYPES.items()})
+    if codes.isna().any():
+        unknown = sorted(bet_type[codes.isna()].unique())
+        raise ValueError(f"対応していない券種です: {unknown}")
+    return codes.to_numpy(dtype=np.int64)
+
+
+def combination_keys(race_id, bet_type, umaban):
+    """
+    _関数の意味と使い方_
+    (race_id, 券種, 馬番の組み合わせ) を1つのint64のキーにまとめる関数です。
+    馬連・ワイド・三連複のような順不同の券種は、馬番を昇順に並べてからキーにするので、
+    "10-5" と "5-10" は同じキーになります。馬単・三連単は並び順のままキーにします。
+    キーは race_id | 券種コード | 馬番1 | 馬番2 | 馬番3 のビット列です。
+
+    Args:
+        race_id (array-like): race_id（12桁の数値か文字列）
+        bet_type (array-like): 券種（"馬連"など）
+        umaban (array-like or np.ndarray): 馬番の組み合わせ。_umaban_arrayで変換済みの配列も渡せます
+
+    Returns:
+        np.ndarray: int64のキー
+    """
+    codes = _bet_type_codes(bet_type)
+    array = umaban if isinstance(umaban, np.ndarray) else _umaban_array(umaban)
+    ordered = np.array([ordered for _, ordered in BET_TYPES.values()])[codes - 1]
+    # 順不同の券種は馬番を昇順にする。0（空き）は後ろに回す
+    padded = np.where(array == 0, 1 << UMABAN_BITS, array)
+    array = np.where(ordered[:, None], array, np.sort(padded, axis=1) % (1 << UMABAN_BITS))
+    combination = np.zeros(len(array), dtype=np.int64)
+    for i in range(MAX_HORSES):
+        combination = (combination << UMABAN_BITS) | array[:, i]
+    race_id = pd.Series(race_id).astype(np.int64).to_numpy()
+    return (race_id << (BET_TYPE_BITS + COMBINATION_BITS)) | (codes << COMBINATION_BITS) | combination
+
+
+def load_payouts(df_race_return=None):
+    """
+    _関数の意味と使い方_
+    df_race_return（df_race_return_csvの出力）から、キーで引ける払い戻し表を作る関数です。
+    df_race_returnを省略するとDF_CSV_DIRのdf_race_return.csvを読み込みます。
+
+    Returns:
+        pd.Series: キー（combination_keys）の昇順に並んだ、100円あたりの払い戻し
+    """
+    if df_race_return is None:
+        df_race_return = pd.read_csv(DF_CSV_DIR / "df_race_return.csv", sep="\t")
+    df = df_race_return[df_race_return["bet_type"].replace(BET_TYPE_ALIASES).isin(BET_TYPES)]
+    keys = combination_keys(df["race_id"], df["bet_type"], df["win_umaban"])
+    payouts = pd.Series(df["return"].to_numpy(dtype=np.int64), index=keys)
+    # 同じ組み合わせが重複して載っている場合は1つにする
+    return payouts[~payouts.index.duplicated()].sort_index()
+
+
+def match_bets(bets, payouts):
+    """
+    _関数の意味と使い方_
+    買い目のテーブルを払い戻し表と突き合わせて、的中と払い戻し額を付ける関数です。
+    キーの配列に対するnp.searchsortedで突き合わせるので、買い目が数百万行でもループしません。
+
+    Args:
+        bets (pd.DataFrame): race_id, bet_type, umaban, stake（円）列を持つ買い目のテーブル。
+            umabanの代わりにumaban_1, umaban_2, umaban_3列（使わない馬番は0）でも構いません。
+            ほかの列（strategyなど）はそのまま残ります。
+        payouts (pd.Series): load_payoutsの戻り値
+
+    Returns:
+        pd.DataFrame: betsにhit（的中したか）, payout（払い戻し額）列を追加したテーブル。
+            bet_typeの"3連複", "3連単"は"三連複", "三連単"にそろえます。
+    """
+    if "umaban" in bets.columns:
+        umaban = _umaban_array(bets["umaban"])
+    else:
+        columns = [f"umaban_{i}" for i in range(1, MAX_HORSES + 1) if f"umaban_{i}" in bets.columns]
+        umaban = np.zeros((len(bets), MAX_HORSES), dtype=np.int64)
+        umaban[:, : len(columns)] = bets[columns].fillna(0).to_numpy(dtype=np.int64)
+    keys = combination_keys(bets["race_id"], bets["bet_type"], umaban)
+    payout_keys = payouts.index.to_numpy()
+    position = np.searchsorted(payout_keys, keys).clip(max=len(payout_keys) - 1)
+    hit = payout_keys[position] == keys if len(payout_keys) else np.zeros(len(keys), dtype=bool)
+    ret = np.where(hit, payouts.to_numpy()[position] if len(payout_keys) else 0, 0)
+    result = bets.copy()
+    # 券種ごとの集計で"3連単"と"三連単"が分かれないよう、表記をそろえる
+    result["bet_type"] = result["bet_type"].replace(BET_TYPE_ALIASES)
+    result["hit"] = hit
+    result["payout"] = ret * result["stake"].to_numpy() / 100
+    return result
+
+
+def _max_drawdown(result, by):
+    """
+    byの組ごとに、レースの日付順（日付がなければrace_id順）に損益を積み上げたときの最大ドローダウン。
+    同じレースの買い目はまとめて1回の損益として扱い、開始時点の0も高値に含めます。
+    """
+    order = ["date", "race_id"] if "date" in result.columns else ["race_id"]
+    per_race = (
+        result.assign(profit=result["payout"] - result["stake"])
+        .groupby(by + order, observed=True, dropna=False)["profit"]
+        .sum()
+        .reset_index()
+        .sort_values(order, kind="stable")
+    )
+    keys = [per_race[key] for key in by] or [pd.Series(0, index=per_race.index)]
+    cum_profit = per_race["profit"].groupby(keys, observed=True, dropna=False).cumsum()
+    peak = cum_profit.groupby(keys, observed=True, dropna=False).cummax().clip(lower=0)
+    drawdown = (peak - cum_profit).groupby(keys, observed=True, dropna=False).max()
+    return drawdown.rename("max_drawdown")
+
+
+def summarize(result, by=None):
+    """
+    _関数の意味と使い方_
+    match_betsの結果を集計する関数です。
+    買い目数・的中数・的中率・購入額・払い戻し額・損益・回収率（ROI）・最大ドローダウンを計算します。
+    byに列名のリスト（"bet_type", "place", "race_class", "strategy"など）を渡すと、その組ごとに集計します。
+
+    Returns:
+        pd.DataFrame: 集計結果。byを省略した場合は1行です。
+    """
+    by = [by] if isinstance(by, str) else list(by or [])
+    if by:
+        grouped = result.groupby(by, observed=True, dropna=False)
+        summary = grouped.agg(
+            n_bets=("stake", "size"),
+            n_hits=("hit", "sum"),
+            stake=("stake", "sum"),
+            payout=("payout", "sum"),
+        )
+    else:
+        summary = pd.DataFrame(
+            {
+                "n_bets": [len(result)],
+                "n_hits": [result["hit"].sum()],
+                "stake": [result["stake"].sum()],
+                "payout": [result["payout"].sum()],
+            }
+        )
+    summary["hit_rate"] = summary["n_hits"] / summary["n_bets"]
+    summary["profit"] = summary["payout"] - summary["stake"]
+    summary["roi"] = summary["payout"] / summary["stake"]
+    drawdown = _max_drawdown(result, by)
+    if by:
+        return summary.join(drawdown).reset_index()
+    summary["max_drawdown"] = drawdown.max() if len(drawdown) else 0.0
+    return summary
+
+
+@stage("backtest")
+def backtest(bets, df_race_return=None, df_race_info=None, by=None):
+    """
+    _関数の意味と使い方_
+    買い目のテーブルを払い戻しと突き合わせて、的中・払い戻し・回収率・ドローダウンを計算する関数です。
+    馬連・ワイド・三連複は順不同、馬単・三連単は着順どおりの組み合わせで判定します（単勝・複勝も使えます）。
+    df_race_info（df_race_info_csvの出力）を渡すと、date, place, race_class列を買い目に付けて、
+    日付順のドローダウンと、開催場所・クラスごとの集計ができるようになります。
+    省略した場合はDF_CSV_DIRのCSVを読み込みます。
+
+    Args:
+        bets (pd.DataFrame): race_id, bet_type, umaban, stake列を持つ買い目のテーブル（match_bets参照）
+        df_race_return (pd.DataFrame, optional): df_race_return_csvの出力
+        df_race_info (pd.DataFrame, optional): df_race_info_csvの出力
+        by (list, optional): 集計の単位。省略すると全体の集計と、券種・開催場所・クラスごとの集計を返します
+
+    Returns:
+        tuple: (買い目ごとの結果, 集計結果)。byを省略した場合、集計結果は
+            {"total", "bet_type", "place", "race_class"} をキーとする辞書になります。
+
+    Example:
+        bets = pd.DataFrame({
+            "race_id": [202408060405, 202408060405],
+            "bet_type": ["馬連", "三連単"],
+            "umaban": [[10, 5], [10, 5, 1]],
+            "stake": [100, 100],
+        })
+        result, summary = backtest(bets)
+    """
+    payouts = load_payouts(df_race_return)
+    if df_race_info is None:
+        df_race_info = pd.read_csv(DF_CSV_DIR / "df_race_info.csv", sep="\t", parse_dates=["date"])
+    result = match_bets(bets, payouts)
+    info = df_race_info.drop_duplicates("race_id").set_index("race_id")
+    info.index = info.index.astype(np.int64)
+    race_id = result["race_id"].astype(np.int64)
+    for column in ["date", "place", "race_class"]:
+        result[column] = race_id.map(info[column])
+    metrics.incr("backtest_bets_total", len(result))
+    metrics.incr("backtest_hits_total", int(result["hit"].sum()))
+    if by is not None:
+        return result, summarize(result, by)
+    return result, {
+        "total": summarize(result),
+        "bet_type": summarize(result, "bet_type"),
+        "place": summarize(result, "place"),
+        "race_class": summarize(result, "race_class"),
+    }
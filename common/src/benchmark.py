@@ -0,0 +1,320 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+
+DATA_DIR = Path("../data")
+MAPPING_DIR = DATA_DIR / "mapping"
+BENCHMARK_DIR = DATA_DIR / "benchmark"
+RESULT_FILE_NAME = "benchmark.jsonl"
+
+SRC_DIR = Path(__file__).resolve().parent
+
+# 計測するステージ。(ステージ名, モジュール名, 関数名) の順に実行します。
+# create_rawのステージが書いたraw_csvを、dfのステージが読み込みます。
+STAGES = [
+    ("raw_race_csv", "create_raw", "raw_race_csv"),
+    ("raw_race_info_csv", "create_raw", "raw_race_info_csv"),
+    ("raw_race_return_csv", "create_raw", "raw_race_return_csv"),
+    ("raw_race_all_csv", "create_raw", "raw_race_all_csv"),
+    ("create_horse_raw_csv", "create_raw", "create_horse_raw_csv"),
+    ("df_race_csv", "df", "df_race_csv"),
+    ("df_horse_csv", "df", "df_horse_csv"),
+    ("df_race_info_csv", "df", "df_race_info_csv"),
+    ("df_race_return_csv", "df", "df_race_return_csv"),
+]
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+PLACES = ["札幌", "函館", "福島", "新潟", "東京", "中山", "中京", "京都", "阪神", "小倉"]
+CLASSES = ["2歳新馬", "2歳未勝利", "3歳以上1勝クラス", "3歳以上2勝クラス", "3歳以上3勝クラス", "3歳以上オープン"]
+TITLE_CLASSES = ["", "(1勝クラス)", "(2勝クラス)", "(3勝クラス)", "(OP)", "(G3)", "(G2)", "(G1)"]
+SURFACES = [("芝", "右"), ("芝", "左"), ("ダ", "右"), ("ダ", "左"), ("芝", "直"), ("障", "芝")]
+WEATHERS = ["晴", "曇", "小雨", "雨"]
+GOINGS = ["良", "稍重", "重", "不良"]
+MARGINS = ["", "クビ", "ハナ", "アタマ", "1/2", "3/4", "1", "1.1/2", "2", "大"]
+
+RACE_HEADER = ["着順", "枠番", "馬番", "馬名", "性齢", "斤量", "騎手", "タイム", "着差", "単勝", "人気", "馬体重", "調教師"]
+HORSE_HEADER = ["日付", "開催", "天気", "R", "レース名", "映像", "頭数",
+    "枠番", "馬番", "オッズ", "人気", "着順", "騎手", "斤量", "距離",
+    "馬場", "馬場指数", "タイム", "着差", "タイム指数", "通過",
+    "ペース", "上り", "馬体重", "厩舎コメント", "備考", "勝ち馬", "賞金"
+]
+
+
+def _race_id_list(n_races):
+    """年・場所・回・日・レース番号の順に、実際と同じ形式のrace_idをn_races個作る"""
+    race_id_list = []
+    for year in range(2024, 1900, -1):
+        for place in range(1, 11):
+            for kai in range(1, 6):
+                for day in range(1, 13):
+                    for race_no in range(1, 13):
+                        race_id_list.append(f"{year}{place:02d}{kai:02d}{day:02d}{race_no:02d}")
+                        if len(race_id_list) == n_races:
+                            return race_id_list
+    return race_id_list
+
+
+def _wrap_page(body):
+    return (
+        '<html><head><meta http-equiv="Content-Type" content="text/html; charset=EUC-JP">'
+        f"</head><body><div id=\"page\">{body}</div></body></html>"
+    ).encode("euc-jp")
+
+
+def _race_page(rng, race_id, horse_id_list):
+    """netkeibaのraceページと同じ構造（race_table_01, data_intro, pay_block）の合成ページ"""
+    surface, direction = rng.choice(SURFACES)
+    n_horses = len(horse_id_list)
+    year, place = int(race_id[:4]), int(race_id[4:6])
+    umaban_list = rng.sample(range(1, n_horses + 1), n_horses)
+    rows = []
+    for rank, (horse_id, umaban) in enumerate(zip(horse_id_list, umaban_list), 1):
+        rank_text = "中" if rank == n_horses and rng.random() < 0.05 else str(rank)
+        weight = rng.randint(400, 540)
+        rows.append(
+            "<tr>"
+            f"<td>{rank_text}</td><td>{(umaban + 1) // 2}</td><td>{umaban}</td>"
+            f'<td><a href="/horse/{horse_id}/" title="馬{horse_id}">馬{horse_id}</a></td>'
+            f"<td>{rng.choice('牡牝セ')}{rng.randint(2, 7)}</td><td>{rng.choice(['54.0', '55.0', '56.0', '57.0', '58.0'])}</td>"
+            f'<td><a href="/jockey/result/recent/0{rng.randint(1000, 1999)}/">騎手{rng.randint(1, 200)}</a></td>'
+            f"<td>{rng.randint(1, 3)}:{rng.randint(0, 59):02d}.{rng.randint(0, 9)}</td>"
+            f"<td>{'' if rank == 1 else rng.choice(MARGINS[1:])}</td>"
+            f"<td>{rng.uniform(1.1, 300):.1f}</td><td>{rng.randint(1, n_horses)}</td>"
+            f"<td>{weight}({rng.randint(-20, 20):+d})</td>"
+            f'<td>[{rng.choice("東西")}] <a href="/trainer/result/recent/0{rng.randint(1000, 1999)}/">調教師{rng.randint(1, 200)}</a></td>'
+            "</tr>"
+        )
+    header = "".join(f"<th>{name}</th>" for name in RACE_HEADER)
+    a, b, c = rng.sample(range(1, n_horses + 1), 3)
+    payouts = [
+        ("tan", "単勝", f"{a}", f"{rng.randint(110, 9000):,}", "1"),
+        ("fuku", "複勝", f"{a}<br />{b}<br />{c}", "<br />".join(f"{rng.randint(100, 2000):,}" for _ in range(3)), "1<br />2<br />3"),
+        ("waku", "枠連", f"{(a + 1) // 2} - {(b + 1) // 2}", f"{rng.randint(150, 9000):,}", "1"),
+        ("uren", "馬連", f"{a} - {b}", f"{rng.randint(150, 50000):,}", "1"),
+        ("wide", "ワイド", f"{a} - {b}<br />{a} - {c}<br />{b} - {c}", "<br />".join(f"{rng.randint(100, 9000):,}" for _ in range(3)), "1<br />2<br />3"),
+        ("utan", "馬単", f"{a} → {b}", f"{rng.randint(200, 90000):,}", "1"),
+        ("sanfuku", "三連複", f"{a} - {b} - {c}", f"{rng.randint(200, 900000):,}", "1"),
+        ("santan", "三連単", f"{a} → {b} → {c}", f"{rng.randint(500, 9000000):,}", "1"),
+    ]
+    pay_rows = [
+        f'<tr><th class="{cls}">{name}</th><td>{umaban}</td><td class="txt_r">{ret}</td><td class="txt_r">{pop}</td></tr>'
+        for cls, name, umaban, ret, pop in payouts
+    ]
+    body = (
+        '<div class="data_intro"><dl class="racedata fc">'
+        f"<dt>{int(race_id[10:])} R</dt><dd><h1>{PLACES[place - 1]}特別{rng.choice(TITLE_CLASSES)}</h1>"
+        f"<p><diary_snap_cut><span>{surface}{direction}{rng.choice([1000, 1200, 1400, 1600, 1800, 2000, 2400, 3000])}m"
+        f"&nbsp;/&nbsp;天候 : {rng.choice(WEATHERS)}&nbsp;/&nbsp;{'ダート' if surface == 'ダ' else '芝'} : {rng.choice(GOINGS)}"
+        "&nbsp;/&nbsp;発走 : 15:40</span></diary_snap_cut></p></dd></dl>"
+        f'<p class="smalltxt">{year}年{rng.randint(1, 12)}月{rng.randint(1, 28)}日 '
+        f"{int(race_id[6:8])}回{PLACES[place - 1]}{int(race_id[8:10])}日目 {rng.choice(CLASSES)}&nbsp;&nbsp;(混)(特指)(定量)</p></div>"
+        f'<table class="race_table_01 nk_tb_common" summary="レース結果"><tr>{header}</tr>{"".join(rows)}</table>'
+        '<dl class="pay_block"><dt>払い戻し</dt><dd>'
+        f'<table class="pay_table_01" summary="払い戻し">{"".join(pay_rows[:4])}</table>'
+        f'<table class="pay_table_01" summary="ワイド">{"".join(pay_rows[4:])}</table>'
+        "</dd></dl>"
+    )
+    return _wrap_page(body)
+
+
+def _horse_page(rng, n_rows):
+    """netkeibaのhorseページと同じ構造（db_h_race_results）の合成ページ"""
+    rows = []
+    for _ in range(n_rows):
+        surface = rng.choice("芝ダ")
+        rank = rng.randint(1, 16)
+        margin = -rng.randint(1, 9) / 10 if rank == 1 else rng.randint(0, 30) / 10
+        cells = [
+            f"{rng.randint(2010, 2024)}/{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}",
+            f"{rng.randint(1, 5)}{rng.choice(PLACES)}{rng.randint(1, 12)}",
+            rng.choice(WEATHERS), str(rng.randint(1, 12)),
+            f"テスト特別{rng.choice(TITLE_CLASSES)}", "", str(rng.randint(8, 18)),
+            str(rng.randint(1, 8)), str(rng.randint(1, 18)), f"{rng.uniform(1.1, 300):.1f}",
+            str(rng.randint(1, 18)), str(rank), "騎手", "57",
+            f"{surface}{rng.choice([1200, 1600, 2000, 2400])}", rng.choice(["良", "稍", "重", "不"]),
+            "**", f"1:{rng.randint(0, 59):02d}.{rng.randint(0, 9)}", f"{margin:.1f}", "**",
+            f"{rng.randint(1, 16)}-{rng.randint(1, 16)}", "35.0-35.8", f"{rng.uniform(33, 40):.1f}",
+            f"{rng.randint(400, 540)}({rng.randint(-20, 20):+d})", "", "", "勝ち馬",
+            f"{rng.randint(100, 20000):,}.0" if rank <= 5 else "",
+        ]
+        rows.append("<tr>" + "".join(f"<td>{cell}</td>" for cell in cells) + "</tr>")
+    header = "".join(f"<th>{name}</th>" for name in HORSE_HEADER)
+    return _wrap_page(
+        f'<table class="db_h_race_results nk_tb_common"><thead><tr>{header}</tr></thead>'
+        f'<tbody>{"".join(rows)}</tbody></table>'
+    )
+
+
+def generate_pages(data_dir, n_races, seed=0):
+    """
+    _関数の意味と使い方_
+    ベンチマーク用に、netkeibaと同じ構造の合成ページをdata_dir / "html" に書き出す関数です。
+    raceページをn_races個、horseページを同じ数だけ作ります。
+    1レースあたり8〜18頭、1頭あたり5〜30走の過去成績を入れます。
+    同じseedなら同じページが作られるので、実行ごとの比較ができます。
+    すでに同じ数のページがある場合は作り直しません。
+    """
+    race_dir = Path(data_dir) / "html" / "race"
+    horse_dir = Path(data_dir) / "html" / "horse"
+    race_dir.mkdir(parents=True, exist_ok=True)
+    horse_dir.mkdir(parents=True, exist_ok=True)
+    if len(list(race_dir.glob("*.bin"))) == n_races:
+        return
+    rng = random.Random(seed)
+    horse_id_list = [f"{2010 + i % 15}{i:06d}" for i in range(n_races)]
+    for race_id in _race_id_list(n_races):
+        race_horse_id_list = rng.sample(horse_id_list, min(rng.randint(8, 18), n_races))
+        (race_dir / f"{race_id}.bin").write_bytes(_race_page(rng, race_id, race_horse_id_list))
+    for horse_id in horse_id_list:
+        (horse_dir / f"{horse_id}.bin").write_bytes(_horse_page(rng, rng.randint(5, 30)))
+
+
+def _max_rss_mb():
+    # ru_maxrssはLinuxではKB、macOSではバイト単位
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1 << 20) if sys.platform == "darwin" else max_rss / (1 << 10)
+
+
+def _run_stage(work_src_dir, module_name, func_name, kwargs):
+    """
+    1つのステージを実行して、時間とメモリを返す。
+    ステージごとに新しいプロセスで実行するので、最大メモリがほかのステージに影響されません。
+    作業ディレクトリのsrcに移動してからimportするので、../data は作業ディレクトリのdataになります。
+    """
+    os.chdir(work_src_dir)
+    sys.path.insert(0, str(SRC_DIR))
+    module = __import__(module_name)
+    if hasattr(module, "tqdm"):
+        # 進捗バーの表示は計測に含めない
+        module.tqdm = lambda iterable, **_: iterable
+    base_rss_mb = _max_rss_mb()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    result = getattr(module, func_name)(**kwargs)
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - start_cpu
+    if isinstance(result, tuple):
+        result = result[0]
+    return {
+        "seconds": round(seconds, 4),
+        "cpu_seconds": round(cpu_seconds, 4),
+        "peak_rss_mb": round(_max_rss_mb(), 1),
+        "base_rss_mb": round(base_rss_mb, 1),
+        "rows": None if result is None else len(result),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SRC_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(sizes=None, stages=None, n_workers=1, seed=0, work_dir=None, output=None, engine="pandas"):
+    """
+    _関数の意味と使い方_
+    合成ページを使って、create_raw・dfの各ステージの実行時間と最大メモリを計測する関数です。
+    ネットワークには接続しません。
+    結果は1ステージ1行のJSON Linesでoutputに追記するので、実行ごとの結果を比較できます。
+    各行には実行日時・gitのコミット・ページ数・ステージ名・時間・メモリが入ります。
+
+    Args:
+        sizes (list, optional): raceページ数のリスト。デフォルトは[1000, 10000, 100000]
+        stages (list, optional): 計測するステージ名のリスト。デフォルトはSTAGESのすべて
+        n_workers (int, optional): create_rawのステージに渡すワーカープロセス数
+        seed (int, optional): 合成ページの乱数のシード
+        work_dir (str, optional): 合成ページと出力を置くディレクトリ。
+            指定した場合は実行後も残し、次回はページを作り直さずに使います。
+            指定しない場合は一時ディレクトリを使い、実行後に削除します。
+        output (str, optional): 結果を追記するファイル。デフォルトはBENCHMARK_DIR / RESULT_FILE_NAME
+        engine (str, optional): dfのステージに渡す変換の実装（"pandas"か"polars"）
+    """
+    sizes = sizes or DEFAULT_SIZES
+    stage_list = [stage for stage in STAGES if stages is None or stage[0] in stages]
+    output = Path(output) if output else BENCHMARK_DIR / RESULT_FILE_NAME
+    output.parent.mkdir(parents=True, exist_ok=True)
+    keep = work_dir is not None
+    work_dir = Path(work_dir or tempfile.mkdtemp(prefix="keiba_benchmark_")).resolve()
+    run_info = {
+        "run_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "n_workers": n_workers,
+        "seed": seed,
+        "engine": engine,
+    }
+    records = []
+    try:
+        for size in sizes:
+            size_dir = work_dir / f"size_{size}"
+            data_dir = size_dir / "data"
+            (size_dir / "src").mkdir(parents=True, exist_ok=True)
+            shutil.copytree(MAPPING_DIR, data_dir / "mapping", dirs_exist_ok=True)
+            start = time.perf_counter()
+            generate_pages(data_dir, size, seed)
+            print(f"size={size}: pages ready in {time.perf_counter() - start:.1f}s")
+            # 前回の出力が残っているとincrementalでなくても結果が変わりうるので消しておく
+            for name in ["raw_csv", "df_csv", "manifest"]:
+                shutil.rmtree(data_dir / name, ignore_errors=True)
+            for stage_name, module_name, func_name in stage_list:
+                kwargs = {"n_workers": n_workers} if module_name == "create_raw" else {"engine": engine}
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    stats = executor.submit(
+                        _run_stage, str(size_dir / "src"), module_name, func_name, kwargs
+                    ).result()
+                record = {**run_info, "size": size, "stage": stage_name, **stats}
+                records.append(record)
+                with open(output, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                print(
+                    f"size={size} {stage_name}: {stats['seconds']:.2f}s "
+                    f"peak_rss={stats['peak_rss_mb']:.0f}MB rows={stats['rows']}"
+                )
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="create_raw・dfの各ステージのベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--stages", nargs="+", choices=[stage[0] for stage in STAGES])
+    parser.add_argument("--n-workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir")
+    parser.add_argument("--output")
+    parser.add_argument("--engine", choices=["pandas", "polars"], default="pandas")
+    args = parser.parse_args()
+    run_benchmark(
+        sizes=args.sizes,
+        stages=args.stages,
+        n_workers=args.n_workers,
+        seed=args.seed,
+        work_dir=args.work_dir,
+        output=args.output,
+        engine=args.engine,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,30 @@
+import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
 from pathlib import Path
 from tqdm.notebook import tqdm
 import pickle
 import re
-from io import StringIO
 import json
+import os
+import time
+import heapq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from archive import ARCHIVE_HORSE_DIR, ARCHIVE_RACE_DIR, INDEX_FILE_NAME, open_archive
+from extract import (
+    HORSE_RESULT_COLUMNS,
+    RACE_RESULT_COLUMNS,
+    parse_horse_html,
+    parse_html,
+    parse_race_html,
+    read_race_info,
+    read_race_result,
+    read_race_return,
+)
+from id_dict import ID_COLUMN_DTYPES, open_id_dictionary
+from metrics import metrics, stage
 
 
 # ディレクトリの設定（pathlib を使用）
@@ -19,6 +38,7 @@ HTML_DIR = DATA_DIR / "html"
 HTML_RASE_DIR = HTML_DIR / "race"
 HTML_HORSE_DIR = HTML_DIR / "horse"
 RAW_CSV_DIR = DATA_DIR / "raw_csv"
+MANIFEST_DIR = DATA_DIR / "manifest"
 
 
 HORSE_ID_DIR.mkdir(parents=True, exist_ok=True)
@@ -28,6 +48,7 @@ HTML_DIR.mkdir(parents=True, exist_ok=True)
 HTML_RASE_DIR.mkdir(parents=True, exist_ok=True)
 HTML_HORSE_DIR.mkdir(parents=True, exist_ok=True)
 RAW_CSV_DIR.mkdir(parents=True, exist_ok=True)
+MANIFEST_DIR.mkdir(parents=True, exist_ok=True)
 
 
 
@@ -42,73 +63,436 @@ def load_data(file_name, directory: Path):
         return pickle.load(f)
 
 
-def raw_race_csv(html_race_file_list=None):
+def list_html_pages(html_dir, archive_dir):
+    """
+    html_dirの.binファイルと、archive_dirのアーカイブに入っているページを合わせて、idの昇順で返す関数。
+    アーカイブのページはArchivePageで、.binファイルと同じようにstem, read_bytes(), stat()が使えます。
+    同じidが両方にある場合は.binファイルの方を使います。
+    """
+    page_dict = {}
+    if (archive_dir / INDEX_FILE_NAME).exists():
+        for page in open_archive(archive_dir).pages():
+            page_dict[page.stem] = page
+    for html_path in html_dir.glob("*.bin"):
+        page_dict[html_path.stem] = html_path
+    return [page_dict[id_] for id_ in sorted(page_dict)]
+
+
+def _parse_race_file(html_path):
+    return parse_race_html(html_path.read_bytes(), html_path.stem)
+
+
+def _parse_race_result_file(html_path):
+    return read_race_result(parse_html(html_path.read_bytes()), html_path.stem)
+
+
+def _parse_race_info_file(html_path):
+    return read_race_info(parse_html(html_path.read_bytes()), html_path.stem)
+
+
+def _parse_race_return_file(html_path):
+    return read_race_return(parse_html(html_path.read_bytes()), html_path.stem)
+
+
+def _parse_horse_file(html_path):
+    return parse_horse_html(html_path.read_bytes(), html_path.stem)
+
+
+def _timed_call(func, html_path):
+    start = time.perf_counter()
+    result = func(html_path)
+    return result, time.perf_counter() - start
+
+
+def _timed_chunk(func, html_path_list):
+    return [_timed_call(func, html_path) for html_path in html_path_list]
+
+
+def _map_chunks(executor, func, html_path_list, chunksize, max_pending):
+    """
+    html_path_listをchunksizeずつワーカーに渡し、結果を順番どおりに返すジェネレータ。
+    executor.mapと違って、同時に投げるチャンクをmax_pending個までにするので、
+    書き込みが追いつかなくても結果がメモリに溜まり続けません。
+    """
+    pending = deque()
+    for i in range(0, len(html_path_list), chunksize):
+        pending.append(executor.submit(_timed_chunk, func, html_path_list[i : i + chunksize]))
+        if len(pending) >= max_pending:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def map_pages(func, html_path_list, n_workers=1, chunksize=64):
+    """
+    html_path_listの各ファイルにfuncを適用し、結果をhtml_path_listと同じ順番で返すジェネレータ。
+    n_workersが1のときは今まで通り1プロセスで順番に処理します。
+    2以上（Noneの場合はCPUコア数）のときはプロセスプールで並列にパースします。
+    先読みするのはワーカー数の2倍のチャンクまでです。
+    funcはプロセス間で受け渡せるよう、モジュールのトップレベルで定義された関数にしてください。
+
+    Args:
+        func (callable): htmlファイルのパス（またはArchivePage）を受け取る関数
+        html_path_list (list): htmlファイルのパス（またはArchivePage）のリスト
+        n_workers (int, optional): ワーカープロセス数
+        chunksize (int, optional): 1回にワーカーへ渡すファイル数
+    """
+    # 1ページのパース時間はワーカーの中で測って、結果と一緒に受け取る
+    timed_func = partial(_timed_call, func)
+    parser = func.__name__.lstrip("_")
+    if n_workers == 1:
+        results = map(timed_func, html_path_list)
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        max_pending = 2 * (n_workers or os.cpu_count() or 1)
+        results = _map_chunks(executor, func, html_path_list, chunksize, max_pending)
+    try:
+        for result, seconds in tqdm(results, total=len(html_path_list)):
+            metrics.observe("parse_seconds", seconds, parser=parser)
+            yield result
+    finally:
+        if n_workers != 1:
+            executor.shutdown(cancel_futures=True)
+
+
+def _manifest_file_name(file_name):
+    return f"{Path(file_name).stem}_manifest.pickle"
+
+
+def _load_manifest(file_name):
+    try:
+        return load_data(_manifest_file_name(file_name), MANIFEST_DIR)
+    except FileNotFoundError:
+        return {}
+
+
+def plan_raw_build(html_path_list, file_names, incremental=False):
+    """
+    _関数の意味と使い方_
+    manifestを見て、どのhtmlファイルをパースし直す必要があるかを決める関数です。
+    manifestには出力CSVごとに、htmlファイルのサイズ・更新時刻と、そのファイルから作られた行数が記録されています。
+    incrementalがTrueで、出力CSVとmanifestがすべてそろっている場合は、
+    新しく追加されたファイルと、サイズか更新時刻が変わったファイルだけをパース対象にします。
+    それ以外の場合は、すべてのファイルをパース対象にします（全件作り直し）。
+
+    Args:
+        html_path_list (list): list_html_pagesで取得したページのリスト
+        file_names (list): 出力するCSVのファイル名のリスト
+        incremental (bool, optional): 差分だけをパースするかどうか
+
+    Returns:
+        tuple: (パースするファイルのリスト, 既存CSVから削除するidの集合, ファイルごとのstat)
+        全件作り直しの場合、削除するidの集合はNoneになります。
+    """
+    stats = {}
+    for html_path in html_path_list:
+        stat = html_path.stat()
+        stats[html_path.stem] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    manifests = [_load_manifest(file_name) for file_name in file_names]
+    outputs_exist = all((RAW_CSV_DIR / file_name).exists() for file_name in file_names)
+    if not incremental or not outputs_exist or not all(manifests):
+        return html_path_list, None, stats
+
+    changed_path_list = []
+    for html_path in html_path_list:
+        stat = stats[html_path.stem]
+        for manifest in manifests:
+            entry = manifest.get(html_path.stem)
+            if entry is None or entry["size"] != stat["size"] or entry["mtime_ns"] != stat["mtime_ns"]:
+                changed_path_list.append(html_path)
+                break
+    # 前回あったが今回なくなったファイルの行は削除する
+    removed_ids = set()
+    for manifest in manifests:
+        removed_ids |= manifest.keys() - stats.keys()
+    drop_ids = removed_ids | {html_path.stem for html_path in changed_path_list}
+    return changed_path_list, drop_ids, stats
+
+
+def _update_manifest(file_name, row_counts, parsed_path_list, drop_ids, stats):
+    """
+    パースしたファイルのstatと行数をmanifestに記録して保存する関数。
+    row_countsはid -> そのページから作られた行数の辞書です（RawCsvWriter.row_counts）。
+    テーブルが取れなかったファイルも0行として記録し、変更がなければ次回はスキップします。
+    パースしたページ数・テーブルがなかったページ数・変更がなくスキップしたページ数はmetricsに記録します。
+    """
+    n_missing = sum(html_path.stem not in row_counts for html_path in parsed_path_list)
+    metrics.incr("pages_parsed_total", len(parsed_path_list) - n_missing, file=file_name)
+    metrics.incr("pages_missing_table_total", n_missing, file=file_name)
+    metrics.incr("pages_unchanged_total", len(stats) - len(parsed_path_list), file=file_name)
+    manifest = {} if drop_ids is None else _load_manifest(file_name)
+    for id_ in drop_ids or ():
+        manifest.pop(id_, None)
+    for html_path in parsed_path_list:
+        id_ = html_path.stem
+        manifest[id_] = {**stats[id_], "rows": row_counts.get(id_, 0)}
+    save_data(manifest, _manifest_file_name(file_name), MANIFEST_DIR)
+
+
+def _read_raw_csv(output_file, chunksize=None):
+    # 既存の行は文字列のまま読み込んで、書式を変えずに書き戻す
+    return pd.read_csv(
+        output_file, sep="\t", dtype=str, keep_default_na=False, index_col=0, chunksize=chunksize
+    )
+
+
+def _save_raw_csv(dfs, file_name, key, columns=None, drop_ids=None):
+    """
+    ページごとのDataFrameを結合し、RAW_CSV_DIRにCSVファイルとして保存する関数。
+    drop_idsが与えられた場合は、既存のCSVからdrop_idsの行を取り除き、新しくパースした行を追加して保存します。
+    keyはrace_id, horse_idが入っている列名で、列にない場合はインデックス名として使います。
+    """
+    output_file = RAW_CSV_DIR / file_name
+    df_list = []
+    if dfs:
+        new_df = pd.concat(dfs.values())
+        if columns is not None:
+            new_df.columns = columns
+        if key not in new_df.columns:
+            new_df.index.name = key
+        df_list.append(new_df)
+    if drop_ids is not None:
+        old_df = _read_raw_csv(output_file)
+        old_df.index = old_df.index.astype(str)
+        old_ids = old_df[key] if key in old_df.columns else old_df.index
+        if not drop_ids:
+            # 追加・変更・削除されたページがなければ書き直さない
+            metrics.set_gauge("rows", len(old_df), file=file_name)
+            return old_df
+        old_df = old_df[~old_ids.isin(drop_ids)]
+        for new_df in df_list:
+            new_df.columns = new_df.columns.astype(str)
+        df_list.insert(0, old_df)
+    concat_df = pd.concat(df_list)
+    if drop_ids is not None:
+        concat_df = concat_df.sort_values(key, kind="stable")
+    # CSVファイルとして保存
+    concat_df.to_csv(output_file, encoding='utf-8', sep='\t')
+    metrics.incr("rows_parsed_total", sum(len(df) for df in dfs.values()), file=file_name)
+    metrics.set_gauge("rows", len(concat_df), file=file_name)
+    return concat_df
+
+
+class RawCsvWriter:
+    """
+    _クラスの意味と使い方_
+    ページごとのDataFrameを受け取って、RAW_CSV_DIRのCSVに書き出すクラスです。
+    batch_sizeがNoneなら、今まで通りすべてのページを溜めてからclose()で_save_raw_csvを呼びます。
+    batch_sizeを指定すると、batch_sizeページ溜まるたびに一時ファイルへ追記して手放すので、
+    ページ数が増えてもメモリ使用量は一定です（ストリーミング）。
+    ストリーミングでdrop_idsが与えられた場合は、新しい行を一時ファイルに書いておき、
+    close()で既存のCSVとkeyの順に突き合わせながら書き出します（既存のCSVも少しずつ読みます）。
+    書き出しが終わるまでは一時ファイルに書くので、途中で失敗しても既存のCSVは壊れません。
+
+    Example:
+        writer = RawCsvWriter("raw_race.csv", "race_id", RACE_RESULT_COLUMNS, batch_size=1000)
+        for race_id, df in pages:
+            writer.add(race_id, df)
+        writer.close()
+    """
+
+    def __init__(self, file_name, key, columns=None, drop_ids=None, batch_size=None):
+        self.file_name = file_name
+        self.key = key
+        self.columns = columns
+        self.drop_ids = drop_ids
+        self.batch_size = batch_size
+        self.output_file = RAW_CSV_DIR / file_name
+        # manifestに記録する、ページごとの行数
+        self.row_counts = {}
+        self._dfs = {}
+        self._n_rows = 0
+        self._tmp_files = []
+
+    def add(self, id_, df):
+        self.row_counts[id_] = len(df)
+        self._dfs[id_] = df
+        if self.batch_size is not None and len(self._dfs) >= self.batch_size:
+            self._flush()
+
+    def _new_tmp_file(self, name):
+        tmp_file = self.output_file.with_name(f"{self.output_file.stem}.{name}.tmp")
+        tmp_file.unlink(missing_ok=True)
+        self._tmp_files.append(tmp_file)
+        return tmp_file
+
+    def _write(self, tmp_file, df):
+        df.to_csv(
+            tmp_file, encoding='utf-8', sep='\t', mode="a", header=not tmp_file.exists()
+        )
+        self._n_rows += len(df)
+
+    def _flush(self):
+        if not self._dfs:
+            return
+        if not self._tmp_files:
+            self._new_tmp_file("new")
+        batch_df = pd.concat(self._dfs.values())
+        if self.columns is not None:
+            batch_df.columns = self.columns
+        if self.key not in batch_df.columns:
+            batch_df.index.name = self.key
+        self._write(self._tmp_files[0], batch_df)
+        self._dfs = {}
+
+    def _iter_pages(self, reader, drop_ids=None):
+        """CSVを少しずつ読んで、keyが同じ行のまとまりごとに (key, DataFrame) を返す。drop_idsの行は除きます"""
+        for chunk in reader:
+            chunk.index = chunk.index.astype(str)
+            ids = chunk[self.key] if self.key in chunk.columns else chunk.index.to_series()
+            if drop_ids:
+                keep = ~ids.isin(drop_ids).to_numpy()
+                chunk, ids = chunk[keep], ids[keep]
+            ids = ids.to_numpy()
+            starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else []
+            ends = np.r_[starts[1:], len(ids)] if len(ids) else []
+            for start, end in zip(starts, ends):
+                yield ids[start], chunk.iloc[start:end]
+
+    def _merge(self, new_file):
+        """既存のCSV（drop_idsの行を除く）と新しい行を、keyの順に混ぜながら書き出す"""
+        chunksize = self.batch_size * 100
+        old_pages = self._iter_pages(_read_raw_csv(self.output_file, chunksize), self.drop_ids)
+        new_pages = self._iter_pages(_read_raw_csv(new_file, chunksize)) if new_file else iter(())
+        merged_file = self._new_tmp_file("merged")
+        self._n_rows = 0
+        batch = []
+        for _, df in heapq.merge(old_pages, new_pages, key=lambda page: page[0]):
+            batch.append(df)
+            if len(batch) >= self.batch_size:
+                self._write(merged_file, pd.concat(batch))
+                batch = []
+        if batch:
+            self._write(merged_file, pd.concat(batch))
+        if not merged_file.exists():
+            # すべての行が削除された場合はヘッダーだけ書く
+            self._write(merged_file, pd.read_csv(self.output_file, sep="\t", index_col=0, nrows=0))
+        return merged_file
+
+    def close(self):
+        """
+        残りの行を書き出してCSVを完成させる。
+
+        Returns:
+            pd.DataFrame or Path: batch_sizeがNoneなら結合したDataFrame、指定した場合はCSVのパス
+        """
+        if self.batch_size is None:
+            return _save_raw_csv(self._dfs, self.file_name, self.key, self.columns, self.drop_ids)
+        try:
+            self._flush()
+            n_new_rows = self._n_rows
+            new_file = self._tmp_files[0] if self._tmp_files else None
+            if self.drop_ids is not None and not self.drop_ids:
+                # 追加・変更・削除されたページがなければ書き直さない
+                self._n_rows = sum(len(chunk) for chunk in _read_raw_csv(self.output_file, 100000))
+            elif self.drop_ids is not None:
+                self._merge(new_file).replace(self.output_file)
+            elif new_file is None:
+                # 1ページもない場合は、_save_raw_csv（pd.concat）と同じくエラーにする
+                raise ValueError("No objects to concatenate")
+            else:
+                new_file.replace(self.output_file)
+            metrics.incr("rows_parsed_total", n_new_rows, file=self.file_name)
+            metrics.set_gauge("rows", self._n_rows, file=self.file_name)
+        finally:
+            for tmp_file in self._tmp_files:
+                tmp_file.unlink(missing_ok=True)
+        return self.output_file
+
+
+@stage("raw_race_csv")
+def raw_race_csv(html_race_file_list=None, n_workers=1, chunksize=64, incremental=False, batch_size=None):
     """
     _関数の意味と使い方_
     この関数は、レース結果のデータを取得しCSVファイルに保存する関数です。
     関数の引数は、html_race_file_listです。
     レース結果をDataFrameとして取得し、CSVファイルとして保存します。
     horse_id, jockey_id, trainer_idを追加しています。
+
+    Args:
+        n_workers (int, optional): パースに使うプロセス数。1なら並列化しない
+        chunksize (int, optional): 1回にワーカーへ渡すファイル数
+        incremental (bool, optional): Trueならmanifestを使い、新規・更新されたページだけをパースして既存のCSVにマージする
+        batch_size (int, optional): 指定すると、batch_sizeページごとにCSVへ書き出して手放す（RawCsvWriter参照）。
+            メモリ使用量はページ数によらず一定になり、戻り値はDataFrameではなくCSVのパスになります
     """
-    html_race_file_list = list(HTML_RASE_DIR.glob("*.bin"))
-    dfs = {}
-    for html_race_file in tqdm(html_race_file_list):
-        with open(html_race_file, "rb") as f:
-            race_id = html_race_file.stem
-            html = f.read()
-            # BeautifulSoupで特定のテーブルだけを抽出
-            soup = BeautifulSoup(html, 'html.parser')
-            target_html = str(soup.find('table', class_='race_table_01'))
-            df = pd.read_html(target_html)[0]  # 抽出したテーブルだけを変換
-            
-            # horse_id列を追加
-            a_list = soup.find_all("a", href=re.compile(r"^/horse/"))
-            horse_id_list = []
-            for a in a_list:
-                horse_id = re.findall(r"/horse/(\d+)", a["href"])[0]
-                horse_id_list.append(horse_id)
-            
-            # jockey_id列を追加
-            a_list = soup.find_all("a", href=re.compile(r"^/jockey/result/recent/"))
-            jockey_id_list = []
-            for a in a_list:
-                jockey_id = re.findall(r"/jockey/result/recent/(\d+)", a["href"])[0]
-                jockey_id_list.append(jockey_id)
-            
-            # trainer_id列を追加
-            a_list = soup.find_all("a", href=re.compile(r"^/trainer/result/recent/"))
-            trainer_id_list = []
-            for a in a_list:
-                trainer_id = re.findall(r"/trainer/result/recent/(\d+)", a["href"])[0]
-                trainer_id_list.append(trainer_id)
-                
-            
-            df["horse_id"] = horse_id_list
-            df["jockey_id"] = jockey_id_list
-            df["trainer_id"] = trainer_id_list
-            df.index = pd.Index([race_id] * len(df))
-            dfs[race_id] = df
-    
-    concat_df = pd.concat(dfs.values())
-    concat_df.index.name = "race_id"
-    concat_df.columns = [ "着順", "枠番", "馬番", "馬名", "性齢", "斤量", "騎手", "タイム", "着差", "単勝", "人気", "馬体重", "調教師", "horse_id", "jockey_id", "trainer_id"
-    ]
-    
-    
-    # CSVファイルとして保存
-    output_file = RAW_CSV_DIR / f"raw_race.csv"
-    concat_df.to_csv(output_file, encoding='utf-8', sep='\t')
-    
+    html_race_file_list, drop_ids, stats = plan_raw_build(
+        list_html_pages(HTML_RASE_DIR, ARCHIVE_RACE_DIR), ["raw_race.csv"], incremental
+    )
+    writer = RawCsvWriter("raw_race.csv", "race_id", RACE_RESULT_COLUMNS, drop_ids, batch_size)
+    results = map_pages(_parse_race_result_file, html_race_file_list, n_workers, chunksize)
+    for html_race_file, df in zip(html_race_file_list, results):
+        if df is None:
+            print(f"Warning: No table found in {html_race_file}")
+            continue
+        writer.add(html_race_file.stem, df)
+
+    concat_df = writer.close()
+    _update_manifest("raw_race.csv", writer.row_counts, html_race_file_list, drop_ids, stats)
     return concat_df
 
 
+@stage("raw_race_all_csv")
+def raw_race_all_csv(n_workers=1, chunksize=64, incremental=False, batch_size=None):
+    """
+    _関数の意味と使い方_
+    raceページのhtmlを1ファイルにつき1回だけ読み込んでパースし、
+    レース結果・レース情報・払い戻しの3つのテーブルをまとめて作成する関数です。
+    raw_race_csv, raw_race_info_csv, raw_race_return_csvを順に呼ぶのと同じ
+    raw_race.csv, raw_race_info.csv, raw_race_return.csvを保存します。
+
+    Args:
+        n_workers (int, optional): パースに使うプロセス数。1なら並列化しない
+        chunksize (int, optional): 1回にワーカーへ渡すファイル数
+        incremental (bool, optional): Trueならmanifestを使い、新規・更新されたページだけをパースして既存のCSVにマージする
+        batch_size (int, optional): 指定すると、batch_sizeページごとにCSVへ書き出して手放す（RawCsvWriter参照）
+
+    Returns:
+        tuple: (レース結果, レース情報, 払い戻し) のDataFrame。batch_sizeを指定した場合は3つのCSVのパス
+    """
+    file_names = ["raw_race.csv", "raw_race_info.csv", "raw_race_return.csv"]
+    html_path_list, drop_ids, stats = plan_raw_build(
+        list_html_pages(HTML_RASE_DIR, ARCHIVE_RACE_DIR), file_names, incremental
+    )
+    result_writer = RawCsvWriter("raw_race.csv", "race_id", RACE_RESULT_COLUMNS, drop_ids, batch_size)
+    info_writer = RawCsvWriter("raw_race_info.csv", "race_id", drop_ids=drop_ids, batch_size=batch_size)
+    return_writer = RawCsvWriter("raw_race_return.csv", "race_id", drop_ids=drop_ids, batch_size=batch_size)
+    results = map_pages(_parse_race_file, html_path_list, n_workers, chunksize)
+    for html_path, (result_df, info_df, return_df) in zip(html_path_list, results):
+        race_id = html_path.stem
+        if result_df is None:
+            print(f"Warning: No table found in {html_path}")
+        else:
+            result_writer.add(race_id, result_df)
+        if info_df is None:
+            print(f"table not found at {race_id}")
+        else:
+            info_writer.add(race_id, info_df)
+        if return_df is None:
+            print(f"table not found at {html_path}")
+        else:
+            return_writer.add(race_id, return_df)
+
+    writers = [result_writer, info_writer, return_writer]
+    outputs = [writer.close() for writer in writers]
+    for file_name, writer in zip(file_names, writers):
+        _update_manifest(file_name, writer.row_counts, html_path_list, drop_ids, stats)
+    if batch_size is not None:
+        return tuple(outputs)
+    result_df, info_df, return_df = outputs
+    return result_df, info_df.reset_index(), return_df.reset_index()
+
+
 
+@stage("create_id_list")
 def create_id_list(raw_race_csv_dir=None):
     """
     この関数は、horse_id, jockey_id, trainer_idを取得しpickleファイルに保存する関数です。
     _DIRにあるCSVファイルから、horse_id, jockey_id, trainer_idを取得します。
     CSVファイル名はrace_raw.csvです。
     horse_id, jockey_id, trainer_idをリストで保存します。
+    あわせてID辞書（id_dict）に名前と一緒に登録します。
     
     Args:
         race_results_dir (Path, optional): レース結果のCSVファイルがあるディレクトリ
@@ -119,12 +503,17 @@ def create_id_list(raw_race_csv_dir=None):
     trainer_id_list = []
     
     # race.csvを読み込む
-    race_results = pd.read_csv(RAW_CSV_DIR/ "raw_race.csv", encoding='utf-8', sep='\t')
+    race_results = pd.read_csv(RAW_CSV_DIR/ "raw_race.csv", encoding='utf-8', sep='\t', dtype=ID_COLUMN_DTYPES)
     
-    # 重複を除いてIDリストを作成
-    horse_id_list = race_results['horse_id'].unique().tolist()
-    jockey_id_list = race_results['jockey_id'].unique().tolist()
-    trainer_id_list = race_results['trainer_id'].unique().tolist()
+    # 重複を除いてIDリストを作成（リンクがなくてidが取れなかった行は除く）
+    horse_id_list = race_results['horse_id'].dropna().unique().tolist()
+    jockey_id_list = race_results['jockey_id'].dropna().unique().tolist()
+    trainer_id_list = race_results['trainer_id'].dropna().unique().tolist()
+
+    # ID辞書にも登録して、名前と一緒にint32のコードを付けておく
+    open_id_dictionary("horse").encode(race_results['horse_id'], race_results['馬名'])
+    open_id_dictionary("jockey").encode(race_results['jockey_id'], race_results['騎手'])
+    open_id_dictionary("trainer").encode(race_results['trainer_id'], race_results['調教師'])
     
     # pickleファイルとして保存
     save_data(horse_id_list, "horse_id_list.pickle", HORSE_ID_DIR)
@@ -135,99 +524,87 @@ def create_id_list(raw_race_csv_dir=None):
 
 
     
-def create_horse_raw_csv(html_horse_file_list = None):
+@stage("create_horse_raw_csv")
+def create_horse_raw_csv(html_horse_file_list = None, n_workers=1, chunksize=64, incremental=False, batch_size=None):
     """
     _関数の意味と使い方_
     この関数は、馬のHTMLを取得しCSVファイルに保存する関数です。
     関数の引数は、html_horse_dirです。
     馬のデータをDataFrameとして取得し、CSVファイルとして保存します。
+
+    Args:
+        n_workers (int, optional): パースに使うプロセス数。1なら並列化しない
+        chunksize (int, optional): 1回にワーカーへ渡すファイル数
+        incremental (bool, optional): Trueならmanifestを使い、新規・更新されたページだけをパースして既存のCSVにマージする
+        batch_size (int, optional): 指定すると、batch_sizeページごとにCSVへ書き出して手放す（RawCsvWriter参照）。
+            メモリ使用量はページ数によらず一定になり、戻り値はDataFrameではなくCSVのパスになります
     """
-    dfs = {}
-    html_horse_file_list = list(HTML_HORSE_DIR.glob("*.bin"))
-    for html_horse_file in tqdm(html_horse_file_list):
-        with open(html_horse_file, "rb") as f:
-            horse_id = html_horse_file.stem
-            html = f.read()
-            # BeautifulSoupで特定のテーブルだけを抽出
-            soup = BeautifulSoup(html, 'html.parser')
-            table = soup.find('table', class_='db_h_race_results')
-            if table is None:
-                print(f"Warning: No table found in {html_horse_file}")
-                continue
-            df = pd.read_html(StringIO(str(table)))[0]  # 抽出したテーブルだけを変換
-            df.index = [horse_id] * len(df)
-            dfs[horse_id] = df
+    html_horse_file_list, drop_ids, stats = plan_raw_build(
+        list_html_pages(HTML_HORSE_DIR, ARCHIVE_HORSE_DIR), ["raw_horse.csv"], incremental
+    )
+    writer = RawCsvWriter("raw_horse.csv", "horse_id", HORSE_RESULT_COLUMNS, drop_ids, batch_size)
+    results = map_pages(_parse_horse_file, html_horse_file_list, n_workers, chunksize)
+    for html_horse_file, df in zip(html_horse_file_list, results):
+        if df is None:
+            print(f"Warning: No table found in {html_horse_file}")
+            continue
+        writer.add(html_horse_file.stem, df)
     
-    concat_df = pd.concat(dfs.values())
-    concat_df.index.name = "horse_id"
-    concat_df.columns = ["日付", "開催", "天気", "R", "レース名", "映像", "頭数", 
-    "枠番", "馬番", "オッズ", "人気", "着順", "騎手", "斤量", "距離", 
-    "馬場", "馬場指数", "タイム", "着差", "タイム指数", "通過", 
-    "ペース", "上り", "馬体重", "厩舎コメント", "備考", "勝ち馬", "賞金"
-]
-    
-    
-    # CSVファイルとして保存
-    output_file = RAW_CSV_DIR / f"raw_horse.csv"
-    concat_df.to_csv(output_file, encoding='utf-8', sep='\t')
+    concat_df = writer.close()
+    _update_manifest("raw_horse.csv", writer.row_counts, html_horse_file_list, drop_ids, stats)
     
     return concat_df
 
-def raw_race_info_csv():
+@stage("raw_race_info_csv")
+def raw_race_info_csv(n_workers=1, chunksize=64, incremental=False, batch_size=None):
     """
     raceページのhtmlを読み込んで、レース情報テーブルに加工する関数。
+
+    Args:
+        n_workers (int, optional): パースに使うプロセス数。1なら並列化しない
+        chunksize (int, optional): 1回にワーカーへ渡すファイル数
+        incremental (bool, optional): Trueならmanifestを使い、新規・更新されたページだけをパースして既存のCSVにマージする
+        batch_size (int, optional): 指定すると、batch_sizeページごとにCSVへ書き出して手放す（RawCsvWriter参照）。
+            メモリ使用量はページ数によらず一定になり、戻り値はDataFrameではなくCSVのパスになります
     """
-    dfs = {}
-    html_path_list = list(HTML_RASE_DIR.glob("*.bin"))
-    for html_path in tqdm(html_path_list):
-        with open(html_path, "rb") as f:
-            try:
-                html = f.read()
-                soup = BeautifulSoup(html, "lxml").find("div", class_="data_intro")
-                info_dict = {}
-                info_dict["title"] = soup.find("h1").text
-                p_list = soup.find_all("p")
-                info_dict["info1"] = re.findall(
-                    r"[\w:]+", p_list[0].text.replace(" ", "")
-                )
-                info_dict["info2"] = re.findall(r"\w+", p_list[1].text)
-                df = pd.DataFrame().from_dict(info_dict, orient="index").T
-
-                # ファイル名からrace_idを取得
-                race_id = html_path.stem
-                df.index = [race_id] * len(df)
-                dfs[race_id] = df
-            except IndexError as e:
-                print(f"table not found at {race_id}")
-                continue
-    concat_df = pd.concat(dfs.values())
-    concat_df.index.name = "race_id"
-    concat_df.columns = concat_df.columns.str.replace(" ", "")
-    concat_df.to_csv(RAW_CSV_DIR / "raw_race_info.csv", sep="\t")
-    return concat_df.reset_index()
-
-def raw_race_return_csv():
+    html_path_list, drop_ids, stats = plan_raw_build(
+        list_html_pages(HTML_RASE_DIR, ARCHIVE_RACE_DIR), ["raw_race_info.csv"], incremental
+    )
+    writer = RawCsvWriter("raw_race_info.csv", "race_id", drop_ids=drop_ids, batch_size=batch_size)
+    results = map_pages(_parse_race_info_file, html_path_list, n_workers, chunksize)
+    for html_path, df in zip(html_path_list, results):
+        # ファイル名からrace_idを取得
+        race_id = html_path.stem
+        if df is None:
+            print(f"table not found at {race_id}")
+            continue
+        writer.add(race_id, df)
+    concat_df = writer.close()
+    _update_manifest("raw_race_info.csv", writer.row_counts, html_path_list, drop_ids, stats)
+    return concat_df if batch_size is not None else concat_df.reset_index()
+
+@stage("raw_race_return_csv")
+def raw_race_return_csv(n_workers=1, chunksize=64, incremental=False, batch_size=None):
     """
     raceページのhtmlを読み込んで、払い戻しテーブルに加工する関数。
+
+    Args:
+        n_workers (int, optional): パースに使うプロセス数。1なら並列化しない
+        chunksize (int, optional): 1回にワーカーへ渡すファイル数
+        incremental (bool, optional): Trueならmanifestを使い、新規・更新されたページだけをパースして既存のCSVにマージする
+        batch_size (int, optional): 指定すると、batch_sizeページごとにCSVへ書き出して手放す（RawCsvWriter参照）。
+            メモリ使用量はページ数によらず一定になり、戻り値はDataFrameではなくCSVのパスになります
     """
-    dfs = {}
-    html_path_list = list(HTML_RASE_DIR.glob("*.bin"))
-    for html_path in tqdm(html_path_list):
-        with open(html_path, "rb") as f:
-            try:
-                html = f.read().decode('euc-jp')
-                soup = BeautifulSoup(html, 'html.parser')
-                pay_block = soup.find('dl', class_='pay_block')
-                df = pd.concat(pd.read_html(str(pay_block)))
-
-                # ファイル名からrace_idを取得
-                race_id = html_path.stem
-                # 最初の列にrace_idを挿入
-                df.insert(0, "race_id", race_id)
-                dfs[race_id] = df
-            except IndexError as e:
-                print(f"table not found at {html_path}")
-                continue
-    concat_df = pd.concat(dfs.values())
-    concat_df.to_csv(RAW_CSV_DIR / "raw_race_return.csv", sep="\t")
-    return concat_df.reset_index()
+    html_path_list, drop_ids, stats = plan_raw_build(
+        list_html_pages(HTML_RASE_DIR, ARCHIVE_RACE_DIR), ["raw_race_return.csv"], incremental
+    )
+    writer = RawCsvWriter("raw_race_return.csv", "race_id", drop_ids=drop_ids, batch_size=batch_size)
+    results = map_pages(_parse_race_return_file, html_path_list, n_workers, chunksize)
+    for html_path, df in zip(html_path_list, results):
+        if df is None:
+            print(f"table not found at {html_path}")
+            continue
+        writer.add(html_path.stem, df)
+    concat_df = writer.close()
+    _update_manifest("raw_race_return.csv", writer.row_counts, html_path_list, drop_ids, stats)
+    return concat_df if batch_size is not None else concat_df.reset_index()
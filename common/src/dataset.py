@@ -0,0 +1,250 @@
+import datetime
+import json
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from backtest import load_payouts, match_bets
+from df import DF_SCHEMAS
+from metrics import metrics, stage
+
+DATA_DIR = Path("../data")
+DF_CSV_DIR = DATA_DIR / "df_csv"
+FEATURE_DIR = DATA_DIR / "features"
+DATASET_DIR = DATA_DIR / "dataset"
+SCHEMA_FILE_NAME = "schema.json"
+
+# 特徴量にする列。カテゴリ変数はNaNを-1にしたコードのまま入れ、schema.jsonに種類の数を書きます
+ENTRY_COLUMNS = [
+    "umaban", "wakuban", "tansho_odds", "popularity", "impost",
+    "sex", "age", "weight", "weight_diff", "jockey_code", "trainer_code",
+]
+RACE_COLUMNS = [
+    "race_type", "around", "course_len", "weather", "ground_state", "race_class", "place", "n_horses",
+]
+CATEGORICAL_COLUMNS = [
+    "sex", "jockey_code", "trainer_code", "race_type", "around", "weather", "ground_state", "race_class", "place",
+]
+# 正解ラベル。払い戻しは100円あたりの金額で、当たっていなければ0です
+LABEL_COLUMNS = ["rank", "win", "top3", "tansho_return", "fukusho_return"]
+KEY_COLUMNS = ["race_id", "horse_code", "date"]
+
+Batch = namedtuple("Batch", ["features", "labels", "keys", "race_offsets"])
+
+
+def _read_df_csv(name, **kwargs):
+    schema = DF_SCHEMAS[name]
+    dtype = {column: t for column, t in schema.items() if not t.startswith("datetime")}
+    parse_dates = [column for column, t in schema.items() if t.startswith("datetime")]
+    return pd.read_csv(
+        DF_CSV_DIR / f"{name}.csv", sep="\t", dtype=dtype, parse_dates=parse_dates, **kwargs
+    )
+
+
+def _return_labels(entries, df_race_return):
+    """各出走馬の単勝・複勝の払い戻し（100円あたり）。backtest.match_betsで突き合わせます"""
+    payouts = load_payouts(df_race_return)
+    labels = {}
+    for bet_type, column in [("単勝", "tansho_return"), ("複勝", "fukusho_return")]:
+        bets = pd.DataFrame(
+            {"race_id": entries["race_id"], "bet_type": bet_type, "umaban_1": entries["umaban"], "stake": 100}
+        )
+        labels[column] = match_bets(bets, payouts)["payout"].to_numpy()
+    return labels
+
+
+def _join_tables():
+    """
+    df_race（出走馬）・df_race_info（レース条件）・近走成績の特徴量（horse_form.csv）を1回だけ結合し、
+    日付・race_id・馬番の順に並べる。レース情報がない出走は除きます。
+    n_horsesはdf_race_infoの出走頭数で、df_raceにない着順のない馬（中止など）も数えています。
+    """
+    entries = _read_df_csv("df_race")
+    race_info = _read_df_csv("df_race_info").drop_duplicates("race_id")
+    form = pd.read_csv(FEATURE_DIR / "horse_form.csv", sep="\t")
+    form_columns = [column for column in form.columns if column not in ("race_id", "horse_code")]
+    table = entries.merge(race_info, on="race_id", how="inner").merge(
+        form.astype({column: "float32" for column in form_columns}),
+        on=["race_id", "horse_code"],
+        how="left",
+    )
+    table = table.sort_values(["date", "race_id", "umaban"], kind="stable").reset_index(drop=True)
+    return table, form_columns
+
+
+def _write_column_matrix(path, table, columns, dtype, fill=None):
+    """
+    tableの列を、1列ずつメモリマップした.npyファイルに書き込む。
+    table.to_numpy()のように全体のコピーを作らないので、必要なメモリは1列分だけです。
+    """
+    matrix = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(len(table), len(columns)))
+    for j, column in enumerate(columns):
+        values = table[column]
+        if fill is not None and fill.get(column) is not None:
+            values = values.fillna(fill[column])
+        matrix[:, j] = values.to_numpy(dtype=dtype, na_value=np.nan if np.dtype(dtype).kind == "f" else 0)
+    matrix.flush()
+    del matrix
+
+
+@stage("training_matrix")
+def build_training_matrix(output_dir=None):
+    """
+    _関数の意味と使い方_
+    df_race, df_race_info, df_race_returnと近走成績の特徴量（features.horse_form_csvの出力）を1回だけ結合して、
+    学習にそのまま使える行列をoutput_dir（省略時はDATASET_DIR）に書き出す関数です。
+    行は日付・race_id・馬番の順で、同じレースの馬は連続した行になります。
+
+    書き出すファイル:
+        features.npy: float32の特徴量（行数, 特徴量数）。カテゴリ変数はNaNを-1にしたコード
+        labels.npy: int32のラベル（行数, 5）。rank, win, top3, tansho_return, fukusho_return
+        keys.npy: int64の (race_id, horse_code, 日付YYYYMMDD)
+        race_offsets.npy: int64の各レースの先頭行（最後に行数）。レースiは offsets[i]:offsets[i+1] 行
+        schema.json: 各列の名前と型、カテゴリ変数の種類の数、行数・レース数
+
+    どのファイルもnp.load(mmap_mode="r")で開けるので、TrainingMatrixで必要な行だけを読めます。
+
+    Returns:
+        Path: 書き出したディレクトリ
+    """
+    output_dir = Path(output_dir) if output_dir else DATASET_DIR
+    output_dir.mkdir(parents=True, exist_ok=True)
+    table, form_columns = _join_tables()
+    table["win"] = (table["rank"] == 1).astype("int32")
+    table["top3"] = (table["rank"] <= 3).astype("int32")
+    for column, values in _return_labels(table, _read_df_csv("df_race_return")).items():
+        table[column] = values
+    table["date"] = table["date"].dt.strftime("%Y%m%d").astype("int64")
+
+    feature_columns = ENTRY_COLUMNS + RACE_COLUMNS + form_columns
+    _write_column_matrix(
+        output_dir / "features.npy", table, feature_columns, np.float32,
+        fill={column: -1 for column in CATEGORICAL_COLUMNS},
+    )
+    _write_column_matrix(output_dir / "labels.npy", table, LABEL_COLUMNS, np.int32)
+    _write_column_matrix(output_dir / "keys.npy", table, KEY_COLUMNS, np.int64)
+    race_id = table["race_id"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, race_id[1:] != race_id[:-1]])[: len(race_id)]
+    np.save(output_dir / "race_offsets.npy", np.r_[starts, len(race_id)].astype(np.int64))
+
+    schema = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "n_rows": len(table),
+        "n_races": len(starts),
+        "features": {"dtype": "float32", "columns": feature_columns},
+        "labels": {"dtype": "int32", "columns": LABEL_COLUMNS},
+        "keys": {"dtype": "int64", "columns": KEY_COLUMNS},
+        "categorical": {
+            column: int(table[column].max()) + 1 if table[column].notna().any() else 0
+            for column in CATEGORICAL_COLUMNS
+        },
+    }
+    with open(output_dir / SCHEMA_FILE_NAME, "w", encoding="utf-8") as f:
+        json.dump(schema, f, ensure_ascii=False, indent=2)
+    metrics.set_gauge("rows", len(table), file="features.npy")
+    return output_dir
+
+
+class TrainingMatrix:
+    """
+    _クラスの意味と使い方_
+    build_training_matrixで書き出した行列を、メモリマップで開くクラスです。
+    開いただけではファイルを読み込まず、iter_batchesで取り出したバッチの行だけを読みます。
+
+    Example:
+        matrix = TrainingMatrix()
+        for batch in matrix.iter_batches(batch_size=4096, shuffle=True, to_="2023-12-31"):
+            model.train(batch.features, batch.labels[:, matrix.label_index("rank")], batch.race_offsets)
+    """
+
+    def __init__(self, directory=None):
+        self.directory = Path(directory) if directory else DATASET_DIR
+        with open(self.directory / SCHEMA_FILE_NAME, encoding="utf-8") as f:
+            self.schema = json.load(f)
+        self.features = np.load(self.directory / "features.npy", mmap_mode="r")
+        self.labels = np.load(self.directory / "labels.npy", mmap_mode="r")
+        self.keys = np.load(self.directory / "keys.npy", mmap_mode="r")
+        self.race_offsets = np.load(self.directory / "race_offsets.npy")
+        self.feature_names = self.schema["features"]["columns"]
+        self.label_names = self.schema["labels"]["columns"]
+
+    def __len__(self):
+        return len(self.features)
+
+    @property
+    def n_races(self):
+        return len(self.race_offsets) - 1
+
+    def feature_index(self, name):
+        return self.feature_names.index(name)
+
+    def label_index(self, name):
+        return self.label_names.index(name)
+
+    def race_range(self, from_=None, to_=None):
+        """from_〜to_（両端を含む日付）のレースの番号の範囲 (start, stop)。行は日付順なので二分探索で求めます"""
+        race_dates = self.keys[self.race_offsets[:-1], 2]
+        start = 0 if from_ is None else np.searchsorted(race_dates, int(pd.Timestamp(from_).strftime("%Y%m%d")))
+        stop = (
+            self.n_races if to_ is None
+            else np.searchsorted(race_dates, int(pd.Timestamp(to_).strftime("%Y%m%d")), side="right")
+        )
+        return int(start), int(stop)
+
+    def _read(self, row_slices):
+        if len(row_slices) == 1:
+            rows = row_slices[0]
+        else:
+            rows = np.concatenate([np.arange(s.start, s.stop) for s in row_slices])
+        return np.array(self.features[rows]), np.array(self.labels[rows]), np.array(self.keys[rows])
+
+    def iter_batches(self, batch_size=4096, shuffle=False, seed=None, from_=None, to_=None):
+        """
+        _関数の意味と使い方_
+        レース単位でまとめたバッチを返すジェネレータです。1つのレースの馬が2つのバッチに分かれることはありません。
+        行数がbatch_size以上になるまでレースを足していきます（batch_sizeより大きいレースは1つで1バッチ）。
+        shuffleがFalseなら日付順の連続した行を読み、Trueならレースの順番をシャッフルします。
+
+        Args:
+            batch_size (int, optional): 1バッチの目安の行数
+            shuffle (bool, optional): レースの順番をシャッフルするかどうか
+            seed (int, optional): シャッフルの乱数のシード
+            from_ (str, optional): この日付以降のレースだけを使う
+            to_ (str, optional): この日付以前のレースだけを使う
+
+        Yields:
+            Batch: features, labels, keys と、バッチ内の各レースの先頭行（最後に行数）race_offsets
+        """
+        start, stop = self.race_range(from_, to_)
+        race_order = np.arange(start, stop)
+        if shuffle:
+            np.random.default_rng(seed).shuffle(race_order)
+        offsets = self.race_offsets
+        batch_races = []
+        n_rows = 0
+        for race in race_order:
+            batch_races.append(race)
+            n_rows += offsets[race + 1] - offsets[race]
+            if n_rows >= batch_size:
+                yield self._make_batch(batch_races)
+                batch_races = []
+                n_rows = 0
+        if batch_races:
+            yield self._make_batch(batch_races)
+
+    def _make_batch(self, races):
+        races = np.asarray(races)
+        starts = self.race_offsets[races]
+        stops = self.race_offsets[races + 1]
+        # 日付順に続いているレースは1つのスライスにまとめて読む
+        row_slices = []
+        for race_start, race_stop in zip(starts, stops):
+            if row_slices and row_slices[-1].stop == race_start:
+                row_slices[-1] = slice(row_slices[-1].start, race_stop)
+            else:
+                row_slices.append(slice(race_start, race_stop))
+        features, labels, keys = self._read(row_slices)
+        race_offsets = np.r_[0, np.cumsum(stops - starts)]
+        return Batch(features, labels, keys, race_offsets)
@@ -1,15 +1,24 @@
 import json
+import re
+import shutil
 from pathlib import Path
 
 import pandas as pd
 
+from id_dict import ID_COLUMN_DTYPES, open_id_dictionary
+from metrics import metrics, stage
+
 DATA_DIR = Path("../data")
 RAW_CSV_DIR = DATA_DIR / "raw_csv"
 DF_CSV_DIR = DATA_DIR / "df_csv"
+DF_PARQUET_DIR = DATA_DIR / "df_parquet"
 MAPPING_DIR = DATA_DIR / "mapping"
 
 DF_CSV_DIR.mkdir(parents=True, exist_ok=True)
 
+# 変換の実装。pandasが基準で、polarsは同じ変換をLazyFrameで行います（df_polars.py）
+ENGINES = ("pandas", "polars")
+
 
 # カテゴリ変数を数値に変換するためのマッピング
 with open(MAPPING_DIR / "sex.json", "rb") as f:
@@ -27,12 +36,172 @@ with open(MAPPING_DIR / "race_class.json", "rb") as f:
 with open(MAPPING_DIR / "margin.json", "rb") as f:
     margin_mapping = json.load(f)
 
+# レース名からレース階級を取り出す正規表現は、呼び出しのたびに作らずここで1回だけコンパイルする
+RACE_CLASS_PATTERN = re.compile("({})".format("|".join(race_class_mapping)))
+# 馬体重（"480(+4)"）の体重と増減
+WEIGHT_PATTERN = re.compile(r"(\d+)\((.+)\)")
+DIGITS_PATTERN = re.compile(r"(\d+)")
+# 着順がこれらの馬は出走していないので、レースの頭数に数えない（中止・失格は出走した馬として数える）
+NOT_STARTED_RANKS = ["取消", "除外"]
+
+
+# 列の型。カテゴリ変数のコードはNaNがあり得るので nullable な Int8 にする
+# parquetはこの型で保存し、関数が返すDataFrameもfloat以外はこの型にする（CSVの値が変わらないようfloatはfloat64のまま）
+DF_SCHEMAS = {
+    "df_race": {
+        "race_id": "int64",
+        "horse_code": "int32",
+        "jockey_code": "int32",
+        "trainer_code": "int32",
+        "rank": "int8",
+        "umaban": "int8",
+        "wakuban": "int8",
+        "tansho_odds": "float32",
+        "popularity": "int8",
+        "impost": "float32",
+        "sex": "Int8",
+        "age": "int8",
+        "weight": "int16",
+        "weight_diff": "int16",
+    },
+    "df_horse": {
+        "horse_code": "int32",
+        "date": "datetime64[ns]",
+        "rank": "int8",
+        "prize": "float32",
+        "rank_diff": "float32",
+        "weather": "Int8",
+        "race_type": "Int8",
+        "course_len": "int16",
+        "ground_state": "Int8",
+        "race_class": "Int8",
+        "n_horses": "Int8",
+    },
+    "df_race_info": {
+        "race_id": "int64",
+        "date": "datetime64[ns]",
+        "race_type": "Int8",
+        "around": "Int8",
+        "course_len": "Int16",
+        "weather": "Int8",
+        "ground_state": "Int8",
+        "race_class": "Int8",
+        "place": "int8",
+        "n_horses": "Int8",
+    },
+    "df_race_return": {
+        "race_id": "int64",
+        "bet_type": "category",
+        "return": "int32",
+    },
+}
 
-def df_race_csv():
+
+def save_parquet(df, name):
     """
-    未加工のレース結果テーブルをinput_dirから読み込んで加工し、保存する関数
+    _関数の意味と使い方_
+    DataFrameをDF_SCHEMASの型に変換し、年ごとにパーティション分けしたparquetとして
+    DF_PARQUET_DIR / name に保存する関数です。
+    年はdate列があればその年、なければrace_idの先頭4桁を使います。
+    parquetの読み書きにはpyarrowが必要です。
+    """
+    df = df.astype(DF_SCHEMAS[name])
+    if "date" in df.columns:
+        year = df["date"].dt.year
+    else:
+        year = df["race_id"] // 10**8
+    output_dir = DF_PARQUET_DIR / name
+    # 前回のパーティションが残らないように作り直す
+    shutil.rmtree(output_dir, ignore_errors=True)
+    df.assign(year=year).to_parquet(output_dir, partition_cols=["year"], index=False)
+
+
+def read_parquet(name, columns=None, from_=None, to_=None):
+    """
+    _関数の意味と使い方_
+    save_parquetで保存したテーブルを読み込む関数です。
+    columnsを指定するとその列だけを読み込みます。
+    from_, to_（"2024-01-01"など）を指定すると、その年のパーティションだけを読み、
+    date列があるテーブルはさらに日付で絞り込みます。
+    date列がないテーブル（df_race, df_race_return）は年単位での絞り込みになります。
+    """
+    filters = []
+    if from_ is not None:
+        filters.append(("year", ">=", pd.Timestamp(from_).year))
+        if "date" in DF_SCHEMAS[name]:
+            filters.append(("date", ">=", pd.Timestamp(from_)))
+    if to_ is not None:
+        filters.append(("year", "<=", pd.Timestamp(to_).year))
+        if "date" in DF_SCHEMAS[name]:
+            filters.append(("date", "<=", pd.Timestamp(to_)))
+    df = pd.read_parquet(
+        DF_PARQUET_DIR / name, columns=columns, filters=filters or None
+    )
+    if columns is None:
+        df = df.drop(columns="year")
+    return df
+
+
+def _map_unique(series, func):
     """
-    df = pd.read_csv(RAW_CSV_DIR/ "raw_race.csv", sep="\t")
+    seriesの値の種類ごとに1回だけfuncを適用し、結果を各行に戻す。
+    性齢・馬体重・距離・レース名のような列は値の種類が行数よりずっと少ないので、
+    文字列処理が行数ではなく種類の数で済みます。NaNの行の結果はNaNです。
+
+    Args:
+        series (pd.Series): 元の列
+        func (callable): 重複のない値のSeriesを受け取り、同じ長さのSeriesかDataFrameを返す関数
+    """
+    codes, uniques = pd.factorize(series)
+    mapped = func(pd.Series(uniques, dtype=object)).reset_index(drop=True).reindex(codes)
+    mapped.index = series.index
+    return mapped
+
+
+def _race_class(*name_columns):
+    """
+    レース名などの列から、RACE_CLASS_PATTERNに最初に当たった階級をrace_class_mappingのコードにする。
+    列を複数渡すと、前の列で取れなかった行を後ろの列で埋めます。
+    """
+    race_class = None
+    for column in name_columns:
+        extracted = _map_unique(column, lambda s: s.str.extract(RACE_CLASS_PATTERN)[0])
+        race_class = extracted if race_class is None else race_class.fillna(extracted)
+    return race_class.map(race_class_mapping)
+
+
+def _compact(df, name):
+    """DF_SCHEMASの型のうち、float以外の型に変換してメモリを減らす"""
+    return df.astype(
+        {column: dtype for column, dtype in DF_SCHEMAS[name].items() if not dtype.startswith("float")}
+    )
+
+
+def _transform(name, engine):
+    """
+    nameのテーブルを、engineで指定した実装で作る。
+    pandasの実装（このファイルの_df_race など）が基準で、polarsの実装（df_polars.py）は同じ結果を返します。
+    polarsはengine="polars"のときだけ必要です。
+    """
+    if engine == "pandas":
+        return PANDAS_TRANSFORMS[name]()
+    if engine == "polars":
+        import df_polars
+
+        return df_polars.POLARS_TRANSFORMS[name]()
+    raise ValueError(f"engine must be one of {ENGINES}: {engine!r}")
+
+
+def _save(df, name, parquet):
+    df.to_csv(DF_CSV_DIR / f"{name}.csv", sep="\t", index=False)
+    metrics.set_gauge("rows", len(df), file=f"{name}.csv")
+    if parquet:
+        save_parquet(df, name)
+    return df
+
+
+def _df_race():
+    df = pd.read_csv(RAW_CSV_DIR/ "raw_race.csv", sep="\t", dtype=ID_COLUMN_DTYPES)
     df["rank"] = pd.to_numeric(df["着順"], errors="coerce")
     df.dropna(subset=["rank"], inplace=True)
     df["rank"] = df["rank"].astype(int)
@@ -41,49 +210,56 @@ def df_race_csv():
     df["popularity"] = df["人気"].astype(int)
     df["impost"] = df["斤量"].astype(float)
     df["wakuban"] = df["枠番"].astype(int)
-    df["sex"] = df["性齢"].str[0].map(sex_mapping)
-    df["age"] = df["性齢"].str[1:].astype(int)
-    df["weight"] = df["馬体重"].str.extract(r"(\d+)").astype(int)
-    df["weight_diff"] = df["馬体重"].str.extract(r"\((.+)\)").astype(int)
-    df["horse_name"] = df["馬名"]
-    df["jockey_name"] = df["騎手"]
-    df["trainer_name"] = df["調教師"]
+    df["sex"] = _map_unique(df["性齢"], lambda s: s.str[0].map(sex_mapping))
+    df["age"] = _map_unique(df["性齢"], lambda s: s.str[1:]).astype(int)
+    weight = _map_unique(df["馬体重"], lambda s: s.str.extract(WEIGHT_PATTERN))
+    df["weight"] = weight[0].astype(int)
+    df["weight_diff"] = weight[1].astype(int)
+    # IDはID辞書のint32のコードにし、名前はID辞書の方に持たせる
+    df["horse_code"] = open_id_dictionary("horse").encode(df["horse_id"], df["馬名"])
+    df["jockey_code"] = open_id_dictionary("jockey").encode(df["jockey_id"], df["騎手"])
+    df["trainer_code"] = open_id_dictionary("trainer").encode(df["trainer_id"], df["調教師"])
     # データが着順に並んでいることによるリーク防止のため、各レースを馬番順にソートする
     df = df.sort_values(["race_id", "umaban"])
     # 使用する列を選択
     df = df[
         [
-            "race_id","horse_id","horse_name","jockey_id","jockey_name","trainer_id","trainer_name","rank","umaban","wakuban","tansho_odds","popularity","impost","sex","age","weight","weight_diff"
+            "race_id","horse_code","jockey_code","trainer_code","rank","umaban","wakuban","tansho_odds","popularity","impost","sex","age","weight","weight_diff"
         ]
     ]
-    df.to_csv(DF_CSV_DIR / "df_race.csv", sep="\t", index=False)
-    return df
+    return _compact(df, "df_race")
 
 
-def df_horse_csv():
+@stage("df_race_csv")
+def df_race_csv(parquet=False, engine="pandas"):
     """
-    未加工の馬の過去成績テーブルを読み込み、加工して保存する関数
+    未加工のレース結果テーブルをinput_dirから読み込んで加工し、保存する関数
+    parquetがTrueなら、型を付けて年ごとに分けたparquetもDF_PARQUET_DIRに保存する
+    horse_id, jockey_id, trainer_idはID辞書（id_dict）のコードに変換し、名前はID辞書に保存する
+    engineが"polars"なら、polarsのLazyFrameで変換する（結果はpandasと同じ）
     """
-    df = pd.read_csv(RAW_CSV_DIR/ "raw_horse.csv", sep="\t")
+    return _save(_transform("df_race", engine), "df_race", parquet)
+
+
+def _df_horse():
+    df = pd.read_csv(RAW_CSV_DIR/ "raw_horse.csv", sep="\t", dtype=ID_COLUMN_DTYPES)
     df["rank"] = pd.to_numeric(df["着順"], errors="coerce")
     df.dropna(subset=["rank"], inplace=True)
     df["date"] = pd.to_datetime(df["日付"])
-    df["weather"] = df["天気"].map(weather_mapping)
-    df["race_type"] = df["距離"].str[0].map(race_type_mapping)
-    df["course_len"] = df["距離"].str.extract(r"(\d+)").astype(int)
-    df["ground_state"] = df["馬場"].map(ground_state_mapping)
+    df["weather"] = _map_unique(df["天気"], lambda s: s.map(weather_mapping))
+    df["race_type"] = _map_unique(df["距離"], lambda s: s.str[0].map(race_type_mapping))
+    df["course_len"] = _map_unique(df["距離"], lambda s: s.str.extract(DIGITS_PATTERN)[0]).astype(int)
+    df["ground_state"] = _map_unique(df["馬場"], lambda s: s.map(ground_state_mapping))
     # 着差は1着以外は「1着との差」を表すが、1着のみ「2着との差」のデータが入っている
-    df["rank_diff"] = df["着差"].map(lambda x: 0 if x < 0 else x)
+    df["rank_diff"] = df["着差"].mask(df["着差"] < 0, 0)
     df["prize"] = df["賞金"].fillna(0)
-    regex_race_class = "|".join(race_class_mapping)
-    df["race_class"] = (
-        df["レース名"].str.extract(rf"({regex_race_class})")[0].map(race_class_mapping)
-    )
+    df["race_class"] = _race_class(df["レース名"])
     df.rename(columns={"頭数": "n_horses"}, inplace=True)
+    df["horse_code"] = open_id_dictionary("horse").encode(df["horse_id"])
     # 使用する列を選択
     df = df[
         [
-            "horse_id",
+            "horse_code",
             "date",
             "rank",
             "prize",
@@ -96,39 +272,37 @@ def df_horse_csv():
             "n_horses",
         ]
     ]
-    df.to_csv(DF_CSV_DIR/ "df_horse.csv", sep="\t", index=False)
-    return df
+    return _compact(df, "df_horse")
 
 
-
-def df_race_info_csv():
+@stage("df_horse_csv")
+def df_horse_csv(parquet=False, engine="pandas"):
     """
-    未加工のレース情報テーブルを読み込み、加工して保存する関数
+    未加工の馬の過去成績テーブルを読み込み、加工して保存する関数
+    parquetがTrueなら、型を付けて年ごとに分けたparquetもDF_PARQUET_DIRに保存する
+    horse_idはID辞書（id_dict）のコードに変換する
+    engineが"polars"なら、polarsのLazyFrameで変換する（結果はpandasと同じ）
     """
+    return _save(_transform("df_horse", engine), "df_horse", parquet)
+
+
+def _df_race_info():
     df = pd.read_csv(RAW_CSV_DIR / "raw_race_info.csv", sep="\t")
-    # evalで文字列型の列をリスト型に変換し、一時的な列を作成
-    df["tmp"] = df["info1"].map(lambda x: eval(x)[0])
-    # ダートor芝or障害
-    df["race_type"] = df["tmp"].str[0].map(race_type_mapping)
-    # 右or左or直線
-    df["around"] = df["tmp"].str[1].map(around_mapping)
-    df["course_len"] = df["tmp"].str.extract(r"(\d+)")
-    df["weather"] = df["info1"].str.extract(r"天候:(\w+)")[0].map(weather_mapping)
-    df["ground_state"] = (
-        df["info1"].str.extract(r"(芝|ダート|障害):(\w+)")[1].map(ground_state_mapping)
-    )
-    df["date"] = pd.to_datetime(
-        df["info2"].map(lambda x: eval(x)[0]), format="%Y年%m月%d日"
-    )
-    regex_race_class = "|".join(race_class_mapping)
-    df["race_class"] = (
-        df["title"]
-        .str.extract(rf"({regex_race_class})")
-        # タイトルからレース階級情報が取れない場合はinfo2から取得
-        .fillna(df["info2"].str.extract(rf"({regex_race_class})"))[0]
-        .map(race_class_mapping)
-    )
-    df["place"] = df["race_id"].astype(str).str[4:6].astype(int)
+    # raw_race_info.csvは列ごとに分けて保存してあるので、列単位で変換する
+    df["race_type"] = _map_unique(df["surface"], lambda s: s.map(race_type_mapping))
+    df["around"] = _map_unique(df["direction"], lambda s: s.map(around_mapping))
+    df["course_len"] = df["distance"].astype("Int64")
+    df["weather"] = _map_unique(df["weather"], lambda s: s.map(weather_mapping))
+    df["ground_state"] = _map_unique(df["going"], lambda s: s.map(ground_state_mapping))
+    df["date"] = pd.to_datetime(df["date"], format="%Y-%m-%d")
+    # タイトルからレース階級情報が取れない場合はclass_textから取得
+    df["race_class"] = _race_class(df["title"], df["class_text"])
+    # race_idは 年4桁・場所2桁・回2桁・日2桁・レース番号2桁
+    df["place"] = df["race_id"] // 10**6 % 100
+    # 頭数はraw_race.csvから数える。df_raceは着順のない馬（取消・中止・除外）を除いているので、そこからは数えられない
+    entries = pd.read_csv(RAW_CSV_DIR / "raw_race.csv", sep="\t", usecols=["race_id", "着順"])
+    started = entries[~entries["着順"].isin(NOT_STARTED_RANKS)]
+    df = df.merge(started.groupby("race_id").size().rename("n_horses").reset_index(), on="race_id", how="left")
     # 使用する列を選択
     df = df[
         [
@@ -141,29 +315,56 @@ def df_race_info_csv():
             "ground_state",
             "race_class",
             "place",
+            "n_horses",
         ]
     ]
-    df.to_csv(DF_CSV_DIR/ "df_race_info.csv", sep="\t", index=False)
-    return df
+    return _compact(df, "df_race_info")
 
 
-def df_race_return_csv():
+@stage("df_race_info_csv")
+def df_race_info_csv(parquet=False, engine="pandas"):
     """
-    未加工の払い戻しテーブルを読み込み、加工して保存する関数
+    未加工のレース情報テーブルを読み込み、加工して保存する関数
+    n_horsesはraw_race.csvから数えた出走頭数（取消・除外の馬を除く）
+    parquetがTrueなら、型を付けて年ごとに分けたparquetもDF_PARQUET_DIRに保存する
+    engineが"polars"なら、polarsのLazyFrameで変換する（結果はpandasと同じ）
     """
+    return _save(_transform("df_race_info", engine), "df_race_info", parquet)
+
+
+def _df_race_return():
     df = pd.read_csv(RAW_CSV_DIR / "raw_race_return.csv", sep="\t")
     df = (
-        df[["0", "1", "2"]]
+        df.set_index("race_id")[["0", "1", "2"]]
         .replace(" (-|→) ", "-", regex=True)
         .replace(",", "", regex=True)
         .apply(lambda x: x.str.split())
         .explode(["1", "2"])
         .explode("0")
-        .apply(lambda x: x.str.split("-"))
-        .explode(["0", "2"])
+        .reset_index()
     )
-    df.columns = ["bet_type", "win_umaban", "return"]
-    df = df.query("bet_type != '枠連'").reset_index()
+    # 馬番の組み合わせは"7-12"のような"-"区切りの文字列のまま残し、券種と払い戻しだけを分ける
+    df = df.assign(**{column: df[column].str.split("-") for column in ["0", "2"]}).explode(["0", "2"])
+    df.columns = ["race_id", "bet_type", "win_umaban", "return"]
+    df = df.query("bet_type != '枠連'").reset_index(drop=True)
     df["return"] = df["return"].astype(int)
-    df.to_csv(DF_CSV_DIR/ "df_race_return.csv", sep="\t", index=False)
-    return df
\ No newline at end of file
+    return _compact(df, "df_race_return")
+
+
+@stage("df_race_return_csv")
+def df_race_return_csv(parquet=False, engine="pandas"):
+    """
+    未加工の払い戻しテーブルを読み込み、加工して保存する関数
+    parquetがTrueなら、型を付けて年ごとに分けたparquetもDF_PARQUET_DIRに保存する
+    engineが"polars"なら、polarsのLazyFrameで変換する（結果はpandasと同じ）
+    """
+    return _save(_transform("df_race_return", engine), "df_race_return", parquet)
+
+
+# テーブル名 -> pandasでの変換。df_polars.POLARS_TRANSFORMSと同じテーブルを返します
+PANDAS_TRANSFORMS = {
+    "df_race": _df_race,
+    "df_horse": _df_horse,
+    "df_race_info": _df_race_info,
+    "df_race_return": _df_race_return,
+}
\ No newline at end of file
@@ -0,0 +1,261 @@
+import argparse
+import sys
+import time
+
+import polars as pl
+
+from df import (
+    DIGITS_PATTERN,
+    NOT_STARTED_RANKS,
+    PANDAS_TRANSFORMS,
+    RACE_CLASS_PATTERN,
+    RAW_CSV_DIR,
+    WEIGHT_PATTERN,
+    _compact,
+    around_mapping,
+    ground_state_mapping,
+    race_class_mapping,
+    race_type_mapping,
+    sex_mapping,
+    weather_mapping,
+)
+from id_dict import open_id_dictionary
+
+# pandas.read_csvが欠損値として読む文字列。pandasと同じ行をNaNにするために合わせます
+NA_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
+
+def _scan_raw_csv(file_name):
+    """
+    raw_csvを遅延評価で読む。列はすべて文字列で読み、使う列だけを変換します。
+    型の推測をしないので、pandasのように列全体を見て型を決め直すことがありません。
+    """
+    return pl.scan_csv(
+        RAW_CSV_DIR / file_name, separator="\t", infer_schema=False, null_values=NA_VALUES
+    )
+
+
+def _collect(lf):
+    """クエリを、ストリーミング実行（全コアを使い、入力をまとめて読み込まない）で実行する"""
+    return lf.collect(engine="streaming")
+
+
+def _number(column, dtype=pl.Float64):
+    """pd.to_numeric(errors="coerce")と同じく、数値にできない値はnullにする"""
+    return pl.col(column).str.strip_chars().cast(pl.Float64, strict=False).cast(dtype)
+
+
+def _map(expr, mapping):
+    """Series.map(dict)と同じく、マッピングにない値はnullにする"""
+    return expr.replace_strict(mapping, default=None, return_dtype=pl.Int64)
+
+
+def _race_class(*name_columns):
+    """df._race_classと同じく、前の列でレース階級が取れなかった行を後ろの列で埋める"""
+    extracted = [pl.col(column).str.extract(RACE_CLASS_PATTERN.pattern, 1) for column in name_columns]
+    return _map(pl.coalesce(extracted), race_class_mapping)
+
+
+def _to_pandas(df, name):
+    """pandasの実装と同じ型のDataFrameにする"""
+    return _compact(df.to_pandas(), name)
+
+
+def df_race():
+    """df._df_raceと同じ変換。ID辞書へのコードの追加は、pandasと同じ行の順番（着順に並んだまま）で行います"""
+    weight = pl.col("馬体重").str.extract_groups(WEIGHT_PATTERN.pattern)
+    df = _collect(
+        _scan_raw_csv("raw_race.csv")
+        .with_columns(rank=_number("着順"))
+        .filter(pl.col("rank").is_not_null())
+        .select(
+            pl.col("race_id").cast(pl.Int64),
+            pl.col("rank").cast(pl.Int64),
+            pl.col("馬番").cast(pl.Int64).alias("umaban"),
+            pl.col("単勝").cast(pl.Float64).alias("tansho_odds"),
+            pl.col("人気").cast(pl.Int64).alias("popularity"),
+            pl.col("斤量").cast(pl.Float64).alias("impost"),
+            pl.col("枠番").cast(pl.Int64).alias("wakuban"),
+            _map(pl.col("性齢").str.slice(0, 1), sex_mapping).alias("sex"),
+            pl.col("性齢").str.slice(1).cast(pl.Int64).alias("age"),
+            weight.struct.field("1").cast(pl.Int64).alias("weight"),
+            weight.struct.field("2").cast(pl.Int64).alias("weight_diff"),
+            "horse_id",
+            "jockey_id",
+            "trainer_id",
+            "馬名", "騎手", "調教師",
+        )
+    )
+    df = df.with_columns(
+        horse_code=open_id_dictionary("horse").encode(df["horse_id"].to_numpy(), df["馬名"].to_numpy()),
+        jockey_code=open_id_dictionary("jockey").encode(df["jockey_id"].to_numpy(), df["騎手"].to_numpy()),
+        trainer_code=open_id_dictionary("trainer").encode(df["trainer_id"].to_numpy(), df["調教師"].to_numpy()),
+    )
+    df = df.sort(["race_id", "umaban"], maintain_order=True).select(
+        "race_id", "horse_code", "jockey_code", "trainer_code", "rank", "umaban", "wakuban",
+        "tansho_odds", "popularity", "impost", "sex", "age", "weight", "weight_diff",
+    )
+    return _to_pandas(df, "df_race")
+
+
+def df_horse():
+    """df._df_horseと同じ変換"""
+    df = _collect(
+        _scan_raw_csv("raw_horse.csv")
+        .with_columns(rank=_number("着順"))
+        .filter(pl.col("rank").is_not_null())
+        .select(
+            "horse_id",
+            pl.col("日付").str.to_datetime("%Y/%m/%d", time_unit="ns").alias("date"),
+            "rank",
+            # 着差は1着以外は「1着との差」を表すが、1着のみ「2着との差」のデータが入っている
+            pl.col("着差").cast(pl.Float64).clip(lower_bound=0).alias("rank_diff"),
+            pl.col("賞金").cast(pl.Float64).fill_null(0).alias("prize"),
+            _map(pl.col("天気"), weather_mapping).alias("weather"),
+            _map(pl.col("距離").str.slice(0, 1), race_type_mapping).alias("race_type"),
+            pl.col("距離").str.extract(DIGITS_PATTERN.pattern, 1).cast(pl.Int64).alias("course_len"),
+            _map(pl.col("馬場"), ground_state_mapping).alias("ground_state"),
+            _race_class("レース名").alias("race_class"),
+            pl.col("頭数").cast(pl.Int64).alias("n_horses"),
+        )
+    )
+    df = df.with_columns(horse_code=open_id_dictionary("horse").encode(df["horse_id"].to_numpy())).select(
+        "horse_code", "date", "rank", "prize", "rank_diff", "weather", "race_type",
+        "course_len", "ground_state", "race_class", "n_horses",
+    )
+    return _to_pandas(df, "df_horse")
+
+
+def df_race_info():
+    """df._df_race_infoと同じ変換。n_horsesはraw_race.csvの出走した馬の数です"""
+    df = _collect(
+        _scan_raw_csv("raw_race_info.csv").select(
+            pl.col("race_id").cast(pl.Int64),
+            pl.col("date").str.to_datetime("%Y-%m-%d", time_unit="ns"),
+            _map(pl.col("surface"), race_type_mapping).alias("race_type"),
+            _map(pl.col("direction"), around_mapping).alias("around"),
+            pl.col("distance").cast(pl.Int64).alias("course_len"),
+            _map(pl.col("weather"), weather_mapping).alias("weather"),
+            _map(pl.col("going"), ground_state_mapping).alias("ground_state"),
+            # タイトルからレース階級情報が取れない場合はclass_textから取得
+            _race_class("title", "class_text").alias("race_class"),
+            # race_idは 年4桁・場所2桁・回2桁・日2桁・レース番号2桁
+            (pl.col("race_id").cast(pl.Int64) // 10**6 % 100).alias("place"),
+        )
+        .join(
+            _scan_raw_csv("raw_race.csv")
+            .filter(~pl.col("着順").fill_null("").is_in(NOT_STARTED_RANKS))
+            .group_by(pl.col("race_id").cast(pl.Int64))
+            .agg(pl.len().alias("n_horses")),
+            on="race_id",
+            how="left",
+            maintain_order="left",
+        )
+    )
+    return _to_pandas(df, "df_race_info")
+
+
+def df_race_return():
+    """
+    df._df_race_returnと同じ変換。
+    pandasでは列ごとにsplitとexplodeを繰り返して途中のコピーを何度も作りますが、
+    ここでは1つのクエリにまとめて、ストリーミングで実行します。
+    win_umabanはpandasと同じく"7-12"のような"-"区切りの文字列です。
+    """
+
+    def clean(column):
+        return pl.col(column).str.replace_all(" (-|→) ", "-").str.replace_all(",", "", literal=True)
+
+    df = _collect(
+        _scan_raw_csv("raw_race_return.csv")
+        .select(
+            pl.col("race_id").cast(pl.Int64),
+            # str.split()と同じく、空白で区切って空の要素は除く
+            *[clean(column).str.extract_all(r"\S+").alias(column) for column in ["0", "1", "2"]],
+        )
+        .explode(["1", "2"])
+        .explode("0")
+        .select(
+            "race_id",
+            pl.col("0").str.split("-").alias("bet_type"),
+            pl.col("1").alias("win_umaban"),
+            pl.col("2").str.split("-").alias("return"),
+        )
+        .explode(["bet_type", "return"])
+        .filter(pl.col("bet_type") != "枠連")
+        .with_columns(pl.col("return").cast(pl.Int64))
+    )
+    return _to_pandas(df, "df_race_return")
+
+
+# テーブル名 -> polarsでの変換。df.PANDAS_TRANSFORMSと同じテーブルを返します
+POLARS_TRANSFORMS = {
+    "df_race": df_race,
+    "df_horse": df_horse,
+    "df_race_info": df_race_info,
+    "df_race_return": df_race_return,
+}
+
+
+def compare_engines(names=None):
+    """
+    _関数の意味と使い方_
+    今のraw_csvから、pandasとpolarsの両方の実装でテーブルを作り、
+    CSVに書き出したときの中身が1文字も違わないことを確かめる関数です。
+    df_csvのファイルには書き込みません（ID辞書には、dfのステージと同じく新しいIDが追加されます）。
+
+    Args:
+        names (list, optional): 比べるテーブル名のリスト。デフォルトはすべて
+
+    Returns:
+        dict: テーブル名 -> 結果（equal, rows, pandas・polarsの秒数, 最初に違った行）
+    """
+    results = {}
+    for name in names or list(POLARS_TRANSFORMS):
+        texts = {}
+        seconds = {}
+        for engine, transform in [("pandas", PANDAS_TRANSFORMS[name]), ("polars", POLARS_TRANSFORMS[name])]:
+            start = time.perf_counter()
+            df = transform()
+            seconds[engine] = round(time.perf_counter() - start, 4)
+            texts[engine] = df.to_csv(sep="\t", index=False).splitlines()
+        first_diff = next(
+            (
+                {"line": i, "pandas": pandas_line, "polars": polars_line}
+                for i, (pandas_line, polars_line) in enumerate(zip(texts["pandas"], texts["polars"]))
+                if pandas_line != polars_line
+            ),
+            None,
+        )
+        if first_diff is None and len(texts["pandas"]) != len(texts["polars"]):
+            first_diff = {"line": min(len(texts["pandas"]), len(texts["polars"]))}
+        results[name] = {
+            "equal": first_diff is None,
+            "rows": len(texts["pandas"]) - 1,
+            "seconds": seconds,
+            "first_diff": first_diff,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dfの変換について、pandasとpolarsの結果が同じか確かめる")
+    parser.add_argument("--tables", nargs="+", choices=list(POLARS_TRANSFORMS))
+    args = parser.parse_args()
+    results = compare_engines(args.tables)
+    for name, result in results.items():
+        print(
+            f"{name}: {'OK' if result['equal'] else 'DIFF'} rows={result['rows']} "
+            f"pandas={result['seconds']['pandas']:.2f}s polars={result['seconds']['polars']:.2f}s"
+        )
+        if result["first_diff"]:
+            print(f"  {result['first_diff']}")
+    if not all(result["equal"] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import re
+
+import lxml.html
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+
+# pd.read_htmlと同じ空白の詰め方
+_RE_WHITESPACE = re.compile(r"[\r\n]+|\s{2,}")
+_RE_HORSE_ID = re.compile(r"^/horse/(\d+)")
+_RE_JOCKEY_ID = re.compile(r"^/jockey/result/recent/(\d+)")
+_RE_TRAINER_ID = re.compile(r"^/trainer/result/recent/(\d+)")
+
+# raw_race.csv, raw_horse.csvの列名
+RACE_RESULT_COLUMNS = [
+    "着順", "枠番", "馬番", "馬名", "性齢", "斤量", "騎手", "タイム", "着差", "単勝", "人気", "馬体重", "調教師", "horse_id", "jockey_id", "trainer_id"
+]
+HORSE_RESULT_COLUMNS = ["日付", "開催", "天気", "R", "レース名", "映像", "頭数",
+    "枠番", "馬番", "オッズ", "人気", "着順", "騎手", "斤量", "距離",
+    "馬場", "馬場指数", "タイム", "着差", "タイム指数", "通過",
+    "ペース", "上り", "馬体重", "厩舎コメント", "備考", "勝ち馬", "賞金"
+]
+
+
+def parse_html(html):
+    """netkeibaのページ（EUC-JP）のbytesをlxmlの木にする"""
+    return lxml.html.document_fromstring(html.decode("euc-jp", errors="replace"))
+
+
+def _find_by_class(root, tag, class_name):
+    """BeautifulSoupのfind(tag, class_=class_name)と同じく、最初に見つかった要素を返す"""
+    found = root.xpath(
+        f'.//{tag}[contains(concat(" ", normalize-space(@class), " "), " {class_name} ")]'
+    )
+    return found[0] if found else None
+
+
+def _drop_hidden(table):
+    """pd.read_htmlと同じく、display:noneの要素を取り除き、<br>を改行にする"""
+    for elem in table.xpath(".//style"):
+        elem.drop_tree()
+    for elem in table.xpath(".//*[@style]"):
+        if "display:none" in elem.attrib.get("style", "").replace(" ", ""):
+            elem.drop_tree()
+    for br in table.xpath(".//br"):
+        br.tail = "\n" + (br.tail or "")
+
+
+def _table_rows(table):
+    """
+    テーブルの<tr>を、pd.read_htmlと同じ順番（thead, tbody, 直下のtr）で
+    (ヘッダー行のリスト, 本体の行のリスト) に分ける。
+    """
+    header_rows = table.xpath(".//thead//tr")
+    body_rows = table.xpath(".//tbody//tr") + table.xpath("./tr")
+    if not header_rows:
+        while body_rows and all(td.tag == "th" for td in body_rows[0].xpath("./td|./th")):
+            header_rows.append(body_rows.pop(0))
+    return header_rows, body_rows
+
+
+def _row_texts(tr):
+    """1行分のセルの文字列。colspanのセルは列数分繰り返す"""
+    texts = []
+    for td in tr.xpath("./td|./th"):
+        text = _RE_WHITESPACE.sub(" ", td.text_content().strip())
+        texts.extend([text] * int(td.attrib.get("colspan") or 1))
+    return texts
+
+
+def _to_frame(rows, header=None):
+    """
+    セルの文字列の行から、pd.read_htmlと同じ型推論でDataFrameを作る。
+    HTMLのパースはせず、文字列から直接列を作ります。
+    """
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    with TextParser(rows, header=header, thousands=",") as parser:
+        return parser.read()
+
+
+def _first_id(tr, regex):
+    for href in tr.xpath(".//a/@href"):
+        found = regex.match(href)
+        if found:
+            return found.group(1)
+    return None
+
+
+def read_race_result(root, race_id):
+    """
+    raceページの木からレース結果テーブル（race_table_01）を取り出す関数。
+    horse_id, jockey_id, trainer_idは、同じ行のリンクから取り出します。
+    テーブルが見つからない場合はNoneを返します。
+    """
+    table = _find_by_class(root, "table", "race_table_01")
+    if table is None:
+        return None
+    _drop_hidden(table)
+    header_rows, body_rows = _table_rows(table)
+    if not body_rows:
+        return None
+    rows = [_row_texts(tr) for tr in header_rows + body_rows]
+    df = _to_frame(rows, header=0 if header_rows else None)
+    df["horse_id"] = [_first_id(tr, _RE_HORSE_ID) for tr in body_rows]
+    df["jockey_id"] = [_first_id(tr, _RE_JOCKEY_ID) for tr in body_rows]
+    df["trainer_id"] = [_first_id(tr, _RE_TRAINER_ID) for tr in body_rows]
+    df.index = pd.Index([race_id] * len(df))
+    return df
+
+
+def race_info_fields(title, info1, info2):
+    """
+    レース情報のトークンのリストから、raw_race_info.csvの1行分の辞書を作る関数。
+    info1はコース・天候・馬場のトークン（例: ['芝右2000m', '天候:晴', '芝:良', '発走:12:20']）、
+    info2は日付・開催・クラスのトークン（例: ['2024年11月10日', '6回京都4日目', '2歳新馬', '混', '指', '馬齢']）です。
+    df.pyでevalや行ごとの処理をしなくて済むよう、必要な値をそれぞれの列に分けておきます。
+    """
+    course = info1[0] if info1 else ""
+    info1_text = " ".join(info1)
+    distance = re.search(r"(\d+)", course)
+    weather = re.search(r"天候:(\w+)", info1_text)
+    going = re.search(r"(芝|ダート|障害):(\w+)", info1_text)
+    date = re.match(r"(\d+)年(\d+)月(\d+)日", info2[0]) if info2 else None
+    return {
+        "title": title,
+        # ダートor芝or障害
+        "surface": course[:1],
+        # 右or左or直線
+        "direction": course[1:2],
+        "distance": distance.group(1) if distance else None,
+        "weather": weather.group(1) if weather else None,
+        "going": going.group(2) if going else None,
+        "date": "{}-{:0>2}-{:0>2}".format(*date.groups()) if date else None,
+        # 開催日以降のクラス・条件（例: "2歳新馬 混 指 馬齢"）
+        "class_text": " ".join(info2[2:]),
+    }
+
+
+def read_race_info(root, race_id):
+    """
+    raceページの木からレース情報（data_intro）を取り出す関数。
+    情報が見つからない場合はNoneを返します。
+    """
+    data_intro = _find_by_class(root, "div", "data_intro")
+    if data_intro is None:
+        return None
+    h1_list = data_intro.xpath(".//h1")
+    p_list = data_intro.xpath(".//p")
+    if not h1_list or len(p_list) < 2:
+        return None
+    info1 = re.findall(r"[\w:]+", p_list[0].text_content().replace(" ", ""))
+    info2 = re.findall(r"\w+", p_list[1].text_content())
+    df = pd.DataFrame([race_info_fields(h1_list[0].text_content(), info1, info2)])
+    df.index = [race_id] * len(df)
+    return df
+
+
+def read_race_return(root, race_id):
+    """
+    raceページの木から払い戻しテーブル（pay_block）を取り出す関数。
+    pay_blockの中のテーブルを縦に結合し、最初の列にrace_idを入れて返します。
+    テーブルが見つからない場合はNoneを返します。
+    """
+    pay_block = _find_by_class(root, "dl", "pay_block")
+    if pay_block is None:
+        return None
+    _drop_hidden(pay_block)
+    dfs = []
+    for table in pay_block.xpath(".//table"):
+        header_rows, body_rows = _table_rows(table)
+        rows = [_row_texts(tr) for tr in header_rows + body_rows]
+        if rows:
+            dfs.append(_to_frame(rows, header=0 if header_rows else None))
+    if not dfs:
+        return None
+    df = pd.concat(dfs)
+    # 最初の列にrace_idを挿入
+    df.insert(0, "race_id", race_id)
+    return df
+
+
+def parse_race_html(html, race_id):
+    """
+    raceページのhtmlを1回だけパースして、レース結果・レース情報・払い戻しを
+    まとめて返す関数。
+    取得できなかったものはNoneになります。
+
+    Returns:
+        tuple: (レース結果, レース情報, 払い戻し) のDataFrame
+    """
+    root = parse_html(html)
+    return (
+        read_race_result(root, race_id),
+        read_race_info(root, race_id),
+        read_race_return(root, race_id),
+    )
+
+
+def parse_horse_html(html, horse_id):
+    """
+    horseページのhtmlから過去成績テーブル（db_h_race_results）を取り出す関数。
+    テーブルが見つからない場合はNoneを返します。
+    """
+    table = _find_by_class(parse_html(html), "table", "db_h_race_results")
+    if table is None:
+        return None
+    _drop_hidden(table)
+    header_rows, body_rows = _table_rows(table)
+    if not body_rows:
+        return None
+    rows = [_row_texts(tr) for tr in header_rows + body_rows]
+    df = _to_frame(rows, header=0 if header_rows else None)
+    df.index = [horse_id] * len(df)
+    return df
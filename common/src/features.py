@@ -0,0 +1,226 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from metrics import metrics, stage
+
+DATA_DIR = Path("../data")
+DF_CSV_DIR = DATA_DIR / "df_csv"
+FEATURE_DIR = DATA_DIR / "features"
+HORSE_FORM_CACHE_FILE = "horse_form_cache.pickle"
+
+FEATURE_DIR.mkdir(parents=True, exist_ok=True)
+
+# 距離帯の区切り（SMILE区分: ~1300, ~1899, ~2100, ~2700, 2701~）
+DISTANCE_BINS = [0, 1300, 1899, 2100, 2700, np.inf]
+# 過去成績から集計する値と、特徴量の列名の接頭辞
+FORM_COLUMNS = {
+    "rank": "rank_mean",
+    "prize": "prize_mean",
+    "rank_diff": "rank_diff_mean",
+    "win": "win_rate",
+    "top3": "top3_rate",
+}
+# 同じ馬場・距離帯での成績として集計する値
+CONDITION_COLUMNS = {
+    "rank": "cond_rank_mean",
+    "win": "cond_win_rate",
+    "top3": "cond_top3_rate",
+}
+HISTORY_COLUMNS = ["horse_code", "date", "rank", "prize", "rank_diff", "race_type", "course_len"]
+
+
+def _distance_band(course_len):
+    return pd.cut(course_len, DISTANCE_BINS, labels=False).fillna(-1).astype("int8")
+
+
+def _prepare_history(df_horse):
+    history = df_horse[HISTORY_COLUMNS].dropna(subset=["date"])
+    history = history.sort_values(["horse_code", "date"], kind="stable")
+    history = history.reset_index(drop=True)
+    history["win"] = (history["rank"] == 1).astype("int8")
+    history["top3"] = (history["rank"] <= 3).astype("int8")
+    history["race_type"] = history["race_type"].fillna(-1).astype("int8")
+    history["dist_band"] = _distance_band(history["course_len"])
+    return history
+
+
+def _cumulative_means(history, keys, columns, n_list=()):
+    """
+    keysごとに日付順に並んだhistoryについて、各行までの（その行を含む）平均をまとめて計算する。
+    n_listの各Nについては、直近N走の平均も計算します。
+    NaNは平均から除きます。累積和の差を使うので、行ごとのループはしません。
+    """
+    group_keys = [history[key] for key in keys]
+    result = {}
+    for column, prefix in columns.items():
+        value = history[column]
+        cum_sum = value.fillna(0).groupby(group_keys).cumsum()
+        cum_count = value.notna().astype("int32").groupby(group_keys).cumsum()
+        result[f"{prefix}_all"] = cum_sum / cum_count.replace(0, np.nan)
+        for n in n_list:
+            prev_sum = cum_sum.groupby(group_keys).shift(n, fill_value=0)
+            prev_count = cum_count.groupby(group_keys).shift(n, fill_value=0)
+            result[f"{prefix}_{n}"] = (cum_sum - prev_sum) / (cum_count - prev_count).replace(0, np.nan)
+    return pd.DataFrame(result, index=history.index)
+
+
+def _history_stats(history, n_list):
+    """
+    馬ごとに、各出走の時点までの成績（その出走を含む）を計算する。
+    as-of結合で「対象レースより前の最後の出走」の行を引けば、対象レースより前の成績になります。
+
+    Returns:
+        tuple: (馬ごとの成績, 馬・馬場・距離帯ごとの成績)
+    """
+    form = pd.concat(
+        [
+            history[["horse_code", "date"]],
+            history.groupby("horse_code").cumcount().add(1).rename("n_past_races"),
+            _cumulative_means(history, ["horse_code"], FORM_COLUMNS, n_list),
+        ],
+        axis=1,
+    )
+    form["last_date"] = form["date"]
+    condition_keys = ["horse_code", "race_type", "dist_band"]
+    condition = pd.concat(
+        [
+            history[condition_keys + ["date"]],
+            history.groupby(condition_keys).cumcount().add(1).rename("cond_n_races"),
+            _cumulative_means(history, condition_keys, CONDITION_COLUMNS),
+        ],
+        axis=1,
+    )
+    condition = condition.rename(
+        columns={f"{prefix}_all": prefix for prefix in CONDITION_COLUMNS.values()}
+    )
+    return form, condition
+
+
+def _horse_signature(history):
+    """馬ごとの過去成績のハッシュ。過去成績が変わった馬だけを計算し直すのに使う"""
+    row_hash = pd.util.hash_pandas_object(history[HISTORY_COLUMNS], index=False)
+    return row_hash.groupby(history["horse_code"]).sum()
+
+
+def _cached_history_stats(history, n_list, use_cache):
+    """
+    _history_statsの結果を馬ごとにキャッシュして使い回す。
+    過去成績が変わった馬（新しい出走が増えた馬など）と、新しい馬だけを計算し直します。
+    n_listが変わった場合は全件計算し直します。
+    """
+    signature = _horse_signature(history)
+    cache_path = FEATURE_DIR / HORSE_FORM_CACHE_FILE
+    cache = pd.read_pickle(cache_path) if use_cache and cache_path.exists() else None
+    if cache is None or cache["n_list"] != list(n_list):
+        changed_horses = signature.index
+        form, condition = _history_stats(history, n_list)
+    else:
+        old_signature = cache["signature"].reindex(signature.index)
+        changed_horses = signature.index[old_signature.ne(signature)]
+        new_form, new_condition = _history_stats(
+            history[history["horse_code"].isin(changed_horses)].reset_index(drop=True), n_list
+        )
+        keep_form = cache["form"][
+            cache["form"]["horse_code"].isin(signature.index)
+            & ~cache["form"]["horse_code"].isin(changed_horses)
+        ]
+        keep_condition = cache["condition"][
+            cache["condition"]["horse_code"].isin(signature.index)
+            & ~cache["condition"]["horse_code"].isin(changed_horses)
+        ]
+        form = pd.concat([keep_form, new_form], ignore_index=True)
+        condition = pd.concat([keep_condition, new_condition], ignore_index=True)
+    metrics.incr("feature_horses_recomputed_total", len(changed_horses))
+    metrics.incr("feature_horses_cached_total", len(signature) - len(changed_horses))
+    if use_cache:
+        pd.to_pickle(
+            {"n_list": list(n_list), "signature": signature, "form": form, "condition": condition},
+            cache_path,
+        )
+    return form, condition
+
+
+def horse_form_features(df_race, df_race_info, df_horse, n_list=(3, 5), use_cache=True):
+    """
+    _関数の意味と使い方_
+    df_raceの各 (race_id, horse_code) について、そのレースの日付より前の出走だけを使って
+    馬の近走成績の特徴量を計算する関数です。
+    df_horseを馬・日付順に並べて累積和で各出走時点の成績を計算し、
+    pd.merge_asofで「レースの日付より前の最後の出走」の成績を結合します（同じ日付の出走は含めません）。
+    同じ馬場（芝・ダート・障害）・距離帯での成績は、馬・馬場・距離帯ごとに同じように計算して結合します。
+    各出走時点の成績は馬ごとにキャッシュするので、2回目以降は過去成績が変わった馬だけを計算します。
+
+    作る特徴量:
+        n_past_races: 過去の出走数
+        days_since_last: 前走からの日数
+        rank_mean_{N}, prize_mean_{N}, rank_diff_mean_{N}, win_rate_{N}, top3_rate_{N}: 直近N走の平均
+        rank_mean_all, prize_mean_all, rank_diff_mean_all, win_rate_all, top3_rate_all: 全出走の平均
+        cond_n_races, cond_rank_mean, cond_win_rate, cond_top3_rate: 同じ馬場・距離帯での出走数と成績
+
+    Args:
+        df_race (pd.DataFrame): race_id, horse_code列を持つテーブル（df_race_csvの出力）
+        df_race_info (pd.DataFrame): race_id, date, race_type, course_len列を持つテーブル（df_race_info_csvの出力）
+        df_horse (pd.DataFrame): df_horse_csvの出力
+        n_list (tuple, optional): 直近何走の平均を計算するか
+        use_cache (bool, optional): 馬ごとのキャッシュを使うかどうか
+
+    Returns:
+        pd.DataFrame: race_id, horse_codeと特徴量。行の順番はdf_raceと同じです（レース情報がない行は除きます）。
+    """
+    history = _prepare_history(df_horse)
+    form, condition = _cached_history_stats(history, n_list, use_cache)
+
+    target = df_race[["race_id", "horse_code"]].merge(
+        df_race_info[["race_id", "date", "race_type", "course_len"]], on="race_id", how="left"
+    )
+    target["race_type"] = target["race_type"].fillna(-1).astype("int8")
+    target["dist_band"] = _distance_band(target["course_len"])
+    target["order"] = np.arange(len(target))
+    target = target.dropna(subset=["date"]).sort_values("date", kind="stable")
+
+    features = pd.merge_asof(
+        target,
+        form.sort_values("date", kind="stable"),
+        on="date",
+        by="horse_code",
+        allow_exact_matches=False,
+    )
+    features = pd.merge_asof(
+        features,
+        condition.sort_values("date", kind="stable"),
+        on="date",
+        by=["horse_code", "race_type", "dist_band"],
+        allow_exact_matches=False,
+    )
+    features["days_since_last"] = (features["date"] - features["last_date"]).dt.days
+    # 初出走の馬は過去の出走数を0にする
+    features[["n_past_races", "cond_n_races"]] = (
+        features[["n_past_races", "cond_n_races"]].fillna(0).astype("int32")
+    )
+    features = features.sort_values("order").drop(
+        columns=["order", "date", "race_type", "course_len", "dist_band", "last_date"]
+    )
+    feature_columns = ["n_past_races", "days_since_last"] + [
+        column for column in features.columns
+        if column not in ("race_id", "horse_code", "n_past_races", "days_since_last")
+    ]
+    return features[["race_id", "horse_code"] + feature_columns].reset_index(drop=True)
+
+
+@stage("horse_form_csv")
+def horse_form_csv(n_list=(3, 5), use_cache=True):
+    """
+    _関数の意味と使い方_
+    df_csvのdf_race.csv, df_race_info.csv, df_horse.csvから近走成績の特徴量を作り、
+    FEATURE_DIR / "horse_form.csv" に保存する関数です。
+    中身はhorse_form_featuresを参照してください。
+    """
+    df_race = pd.read_csv(DF_CSV_DIR / "df_race.csv", sep="\t")
+    df_race_info = pd.read_csv(DF_CSV_DIR / "df_race_info.csv", sep="\t", parse_dates=["date"])
+    df_horse = pd.read_csv(DF_CSV_DIR / "df_horse.csv", sep="\t", parse_dates=["date"])
+    df = horse_form_features(df_race, df_race_info, df_horse, n_list, use_cache)
+    df.to_csv(FEATURE_DIR / "horse_form.csv", sep="\t", index=False)
+    metrics.set_gauge("rows", len(df), file="horse_form.csv")
+    return df
@@ -0,0 +1,259 @@
+import gzip
+import http.client
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urljoin, urlsplit
+
+from metrics import metrics
+
+
+DEFAULT_HEADERS = {"User-Agent": "Mozilla/5.0", "Accept-Encoding": "gzip"}
+# リトライの対象にするステータスコード
+RETRY_STATUS = {429, 500, 502, 503, 504}
+REDIRECT_STATUS = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+
+
+Response = namedtuple("Response", ["url", "status", "headers", "body"])
+
+
+class FetchError(Exception):
+    """
+    リトライしても取得できなかった、またはリトライしないエラーが返ってきたときの例外。
+    statusにはHTTPステータスコード（通信エラーの場合はNone）が入ります。
+    """
+
+    def __init__(self, url, status=None, message=""):
+        super().__init__(f"{url}: {status} {message}".strip())
+        self.url = url
+        self.status = status
+
+
+class TokenBucket:
+    """
+    トークンバケット方式のレート制限。
+    rateは1秒あたりに補充されるトークン数、capacityは貯められるトークンの上限です。
+    rateがNoneのときは制限しません。
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """トークンが1つ取れるまで待つ"""
+        if self.rate is None:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last) * self.rate
+                )
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_sec = (1 - self._tokens) / self.rate
+            time.sleep(wait_sec)
+
+
+class Fetcher:
+    """
+    _クラスの意味と使い方_
+    スレッドプールで複数のURLを並行して取得するクラスです。
+    スレッドごと・ホストごとにHTTP接続を使い回し（keep-alive）、
+    全体とホストごとのトークンバケットでリクエストの間隔を制限します。
+    5xx・429・タイムアウト・接続エラーは指数バックオフでリトライします。
+    http:// のURLも扱えるので、ローカルのスタブサーバーに向けてテストできます。
+    fetch_manyは終わるときに、ワーカースレッドが開いた接続を閉じます。
+    fetchを直接使う場合は、close()を呼ぶか with Fetcher() as fetcher: の形で使ってください。
+
+    Args:
+        rate (float, optional): 全体で1秒あたりに送るリクエスト数の上限
+        per_host_rate (float, optional): ホストごとの1秒あたりのリクエスト数の上限
+        max_in_flight (int, optional): 同時に送るリクエスト数の上限（スレッド数）
+        retries (int, optional): リトライ回数
+        backoff (float, optional): 1回目のリトライまでの待ち時間（秒）。以降は2倍ずつ増やす
+        timeout (float, optional): 1リクエストのタイムアウト（秒）
+        headers (dict, optional): 追加で送るリクエストヘッダー
+    """
+
+    def __init__(
+        self,
+        rate=1.0,
+        per_host_rate=1.0,
+        max_in_flight=4,
+        retries=3,
+        backoff=1.0,
+        timeout=30,
+        headers=None,
+    ):
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.headers = {**DEFAULT_HEADERS, **(headers or {})}
+        self.per_host_rate = per_host_rate
+        self._bucket = TokenBucket(rate)
+        self._host_buckets = {}
+        self._host_lock = threading.Lock()
+        self._local = threading.local()
+        # スレッドごとの接続の辞書。close()でまとめて閉じるために覚えておく
+        self._thread_connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """すべてのスレッドで開いた接続を閉じる。次のリクエストでは接続し直します"""
+        with self._host_lock:
+            thread_connections, self._thread_connections = self._thread_connections, []
+            self._local = threading.local()
+        for connections in thread_connections:
+            for conn in list(connections.values()):
+                conn.close()
+            connections.clear()
+
+    def _host_bucket(self, netloc):
+        with self._host_lock:
+            if netloc not in self._host_buckets:
+                self._host_buckets[netloc] = TokenBucket(self.per_host_rate)
+            return self._host_buckets[netloc]
+
+    def _connection(self, scheme, netloc):
+        """このスレッドで使い回しているホストへの接続を返す（なければ作る）"""
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+            with self._host_lock:
+                self._thread_connections.append(connections)
+        key = (scheme, netloc)
+        if key not in connections:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[key] = conn
+        return connections[key]
+
+    def _drop_connection(self, scheme, netloc):
+        conn = getattr(self._local, "connections", {}).pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def _request(self, url, headers):
+        """1回だけリクエストを送る。リダイレクトはたどる"""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += f"?{parts.query}"
+            with metrics.timer("fetch_rate_limit_wait_seconds", host=parts.netloc):
+                self._host_bucket(parts.netloc).acquire()
+                self._bucket.acquire()
+            conn = self._connection(parts.scheme, parts.netloc)
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path, headers=headers)
+                res = conn.getresponse()
+                body = res.read()
+            except Exception as e:
+                # 壊れた接続は捨てて、次は新しく接続し直す
+                self._drop_connection(parts.scheme, parts.netloc)
+                metrics.incr("fetch_connection_errors_total", host=parts.netloc, error=type(e).__name__)
+                raise
+            metrics.observe("fetch_seconds", time.perf_counter() - start, host=parts.netloc)
+            metrics.incr("fetch_responses_total", host=parts.netloc, status=res.status)
+            metrics.incr("fetch_bytes_total", len(body), host=parts.netloc)
+            if res.will_close:
+                self._drop_connection(parts.scheme, parts.netloc)
+            if res.getheader("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            if res.status in REDIRECT_STATUS and res.getheader("Location"):
+                url = urljoin(url, res.getheader("Location"))
+                continue
+            return Response(url, res.status, dict(res.getheaders()), body)
+        raise FetchError(url, message="too many redirects")
+
+    def _retry_wait(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response else None
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * 2**attempt * (1 + random.random() * 0.1)
+
+    def fetch(self, url, headers=None):
+        """
+        URLを取得してResponseを返す。
+        2xx, 3xx（304など）はそのまま返し、4xxはFetchErrorを投げます。
+        リトライ対象のエラーはretries回までリトライし、それでも失敗したらFetchErrorを投げます。
+        """
+        headers = {**self.headers, **(headers or {})}
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._request(url, headers)
+            except (OSError, http.client.HTTPException) as e:
+                # タイムアウト、接続エラー、途中で切れたレスポンス
+                if attempt == self.retries:
+                    metrics.incr("fetch_failures_total", status="connection")
+                    raise FetchError(url, message=repr(e)) from e
+                metrics.incr("fetch_retries_total", status="connection")
+                time.sleep(self._retry_wait(attempt))
+                continue
+            if response.status in RETRY_STATUS:
+                if attempt == self.retries:
+                    metrics.incr("fetch_failures_total", status=response.status)
+                    raise FetchError(url, response.status)
+                metrics.incr("fetch_retries_total", status=response.status)
+                time.sleep(self._retry_wait(attempt, response))
+                continue
+            if response.status >= 400:
+                metrics.incr("fetch_failures_total", status=response.status)
+                raise FetchError(url, response.status)
+            return response
+
+    def fetch_many(self, urls, headers=None, url_headers=None):
+        """
+        複数のURLを並行して取得するジェネレータ。
+        取得が終わった順に (url, Response, 例外) を返します。成功時の例外、失敗時のResponseはNoneです。
+        未完了のリクエストはmax_in_flightの数倍までしか溜めないので、URLが大量でもメモリは増えません。
+        url_headers（url -> ヘッダーの辞書）を渡すと、そのURLにだけ追加のヘッダー
+        （条件付きリクエストのIf-None-Matchなど）を付けます。
+        """
+        urls = iter(urls)
+        url_headers = url_headers or {}
+
+        def submit(executor, url):
+            return executor.submit(self.fetch, url, {**(headers or {}), **url_headers.get(url, {})})
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            pending = {}
+            try:
+                for url in urls:
+                    pending[submit(executor, url)] = url
+                    if len(pending) >= self.max_in_flight * 2:
+                        break
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        url = pending.pop(future)
+                        try:
+                            yield url, future.result(), None
+                        except Exception as e:
+                            yield url, None, e
+                        next_url = next(urls, None)
+                        if next_url is not None:
+                            pending[submit(executor, next_url)] = next_url
+            finally:
+                executor.shutdown(cancel_futures=True)
+                # ワーカースレッドは終わるので、そのスレッドが開いた接続を閉じる
+                self.close()
@@ -0,0 +1,162 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+DATA_DIR = Path("../data")
+ID_DICT_DIR = DATA_DIR / "id_dict"
+
+ID_KINDS = ["horse", "jockey", "trainer"]
+# netkeibaのidの桁数。jockey_id, trainer_idは先頭が0の5桁（"01167"）なので、
+# 整数で渡されたidや、整数で保存していた以前の辞書のidはこの桁数まで先頭を0で埋めます
+ID_WIDTHS = {"horse": 10, "jockey": 5, "trainer": 5}
+# raw_csvを読むときに、idの列を文字列のまま読むためのdtype
+ID_COLUMN_DTYPES = {f"{kind}_id": str for kind in ID_KINDS}
+# idがない行（リンクがなかった騎手など）のコード
+MISSING_CODE = -1
+
+ID_DICT_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def normalize_ids(kind, ids):
+    """
+    idの配列を、ID辞書で使う文字列のidにする。
+    CSVを型推論で読んで整数になったid（1167）も、サイトと同じid（"01167"）に戻します。
+    リンクがなくて取れなかったid（None, NaN）はNoneのままにします。
+
+    Returns:
+        np.ndarray: 文字列のidのobject配列
+    """
+    ids = pd.Series(ids)
+    missing = ids.isna().to_numpy()
+    if pd.api.types.is_float_dtype(ids):
+        ids = ids.fillna(0).astype("int64")
+    normalized = ids.astype(str).str.zfill(ID_WIDTHS.get(kind, 0)).to_numpy(dtype=object)
+    normalized[missing] = None
+    return normalized
+
+
+class IdDictionary:
+    """
+    _クラスの意味と使い方_
+    horse_id, jockey_id, trainer_idを、0から始まる連番のint32のコードに変換する辞書です。
+    ID_DICT_DIR / f"{kind}.tsv" に (id, name) を追記していくだけのファイルで保存します。
+    idは先頭の0を含めた文字列で保存し、decodeでそのまま戻せます（normalize_ids参照）。
+    コードはidが最初に追記された順番なので、一度付いたコードは後から変わりません。
+    idがない行（None, NaN）はMISSING_CODEにし、辞書には追加しません。
+    名前が変わった場合は同じidの行をもう一度追記し、読み込み時は最後の名前を使います。
+    書き込みは1プロセスから行う前提です。
+    """
+
+    def __init__(self, kind, directory=ID_DICT_DIR):
+        self.kind = kind
+        self.path = Path(directory) / f"{kind}.tsv"
+        if self.path.exists():
+            df = pd.read_csv(self.path, sep="\t", dtype=str, keep_default_na=False)
+            df["id"] = normalize_ids(kind, df["id"])
+        else:
+            df = pd.DataFrame({"id": pd.Series(dtype=object), "name": pd.Series(dtype=str)})
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            df.to_csv(self.path, sep="\t", index=False)
+        # 最初に出てきた順番がコード、最後に出てきた名前が今の名前
+        self._index = pd.Index(df["id"].drop_duplicates().to_numpy(dtype=object))
+        latest = df.drop_duplicates("id", keep="last").set_index("id")["name"]
+        self._names = latest.reindex(self._index).to_numpy(dtype=object)
+
+    def __len__(self):
+        return len(self._index)
+
+    def _append(self, ids, names):
+        pd.DataFrame({"id": ids, "name": names}).to_csv(
+            self.path, sep="\t", index=False, header=False, mode="a"
+        )
+
+    def encode(self, ids, names=None, add=True):
+        """
+        idの配列をコードの配列に変換する。
+        addがTrueなら、辞書にないidを追加してからコードを付けます。Falseなら辞書にないidは-1になります。
+        idがない要素（None, NaN）は、addに関係なくMISSING_CODE（-1）になります。
+        namesを渡すと、名前が変わったidの名前を更新します（addがTrueの場合のみ）。
+
+        Returns:
+            np.ndarray: int32のコード
+        """
+        ids = normalize_ids(self.kind, ids)
+        missing = pd.isna(ids)
+        codes = self._index.get_indexer(ids)
+        codes[missing] = MISSING_CODE
+        if add:
+            new = (codes == -1) & ~missing
+            if new.any():
+                # 出てきた順番にコードを付ける
+                new_ids = pd.unique(ids[new])
+                new_names = np.full(len(new_ids), "", dtype=object)
+                if names is not None:
+                    latest = pd.Series(np.asarray(names, dtype=object), index=ids)
+                    latest = latest[~latest.index.duplicated(keep="last")]
+                    new_names = latest.reindex(new_ids).fillna("").to_numpy(dtype=object)
+                self._append(new_ids, new_names)
+                self._index = self._index.append(pd.Index(new_ids))
+                self._names = np.concatenate([self._names, new_names])
+                codes[new] = self._index.get_indexer(ids[new])
+            if names is not None:
+                self._update_names(codes, names)
+        return codes.astype(np.int32)
+
+    def _update_names(self, codes, names):
+        latest = pd.Series(np.asarray(names, dtype=object), index=codes)
+        latest = latest[(latest.index >= 0) & latest.notna() & (latest != "")]
+        latest = latest[~latest.index.duplicated(keep="last")]
+        changed = latest[self._names[latest.index.to_numpy()] != latest.to_numpy()]
+        if len(changed):
+            self._append(self._index[changed.index.to_numpy()], changed.to_numpy())
+            self._names[changed.index.to_numpy()] = changed.to_numpy()
+
+    def decode(self, codes):
+        """コードの配列を、文字列のidの配列に戻す。MISSING_CODEはNoneになります"""
+        return self._lookup(self._index.to_numpy(), codes)
+
+    def lookup_name(self, codes):
+        """コードの配列から名前の配列を引く。MISSING_CODEはNoneになります"""
+        return self._lookup(self._names, codes)
+
+    @staticmethod
+    def _lookup(values, codes):
+        codes = np.asarray(codes)
+        found = np.full(len(codes), None, dtype=object)
+        known = codes >= 0
+        found[known] = values[codes[known]]
+        return found
+
+    def table(self):
+        """code, id, nameの対応表"""
+        return pd.DataFrame(
+            {"code": np.arange(len(self), dtype=np.int32), "id": self._index, "name": self._names}
+        )
+
+
+_dictionaries = {}
+
+
+def open_id_dictionary(kind):
+    """
+    種類（"horse", "jockey", "trainer"）ごとにIdDictionaryを1つだけ開いて使い回す。
+    """
+    if kind not in _dictionaries:
+        _dictionaries[kind] = IdDictionary(kind, ID_DICT_DIR)
+    return _dictionaries[kind]
+
+
+def name_table():
+    """
+    _関数の意味と使い方_
+    すべての種類のID辞書をまとめた名前の対応表を返す関数です。
+    df_raceなどのテーブルは名前を持たないので、名前が必要な場合はこの表とコードで結合してください。
+
+    Returns:
+        pd.DataFrame: kind, code, id, name列のテーブル
+    """
+    return pd.concat(
+        [open_id_dictionary(kind).table().assign(kind=kind) for kind in ID_KINDS],
+        ignore_index=True,
+    )[["kind", "code", "id", "name"]]
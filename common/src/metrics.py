@@ -0,0 +1,243 @@
+import cProfile
+import datetime
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+
+DATA_DIR = Path("../data")
+METRICS_DIR = DATA_DIR / "metrics"
+
+# Prometheus形式で出力するときのメトリクス名の接頭辞
+PREFIX = "keiba_"
+# 環境変数で、ノートブックのコードを変えずにメトリクスの出力先とプロファイラを指定できる
+METRICS_FILE_ENV = "KEIBA_METRICS_FILE"
+PROFILE_ENV = "KEIBA_PROFILE"
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Metrics:
+    """
+    _クラスの意味と使い方_
+    パイプラインの各ステージのカウンター・時間・ゲージを集めるクラスです。
+    scraping, create_raw, dfはモジュールのmetricsを共有して記録します。
+    値はメトリクス名とラベル（stage="raw_race_csv"など）の組ごとに集計します。
+    Fetcherのスレッドからも記録するので、更新はロックで守ります。
+    dump()でJSONかPrometheusのテキスト形式に書き出せます。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._timings = {}
+            self._gauges = {}
+
+    def incr(self, name, value=1, **labels):
+        """カウンターにvalueを足す"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """時間を1回分記録する。回数・合計・最大を持ちます"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            count, total, max_ = self._timings.get(key, (0, 0.0, 0.0))
+            self._timings[key] = (count + 1, total + seconds, max(max_, seconds))
+
+    def set_gauge(self, name, value, **labels):
+        """最後に記録した値だけを持つ"""
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """今までの値をJSONにできる辞書で返す"""
+        with self._lock:
+            return {
+                "generated_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                "timings": [
+                    {"name": name, "labels": dict(labels), "count": count, "sum": total, "max": max_}
+                    for (name, labels), (count, total, max_) in sorted(self._timings.items())
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._gauges.items())
+                ],
+            }
+
+    def to_prometheus(self):
+        """Prometheusのテキスト形式（node_exporterのtextfile collectorで読める形式）にする"""
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+
+        def add(family, type_, name, labels, value):
+            if family not in typed:
+                lines.append(f"# TYPE {family} {type_}")
+                typed.add(family)
+            label_text = ",".join(
+                '{}="{}"'.format(key, str(val).replace("\\", "\\\\").replace('"', '\\"'))
+                for key, val in labels.items()
+            )
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        for item in snapshot["counters"]:
+            name = PREFIX + item["name"]
+            add(name, "counter", name, item["labels"], item["value"])
+        for item in snapshot["timings"]:
+            name = PREFIX + item["name"]
+            add(name, "summary", name + "_sum", item["labels"], item["sum"])
+            add(name, "summary", name + "_count", item["labels"], item["count"])
+        # 同じメトリクスの行はまとめて書く必要があるので、最大値は別に書く
+        for item in snapshot["timings"]:
+            name = PREFIX + item["name"] + "_max"
+            add(name, "gauge", name, item["labels"], item["max"])
+        for item in snapshot["gauges"]:
+            name = PREFIX + item["name"]
+            add(name, "gauge", name, item["labels"], item["value"])
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path=None):
+        """
+        メトリクスをファイルに書き出す。
+        拡張子が.promならPrometheusのテキスト形式、それ以外はJSONで書きます。
+        pathを省略するとMETRICS_DIR / "metrics.json" に書きます。
+        """
+        path = Path(path) if path else METRICS_DIR / "metrics.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix == ".prom":
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        tmp_path.write_text(text, encoding="utf-8")
+        tmp_path.replace(path)
+        return path
+
+
+metrics = Metrics()
+
+
+def max_rss_bytes():
+    """このプロセスと、終了した子プロセス（ワーカー）の最大メモリ使用量"""
+    # ru_maxrssはLinuxではKB、macOSではバイト単位
+    unit = 1 if sys.platform == "darwin" else 1024
+    return unit * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+class SamplingProfiler:
+    """
+    一定間隔でスレッドのスタックを覗いて、関数ごとの出現回数を数えるプロファイラ。
+    cProfileより負荷が小さいので、本番の再構築でも使えます。
+    結果はflamegraph.plやspeedscopeで読める、折りたたんだスタック（1行に "a;b;c 回数"）で書き出します。
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{Path(code.co_filename).name}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+_stage_depth = threading.local()
+
+
+@contextmanager
+def stage(name, profile=None):
+    """
+    _関数の意味と使い方_
+    withで囲んだ処理（またはデコレータを付けた関数）を1つのステージとして計測する関数です。
+    ステージの実行時間・実行回数・失敗回数・終了時の最大メモリ使用量を記録します。
+    profileに"cprofile"を渡すとcProfileの結果を METRICS_DIR / f"{name}.prof" に、
+    "sampling"を渡すとSamplingProfilerの結果を METRICS_DIR / f"{name}.folded" に書き出します。
+    profileを省略すると環境変数KEIBA_PROFILEの値を使います。
+    ステージの中で別のステージを呼んだ場合、プロファイルは一番外側のステージだけで取ります。
+    環境変数KEIBA_METRICS_FILEがあれば、一番外側のステージが終わるたびにそのファイルへdumpします。
+
+    Example:
+        with stage("df_race_csv", profile="cprofile"):
+            df_race_csv()
+    """
+    depth = getattr(_stage_depth, "value", 0)
+    profile = profile or os.environ.get(PROFILE_ENV)
+    profiler = None
+    # プロファイラは同時に1つしか動かせないので、入れ子のステージは外側のステージの結果に含める
+    if depth == 0 and profile == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif depth == 0 and profile == "sampling":
+        profiler = SamplingProfiler()
+        profiler.start()
+    _stage_depth.value = depth + 1
+    start = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        metrics.observe("stage_seconds", time.perf_counter() - start, stage=name)
+        metrics.incr("stage_runs_total", stage=name, status=status)
+        metrics.set_gauge("stage_max_rss_bytes", max_rss_bytes(), stage=name)
+        _stage_depth.value = depth
+        if profiler is not None:
+            METRICS_DIR.mkdir(parents=True, exist_ok=True)
+            if profile == "cprofile":
+                profiler.disable()
+                profiler.dump_stats(METRICS_DIR / f"{name}.prof")
+            else:
+                profiler.stop()
+                profiler.dump(METRICS_DIR / f"{name}.folded")
+        if depth == 0 and os.environ.get(METRICS_FILE_ENV):
+            metrics.dump(os.environ[METRICS_FILE_ENV])
@@ -0,0 +1,338 @@
+import argparse
+import datetime
+import hashlib
+import importlib
+import json
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from pathlib import Path
+
+
+# scraping, create_raw, dfはimportするだけでディレクトリを作ったりマッピングを読み込んだりするので、
+# このモジュールではimportせず、ステージを実行するワーカープロセスの中でimportする
+DATA_DIR = Path("../data")
+PIPELINE_DIR = DATA_DIR / "pipeline"
+METRICS_DIR = DATA_DIR / "metrics"
+STATE_FILE_NAME = "state.json"
+
+# inputs, outputsはDATA_DIRからの相対パス。{from_}, {to_}は実行時の期間に置き換えます。
+# paramsは、コマンドラインの指定のうちその関数に渡す引数の名前です。
+# locksが同じステージは同時に実行しません（ID辞書は1プロセスから書き込む前提のため）。
+Stage = namedtuple("Stage", ["name", "module", "func", "inputs", "outputs", "params", "locks"])
+
+KAISAI_DATE_FILE = "kaisai_date/kaisai_date_list[{from_}_to_{to_}].pkl"
+RACE_ID_FILE = "race_id/race_id_list[{from_}_to_{to_}].pkl"
+CREATE_RAW_PARAMS = ("n_workers", "incremental", "batch_size")
+DF_PARAMS = ("parquet", "engine")
+# 今月の開催日・レースは後から増えるので、期間が今月以降を含むスクレイピングのステージは、
+# 出力がこの時間より古ければ入力が変わっていなくても実行し直します
+SCRAPE_MAX_AGE = datetime.timedelta(hours=12)
+
+STAGES = [
+    Stage("scrape_kaisai_date", "scraping", "scrape_kaisai_date",
+          [], [KAISAI_DATE_FILE], ("from_", "to_"), ()),
+    Stage("scrape_race_id_list", "scraping", "scrape_race_id_list",
+          [KAISAI_DATE_FILE], [RACE_ID_FILE], ("from_", "to_"), ()),
+    Stage("scrape_html_race", "scraping", "scrape_html_race",
+          [RACE_ID_FILE], ["html/race"], ("from_", "to_"), ()),
+    # raceページは1回だけパースして、結果・情報・払い戻しの3つのCSVをまとめて書く
+    Stage("raw_race_all_csv", "create_raw", "raw_race_all_csv",
+          ["html/race", "archive/race"],
+          ["raw_csv/raw_race.csv", "raw_csv/raw_race_info.csv", "raw_csv/raw_race_return.csv"],
+          CREATE_RAW_PARAMS, ()),
+    Stage("create_id_list", "create_raw", "create_id_list",
+          ["raw_csv/raw_race.csv"],
+          ["horse_id/horse_id_list.pickle", "jockey_id/jockey_id_list.pickle", "trainer_id/trainer_id_list.pickle"],
+          (), ("id_dict",)),
+    Stage("scrape_html_horse", "scraping", "scrape_html_horse",
+          ["horse_id/horse_id_list.pickle"], ["html/horse"], ("refresh",), ()),
+    Stage("create_horse_raw_csv", "create_raw", "create_horse_raw_csv",
+          ["html/horse", "archive/horse"], ["raw_csv/raw_horse.csv"], CREATE_RAW_PARAMS, ()),
+    Stage("df_race_csv", "df", "df_race_csv",
+          ["raw_csv/raw_race.csv"], ["df_csv/df_race.csv"], DF_PARAMS, ("id_dict",)),
+    Stage("df_horse_csv", "df", "df_horse_csv",
+          ["raw_csv/raw_horse.csv"], ["df_csv/df_horse.csv"], DF_PARAMS, ("id_dict",)),
+    Stage("df_race_info_csv", "df", "df_race_info_csv",
+          ["raw_csv/raw_race_info.csv", "raw_csv/raw_race.csv"], ["df_csv/df_race_info.csv"], DF_PARAMS, ()),
+    Stage("df_race_return_csv", "df", "df_race_return_csv",
+          ["raw_csv/raw_race_return.csv"], ["df_csv/df_race_return.csv"], DF_PARAMS, ()),
+    Stage("horse_form_csv", "features", "horse_form_csv",
+          ["df_csv/df_race.csv", "df_csv/df_race_info.csv", "df_csv/df_horse.csv"],
+          ["features/horse_form.csv"], (), ()),
+    Stage("training_matrix", "dataset", "build_training_matrix",
+          ["df_csv/df_race.csv", "df_csv/df_race_info.csv", "df_csv/df_race_return.csv", "features/horse_form.csv"],
+          ["dataset/schema.json"], (), ()),
+    Stage("race_store", "race_store", "build_race_store",
+          ["df_csv/df_race.csv", "df_csv/df_race_info.csv", "id_dict"], ["race_store/schema.json"], (), ("id_dict",)),
+    Stage("race_shards", "race_shards", "export_race_shards",
+          ["df_csv/df_race.csv", "df_csv/df_race_info.csv", "df_csv/df_race_return.csv", "id_dict"],
+          ["../../front-end/public/data/races/index.json"], (), ("id_dict",)),
+]
+SCRAPE_STAGES = [stage.name for stage in STAGES if stage.module == "scraping"]
+
+
+def _stage_paths(paths, options):
+    return [DATA_DIR / path.format(**options) for path in paths]
+
+
+def _files(path):
+    """ファイルならそのファイル、ディレクトリなら中のファイル（書き込み途中の.tmpを除く）"""
+    if path.is_dir():
+        return sorted(p for p in path.rglob("*") if p.is_file() and p.suffix != ".tmp")
+    return [path] if path.exists() else []
+
+
+def _newest_mtime(path):
+    """pathの更新時刻。ディレクトリは中で一番新しいファイルの更新時刻です"""
+    return max([p.stat().st_mtime_ns for p in _files(path)] or [path.stat().st_mtime_ns])
+
+
+def path_signature(path):
+    """
+    pathの中身のハッシュ。ファイルは中身のsha1、
+    ディレクトリは（ページ数が多いので）中のファイルの名前・サイズ・更新時刻のsha1にします。
+    存在しない場合はNoneです。
+    """
+    if not path.exists():
+        return None
+    h = hashlib.sha1()
+    if path.is_dir():
+        for p in _files(path):
+            stat = p.stat()
+            h.update(f"{p.relative_to(path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+        return "dir:" + h.hexdigest()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_state():
+    try:
+        with open(PIPELINE_DIR / STATE_FILE_NAME, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(state):
+    PIPELINE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = PIPELINE_DIR / (STATE_FILE_NAME + ".tmp")
+    tmp_path.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp_path.replace(PIPELINE_DIR / STATE_FILE_NAME)
+
+
+def input_signature(stage, options):
+    return {str(path): path_signature(path) for path in _stage_paths(stage.inputs, options)}
+
+
+def is_scrape_stale(stage, options):
+    """
+    スクレイピングのステージで、期間（to_）が今月以降を含み、
+    出力がSCRAPE_MAX_AGEより古い場合にTrueを返す
+    """
+    to_ = options.get("to_")
+    if stage.name not in SCRAPE_STAGES or not to_:
+        return False
+    # to_は"2024-01"のような月か"2024-01-15"のような日付なので、先頭7文字で月を比べられる
+    if to_[:7] < datetime.date.today().strftime("%Y-%m"):
+        return False
+    newest = min(map(_newest_mtime, _stage_paths(stage.outputs, options)))
+    return time.time() - newest / 1e9 > SCRAPE_MAX_AGE.total_seconds()
+
+
+def is_up_to_date(stage, options, state):
+    """
+    _関数の意味と使い方_
+    ステージを実行し直す必要がないかを判定する関数です。
+    出力がすべてあり、次のどちらかを満たせば最新とみなします。
+    ・出力の更新時刻が、すべての入力の更新時刻より新しい
+    ・入力のハッシュ（path_signature）が、前回そのステージが成功したときと同じ
+    前段のステージが同じ内容のファイルを書き直しただけの場合は、後者で実行を省けます。
+    ハッシュは更新時刻で判定できなかったときだけ計算します。
+    ただし、期間が今月以降を含むスクレイピングのステージは、出力が古ければ実行し直します（is_scrape_stale参照）。
+    """
+    outputs = _stage_paths(stage.outputs, options)
+    if not outputs or not all(path.exists() for path in outputs):
+        return False
+    if is_scrape_stale(stage, options):
+        return False
+    inputs = [path for path in _stage_paths(stage.inputs, options) if path.exists()]
+    if not inputs:
+        return True
+    if max(map(_newest_mtime, inputs)) <= min(map(_newest_mtime, outputs)):
+        return True
+    previous = state.get(stage.name, {}).get("inputs")
+    return previous is not None and previous == input_signature(stage, options)
+
+
+def _run_stage(module_name, func_name, kwargs, name):
+    """
+    ワーカープロセスで1つのステージを実行する。
+    モジュールはここで初めてimportします。ステージのmetricsは METRICS_DIR / f"pipeline_{name}.json" に書き出します。
+    """
+    from metrics import metrics
+
+    module = importlib.import_module(module_name)
+    if hasattr(module, "tqdm"):
+        # コマンドラインではノートブック用の進捗バーを使えないので、ターミナル用に差し替える
+        from tqdm import tqdm
+
+        module.tqdm = tqdm
+    start = time.perf_counter()
+    getattr(module, func_name)(**kwargs)
+    seconds = time.perf_counter() - start
+    metrics.dump(METRICS_DIR / f"pipeline_{name}.json")
+    return seconds
+
+
+def _depends_on(stage, other, options):
+    return bool(set(_stage_paths(stage.inputs, options)) & set(_stage_paths(other.outputs, options)))
+
+
+def run_pipeline(stages=None, from_=None, to_=None, jobs=2, force=False, dry_run=False, **params):
+    """
+    _関数の意味と使い方_
+    スクレイピングからdf・特徴量の作成までのステージを、依存関係の順に実行する関数です。
+    各ステージの入力・出力はSTAGESに書いてあり、出力が入力より新しいステージや、
+    入力が前回と同じ内容のステージはスキップします（is_up_to_date参照）。
+    依存関係のないステージ（df_race_info_csvとdf_race_return_csvなど）は、
+    最大jobs個まで別々のプロセスで同時に実行します。
+    モジュールは各ステージのプロセスの中でimportするので、スキップしたステージのimportはしません。
+    失敗したステージの後段は実行せず、ほかのステージは続けます。
+
+    Args:
+        stages (list, optional): 対象のステージ名のリスト。省略するとすべて。
+            from_, to_を指定しない場合、スクレイピングのステージは対象外です
+        from_ (str, optional): スクレイピングする期間の開始（"2024-01-01"など）
+        to_ (str, optional): スクレイピングする期間の終了
+        jobs (int, optional): 同時に実行するステージ数
+        force (bool, optional): Trueなら最新かどうかに関係なく実行する
+        dry_run (bool, optional): Trueなら実行せず、各ステージを実行するかどうかだけ表示する
+        **params: ステージの関数に渡す引数（n_workers, incremental, batch_size, refresh, parquet, engine）。
+            各ステージのparamsにあるものだけ渡します
+
+    Returns:
+        dict: ステージ名 -> "ran", "skipped", "failed", "blocked"（前段が失敗したため未実行）
+    """
+    jobs = max(1, jobs)
+    options = {"from_": from_, "to_": to_, **params}
+    selected = [
+        stage for stage in STAGES
+        if (stages is None or stage.name in stages)
+        and (stage.name not in SCRAPE_STAGES or (from_ and to_))
+    ]
+    deps = {
+        stage.name: [other.name for other in selected[:i] if _depends_on(stage, other, options)]
+        for i, stage in enumerate(selected)
+    }
+    state = load_state()
+    status = {}
+    if dry_run:
+        for stage in selected:
+            up_to_date = not force and is_up_to_date(stage, options, state)
+            # 前段を実行するなら、その後段も実行されうる
+            if not up_to_date or any(status[dep] == "run" for dep in deps[stage.name]):
+                status[stage.name] = "run"
+            else:
+                status[stage.name] = "skip"
+            print(f"{status[stage.name]:>4}  {stage.name}")
+        return status
+
+    pending = list(selected)
+    running = {}
+    executor = ProcessPoolExecutor(
+        max_workers=jobs, mp_context=get_context("spawn"), max_tasks_per_child=1
+    )
+    try:
+        while pending or running:
+            held_locks = {lock for stage in running.values() for lock in stage.locks}
+            for stage in list(pending):
+                dep_status = [status.get(dep) for dep in deps[stage.name]]
+                if any(s in ("failed", "blocked") for s in dep_status):
+                    status[stage.name] = "blocked"
+                    print(f"Blocked: {stage.name}")
+                    pending.remove(stage)
+                    continue
+                if not all(s in ("ran", "skipped") for s in dep_status):
+                    continue
+                if len(running) >= jobs or held_locks & set(stage.locks):
+                    continue
+                pending.remove(stage)
+                # 取り直しは、入力が変わらなくてもサイト側の更新を取りに行くので常に実行する
+                refresh = stage.name == "scrape_html_horse" and options.get("refresh")
+                if not force and not refresh and is_up_to_date(stage, options, state):
+                    status[stage.name] = "skipped"
+                    print(f"Skip: {stage.name} is up to date")
+                    continue
+                kwargs = {
+                    param: options[param] for param in stage.params if options.get(param) is not None
+                }
+                print(f"Run: {stage.name}")
+                future = executor.submit(_run_stage, stage.module, stage.func, kwargs, stage.name)
+                running[future] = stage
+                held_locks |= set(stage.locks)
+            if not running:
+                # スキップしたステージの後段を、次のループで判定する
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    status[stage.name] = "failed"
+                    print(f"Error: {stage.name}")
+                    print(repr(e))
+                    continue
+                status[stage.name] = "ran"
+                state[stage.name] = {
+                    "inputs": input_signature(stage, options),
+                    "finished_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "seconds": round(seconds, 3),
+                }
+                save_state(state)
+                print(f"Done: {stage.name} ({seconds:.1f}s)")
+    finally:
+        executor.shutdown(cancel_futures=True)
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="スクレイピングからdfの作成までを、必要なステージだけ実行する")
+    parser.add_argument("--from", dest="from_", help="スクレイピングする期間の開始（例: 2024-01-01）")
+    parser.add_argument("--to", dest="to_", help="スクレイピングする期間の終了（例: 2025-01-31）")
+    parser.add_argument("--stages", nargs="+", choices=[stage.name for stage in STAGES])
+    parser.add_argument("--jobs", type=int, default=2)
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--n-workers", type=int)
+    parser.add_argument("--batch-size", type=int)
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--refresh", action="store_true", help="前回の取得以降に出走した馬のページを取り直す")
+    parser.add_argument("--parquet", action="store_true")
+    parser.add_argument("--engine", choices=["pandas", "polars"], help="dfのステージの変換の実装")
+    args = parser.parse_args()
+    status = run_pipeline(
+        stages=args.stages,
+        from_=args.from_,
+        to_=args.to_,
+        jobs=args.jobs,
+        force=args.force,
+        dry_run=args.dry_run,
+        n_workers=args.n_workers,
+        batch_size=args.batch_size,
+        incremental=args.incremental or None,
+        refresh=args.refresh or None,
+        parquet=args.parquet or None,
+        engine=args.engine,
+    )
+    if any(s in ("failed", "blocked") for s in status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
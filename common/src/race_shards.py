@@ -0,0 +1,146 @@
+import datetime
+import gzip
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from backtest import _umaban_array
+from id_dict import open_id_dictionary
+from metrics import metrics, stage
+
+DATA_DIR = Path("../data")
+DF_CSV_DIR = DATA_DIR / "df_csv"
+# フロントエンド（Next.js）の /api/races が読むディレクトリ
+RACE_SHARD_DIR = Path("../../front-end/public/data/races")
+INDEX_FILE_NAME = "index.json"
+
+# 1レースのファイルに入れる出走馬の列
+ENTRY_COLUMNS = [
+    "umaban", "wakuban", "horse_id", "horse_name", "jockey_name", "trainer_name",
+    "sex", "age", "impost", "weight", "weight_diff", "tansho_odds", "popularity", "rank",
+]
+INFO_COLUMNS = ["date", "place", "race_type", "around", "course_len", "weather", "ground_state", "race_class"]
+
+
+def _column_list(series):
+    """列をJSONにできるリストにする。NaNはnullにします"""
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def _race_slices(race_id):
+    """race_idの順に並んだ配列を、レースごとの (race_id, slice) に分ける"""
+    starts = np.flatnonzero(np.r_[True, race_id[1:] != race_id[:-1]])[: len(race_id)]
+    stops = np.r_[starts[1:], len(race_id)]
+    return {int(race_id[start]): slice(start, stop) for start, stop in zip(starts, stops)}
+
+
+def _load_entries():
+    df = pd.read_csv(DF_CSV_DIR / "df_race.csv", sep="\t")
+    df = df.sort_values(["race_id", "umaban"], kind="stable").reset_index(drop=True)
+    # 名前はdf_raceにはなく、ID辞書に入っている
+    df["horse_id"] = open_id_dictionary("horse").decode(df["horse_code"])
+    df["horse_name"] = open_id_dictionary("horse").lookup_name(df["horse_code"])
+    df["jockey_name"] = open_id_dictionary("jockey").lookup_name(df["jockey_code"])
+    df["trainer_name"] = open_id_dictionary("trainer").lookup_name(df["trainer_code"])
+    return df
+
+
+def _shard_bytes(race):
+    """1レース分の辞書を、区切りの空白を省いたJSONにしてgzipで圧縮する。mtimeを0にして、同じ中身なら同じバイト列にします"""
+    text = json.dumps(race, ensure_ascii=False, separators=(",", ":"))
+    return gzip.compress(text.encode("utf-8"), compresslevel=9, mtime=0)
+
+
+def load_index(output_dir=None):
+    output_dir = Path(output_dir) if output_dir else RACE_SHARD_DIR
+    try:
+        with open(output_dir / INDEX_FILE_NAME, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"races": {}, "dates": {}}
+
+
+@stage("race_shards")
+def export_race_shards(output_dir=None):
+    """
+    _関数の意味と使い方_
+    df_race, df_race_info, df_race_return（df.pyの出力）から、フロントエンドのAPI用に
+    レースごとのJSONファイル {race_id}.json.gz と、日付・開催場所の索引 index.json を書き出す関数です。
+    APIは1レースをファイル1つを読むだけで返せて、index.jsonのetagをそのままETagに使えます。
+
+    {race_id}.json.gz の中身:
+        race_id, info（日付・場所・コースなど）,
+        entries（出走馬。列名 -> 馬番順の値のリスト）,
+        payouts（[券種, 馬番の組み合わせ（整数のリスト）, 100円あたりの払い戻し] のリスト）
+
+    index.json の中身:
+        races: race_id -> {date, place, etag}
+        dates: 日付 -> 開催場所のコード -> race_idのリスト
+
+    前回と中身が同じレースのファイルは書き直さず、なくなったレースのファイルは削除します。
+
+    Args:
+        output_dir (str, optional): 書き出すディレクトリ。省略時はRACE_SHARD_DIR
+
+    Returns:
+        dict: index.jsonの中身
+    """
+    output_dir = Path(output_dir) if output_dir else RACE_SHARD_DIR
+    output_dir.mkdir(parents=True, exist_ok=True)
+    entries = _load_entries()
+    info = pd.read_csv(DF_CSV_DIR / "df_race_info.csv", sep="\t").drop_duplicates("race_id")
+    info = info.set_index("race_id")
+    payouts = pd.read_csv(DF_CSV_DIR / "df_race_return.csv", sep="\t")
+    payouts = payouts.sort_values("race_id", kind="stable").reset_index(drop=True)
+
+    # 列ごとに1回だけリストにして、レースごとにはスライスするだけにする
+    entry_lists = {column: _column_list(entries[column]) for column in ENTRY_COLUMNS}
+    entry_slices = _race_slices(entries["race_id"].to_numpy())
+    # 馬番の組み合わせは、0で埋めた (行数, 3) の配列から [7, 12] のような整数のリストにする
+    umaban_lists = [row[row > 0].tolist() for row in _umaban_array(payouts["win_umaban"])]
+    payout_rows = list(zip(payouts["bet_type"].tolist(), umaban_lists, payouts["return"].tolist()))
+    payout_slices = _race_slices(payouts["race_id"].to_numpy())
+    info_records = {
+        int(race_id): dict(zip(INFO_COLUMNS, values))
+        for race_id, values in zip(
+            info.index, zip(*[_column_list(info[column]) for column in INFO_COLUMNS])
+        )
+    }
+
+    old_index = load_index(output_dir)
+    index = {"generated_at": datetime.datetime.now().isoformat(timespec="seconds"), "races": {}, "dates": {}}
+    n_written = 0
+    for race_id, entry_slice in entry_slices.items():
+        race_info = info_records.get(race_id)
+        if race_info is None:
+            continue
+        race = {
+            "race_id": str(race_id),
+            "info": race_info,
+            "entries": {column: values[entry_slice] for column, values in entry_lists.items()},
+            "payouts": payout_rows[payout_slices[race_id]] if race_id in payout_slices else [],
+        }
+        data = _shard_bytes(race)
+        etag = hashlib.sha1(data).hexdigest()
+        key = str(race_id)
+        shard_path = output_dir / f"{key}.json.gz"
+        if old_index["races"].get(key, {}).get("etag") != etag or not shard_path.exists():
+            tmp_path = shard_path.with_suffix(".tmp")
+            tmp_path.write_bytes(data)
+            tmp_path.replace(shard_path)
+            n_written += 1
+        index["races"][key] = {"date": race_info["date"], "place": race_info["place"], "etag": etag}
+        index["dates"].setdefault(race_info["date"], {}).setdefault(str(race_info["place"]), []).append(key)
+    index["dates"] = dict(sorted(index["dates"].items()))
+    for key in old_index["races"].keys() - index["races"].keys():
+        (output_dir / f"{key}.json.gz").unlink(missing_ok=True)
+
+    tmp_path = output_dir / (INDEX_FILE_NAME + ".tmp")
+    tmp_path.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    tmp_path.replace(output_dir / INDEX_FILE_NAME)
+    metrics.incr("race_shards_written_total", n_written)
+    metrics.set_gauge("rows", len(index["races"]), file=INDEX_FILE_NAME)
+    return index
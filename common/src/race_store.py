@@ -0,0 +1,310 @@
+import datetime
+import json
+import shutil
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from df import DF_SCHEMAS
+from id_dict import normalize_ids, open_id_dictionary
+from metrics import metrics, stage
+
+DATA_DIR = Path("../data")
+DF_CSV_DIR = DATA_DIR / "df_csv"
+RACE_STORE_DIR = DATA_DIR / "race_store"
+SCHEMA_FILE_NAME = "schema.json"
+
+# 出走馬ごとの列（race_id・馬番の順に並べて保存します）。horse_id, jockey_idはID辞書で戻した元のID（文字列）
+ENTRY_COLUMNS = [
+    "race_id", "horse_id", "jockey_id", "horse_code", "jockey_code", "trainer_code",
+    "rank", "umaban", "wakuban", "tansho_odds", "popularity", "impost", "sex", "age", "weight", "weight_diff",
+    "date", "place",
+]
+# レースごとの列（race_idの順）
+RACE_COLUMNS = [
+    "race_id", "date", "place", "race_type", "around", "course_len", "weather", "ground_state", "race_class",
+    "n_horses",
+]
+# NaNがありうる整数の列は、-1を欠損値として整数のまま保存します
+NA_VALUE = -1
+# 索引の名前 -> (索引を作る列, 同じキーの中で並べる列)
+ENTRY_INDEXES = {
+    "horse": ("horse_id", ["date", "race_id"]),
+    "jockey": ("jockey_id", ["date", "race_id"]),
+}
+
+
+def _read_df_csv(name):
+    # floatはdf_csvの値が変わらないようにfloat64のまま読む
+    schema = DF_SCHEMAS[name]
+    dtype = {column: t for column, t in schema.items() if not t.startswith(("datetime", "float"))}
+    parse_dates = [column for column, t in schema.items() if t.startswith("datetime")]
+    return pd.read_csv(DF_CSV_DIR / f"{name}.csv", sep="\t", dtype=dtype, parse_dates=parse_dates)
+
+
+def _date_value(date):
+    """日付（"2024-12-28"やTimestamp）を、entry_dateと比べられるdatetime64にする"""
+    return np.datetime64(pd.Timestamp(date), "ns")
+
+
+def _date_key(date):
+    """日付を、日付・場所の索引に使う整数 YYYYMMDD にする"""
+    return int(pd.Timestamp(date).strftime("%Y%m%d"))
+
+
+def _to_numpy(series):
+    """
+    nullableな整数の列は欠損値をNA_VALUEにする。
+    文字列の列（horse_idなど）はmmapで読めるように固定長の文字列の配列にする
+    """
+    if isinstance(series.dtype, pd.api.extensions.ExtensionDtype) and series.dtype.kind in "iu":
+        return series.to_numpy(dtype=series.dtype.numpy_dtype, na_value=NA_VALUE)
+    if series.dtype == object:
+        # idがない行（ID辞書でNone）は空文字にする
+        return series.fillna("").to_numpy(dtype=str)
+    return series.to_numpy()
+
+
+def _key_index(keys):
+    """
+    並んだキーの配列から、重複のないキーと各キーの先頭の位置（最後に全体の長さ）を作る。
+    キーkの行は offsets[i]:offsets[i+1]（iはkeysでのkの位置）です。
+    """
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])[: len(keys)]
+    return keys[starts], np.r_[starts, len(keys)].astype(np.int64)
+
+
+@stage("race_store")
+def build_race_store(output_dir=None):
+    """
+    _関数の意味と使い方_
+    df_race, df_race_info（df.pyの出力）から、RaceStoreで読む列ごとの配列と索引を
+    output_dir（省略時はRACE_STORE_DIR）に書き出す関数です。
+    出走馬はrace_id・馬番の順に並べるので、1レースの馬は連続した行になります。
+    レース情報がない出走は除きます。
+
+    書き出すファイル（すべて.npy）:
+        entry_{列}: 出走馬ごとの列。整数の列の欠損値は-1
+        race_{列}: レースごとの列（race_idの順）。race_offsetsはレースの先頭行（最後に行数）
+        {horse,jockey}_keys, _offsets, _rows: IDごとの出走の行番号。行は日付・race_idの順
+        date_place_keys, _offsets, _races: 日付YYYYMMDD*100+場所コードごとのレースの番号
+        schema.json: 各列の型、行数・レース数
+
+    前回の出力はすべて書き終わってから置き換えるので、開いているRaceStoreは前回のファイルを読み続けられます。
+
+    Returns:
+        Path: 書き出したディレクトリ
+    """
+    output_dir = Path(output_dir) if output_dir else RACE_STORE_DIR
+    entries = _read_df_csv("df_race")
+    race_info = _read_df_csv("df_race_info").drop_duplicates("race_id")
+    # 出走馬のいないレースは除く。頭数はdf_race_infoのn_horses（着順のない馬も含めて数えたもの）を使う
+    race_info = race_info[race_info["race_id"].isin(entries["race_id"])]
+    entries = entries.merge(race_info[["race_id", "date"]], on="race_id", how="inner")
+    entries = entries.sort_values(["race_id", "umaban"], kind="stable").reset_index(drop=True)
+    # 場所はdf_race_info_csvと同じく、race_idの5・6桁目
+    entries["place"] = (entries["race_id"] // 10**6 % 100).astype("int8")
+    entries["horse_id"] = open_id_dictionary("horse").decode(entries["horse_code"])
+    entries["jockey_id"] = open_id_dictionary("jockey").decode(entries["jockey_code"])
+    race_info = race_info.sort_values("race_id", kind="stable").reset_index(drop=True)
+
+    tmp_dir = output_dir.with_name(output_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    columns = {}
+    for prefix, table, names in [("entry", entries, ENTRY_COLUMNS), ("race", race_info, RACE_COLUMNS)]:
+        for column in names:
+            values = _to_numpy(table[column])
+            np.save(tmp_dir / f"{prefix}_{column}.npy", values)
+            columns[f"{prefix}_{column}"] = {
+                "dtype": str(values.dtype),
+                "nullable": isinstance(table[column].dtype, pd.api.extensions.ExtensionDtype),
+            }
+    race_keys, race_offsets = _key_index(entries["race_id"].to_numpy())
+    # entriesとrace_infoは同じrace_idの集合なので、レースの番号は両方で同じです
+    assert np.array_equal(race_keys, race_info["race_id"].to_numpy())
+    np.save(tmp_dir / "race_offsets.npy", race_offsets)
+
+    for name, (key_column, order_columns) in ENTRY_INDEXES.items():
+        rows = np.lexsort(
+            [_to_numpy(entries[column]) for column in reversed(order_columns)] + [_to_numpy(entries[key_column])]
+        )
+        keys, offsets = _key_index(_to_numpy(entries[key_column])[rows])
+        np.save(tmp_dir / f"{name}_keys.npy", keys)
+        np.save(tmp_dir / f"{name}_offsets.npy", offsets)
+        np.save(tmp_dir / f"{name}_rows.npy", rows.astype(np.int64))
+
+    date_place = race_info["date"].dt.strftime("%Y%m%d").astype("int64").to_numpy() * 100
+    date_place = date_place + race_info["place"].to_numpy()
+    races = np.argsort(date_place, kind="stable")
+    keys, offsets = _key_index(date_place[races])
+    np.save(tmp_dir / "date_place_keys.npy", keys)
+    np.save(tmp_dir / "date_place_offsets.npy", offsets)
+    np.save(tmp_dir / "date_place_races.npy", races.astype(np.int64))
+
+    schema = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "n_rows": len(entries),
+        "n_races": len(race_info),
+        "na_value": NA_VALUE,
+        "columns": columns,
+    }
+    with open(tmp_dir / SCHEMA_FILE_NAME, "w", encoding="utf-8") as f:
+        json.dump(schema, f, ensure_ascii=False, indent=2)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    tmp_dir.replace(output_dir)
+    metrics.set_gauge("rows", len(entries), file="race_store")
+    return output_dir
+
+
+class RaceStore:
+    """
+    _クラスの意味と使い方_
+    build_race_storeで書き出した配列を使って、レース・馬・騎手・日付と場所から出走を引くクラスです。
+    配列はすべてメモリマップで開くだけで、読み込むのは引いた行のページだけです。
+    開いた時点のファイルを使い続けるので、build_race_storeで作り直しても前後のファイルが混ざりません。
+    キーは並べた配列の二分探索で引き、行はoffsetsで切り出すので、df_csvを毎回絞り込むより速く答えられます。
+
+    *_rowsや*_idsは索引だけを引いて行番号やIDの配列を返します。
+    race, horse_history, jockey_rides, races_onは組み立てたDataFrameを返し、結果を引数ごとにLRUキャッシュします。
+    キャッシュした結果は同じオブジェクトを返すので、書き換える場合はコピーしてください。
+
+    Example:
+        store = RaceStore()
+        store.race(202406050811)
+        store.horse_history(2019104308, n=10)
+        store.jockey_rides("01170", date="2024-12-28")
+        store.races_on("2024-12-28", place=6)
+    """
+
+    def __init__(self, directory=None, cache_size=1024):
+        self.directory = Path(directory) if directory else RACE_STORE_DIR
+        with open(self.directory / SCHEMA_FILE_NAME, encoding="utf-8") as f:
+            self.schema = json.load(f)
+        self._arrays = {
+            path.stem: np.load(path, mmap_mode="r") for path in sorted(self.directory.glob("*.npy"))
+        }
+        self.race = lru_cache(maxsize=cache_size)(self._race)
+        self.horse_history = lru_cache(maxsize=cache_size)(self._horse_history)
+        self.jockey_rides = lru_cache(maxsize=cache_size)(self._jockey_rides)
+        self.races_on = lru_cache(maxsize=cache_size)(self._races_on)
+
+    def __len__(self):
+        return self.schema["n_rows"]
+
+    @property
+    def n_races(self):
+        return self.schema["n_races"]
+
+    def _array(self, name):
+        return self._arrays[name]
+
+    def _lookup(self, name, key):
+        """索引nameでkeyの位置 (start, stop) を引く。keyがなければ (0, 0)"""
+        if key is None:
+            return 0, 0
+        keys = self._array(f"{name}_keys")
+        i = np.searchsorted(keys, key)
+        if i == len(keys) or keys[i] != key:
+            return 0, 0
+        offsets = self._array(f"{name}_offsets")
+        return int(offsets[i]), int(offsets[i + 1])
+
+    def _race_index(self, race_id):
+        # race_idは文字列（"202401010101"）で渡されてもint64の配列と比べられるように整数にする
+        race_id = int(race_id)
+        race_ids = self._array("race_race_id")
+        i = int(np.searchsorted(race_ids, race_id))
+        return i if i < len(race_ids) and race_ids[i] == race_id else None
+
+    def race_rows(self, race_id):
+        """race_idの出走の行（馬番順）。レースがなければ空のslice"""
+        i = self._race_index(race_id)
+        if i is None:
+            return slice(0, 0)
+        offsets = self._array("race_offsets")
+        return slice(int(offsets[i]), int(offsets[i + 1]))
+
+    def horse_rows(self, horse_id):
+        """horse_idの出走の行番号（日付の古い順）"""
+        start, stop = self._lookup("horse", normalize_ids("horse", [horse_id])[0])
+        return self._array("horse_rows")[start:stop]
+
+    def jockey_rows(self, jockey_id, date=None):
+        """jockey_idの騎乗の行番号（日付の古い順）。dateを指定するとその日の騎乗だけ"""
+        start, stop = self._lookup("jockey", normalize_ids("jockey", [jockey_id])[0])
+        rows = self._array("jockey_rows")[start:stop]
+        if date is not None:
+            # 行は日付順なので、その日の範囲も二分探索で引ける
+            dates = self._array("entry_date")[rows]
+            value = _date_value(date)
+            rows = rows[np.searchsorted(dates, value): np.searchsorted(dates, value, side="right")]
+        return rows
+
+    def race_ids_on(self, date, place=None):
+        """dateに行われたレースのrace_id。placeを指定するとその場所のレースだけ"""
+        keys = self._array("date_place_keys")
+        key = _date_key(date) * 100
+        if place is None:
+            first, last = np.searchsorted(keys, [key, key + 100])
+        else:
+            first = np.searchsorted(keys, key + place)
+            last = first + 1 if first < len(keys) and keys[first] == key + place else first
+        offsets = self._array("date_place_offsets")
+        races = self._array("date_place_races")[offsets[first]: offsets[last]]
+        return np.sort(self._array("race_race_id")[races])
+
+    def _frame(self, prefix, rows, columns):
+        """行番号（sliceか配列）の行を、列ごとの配列から読んでDataFrameにする"""
+        data = {}
+        for column in columns:
+            values = np.array(self._array(f"{prefix}_{column}")[rows])
+            if self.schema["columns"][f"{prefix}_{column}"]["nullable"]:
+                values = pd.arrays.IntegerArray(values, values == NA_VALUE)
+            data[column] = values
+        # 配列はmmapから切り出したコピーなので、DataFrameを作るときにもう一度コピーしない
+        return pd.DataFrame(data, copy=False)
+
+    def _race(self, race_id):
+        return self._frame("entry", self.race_rows(race_id), ENTRY_COLUMNS)
+
+    def race_info(self, race_id):
+        """race_idのレース情報（日付・場所・コースなど）の辞書。レースがなければNone"""
+        i = self._race_index(race_id)
+        if i is None:
+            return None
+        return self._frame("race", [i], RACE_COLUMNS).iloc[0].to_dict()
+
+    def _horse_history(self, horse_id, n=None, before=None):
+        """
+        horse_idの出走を新しい順に返す。
+        nを指定すると直近n走だけ、beforeを指定するとその日付より前の出走だけを返します。
+        """
+        rows = self.horse_rows(horse_id)
+        if before is not None:
+            rows = rows[: np.searchsorted(self._array("entry_date")[rows], _date_value(before))]
+        rows = rows[::-1][:n]
+        return self._frame("entry", rows, ENTRY_COLUMNS)
+
+    def _jockey_rides(self, jockey_id, date=None):
+        """jockey_idの騎乗を日付・race_idの順に返す。dateを指定するとその日の騎乗だけ"""
+        return self._frame("entry", self.jockey_rows(jockey_id, date), ENTRY_COLUMNS)
+
+    def _races_on(self, date, place=None):
+        """dateに行われたレースの情報を返す。placeを指定するとその場所のレースだけ"""
+        race_ids = self.race_ids_on(date, place)
+        races = np.searchsorted(self._array("race_race_id"), race_ids)
+        return self._frame("race", races, RACE_COLUMNS)
+
+    def cache_info(self):
+        """メソッドごとのLRUキャッシュの状態（hits, misses, maxsize, currsize）"""
+        return {
+            name: getattr(self, name).cache_info()
+            for name in ["race", "horse_history", "jockey_rides", "races_on"]
+        }
+
+    def clear_cache(self):
+        for name in ["race", "horse_history", "jockey_rides", "races_on"]:
+            getattr(self, name).cache_clear()
@@ -1,5 +1,7 @@
+import importlib.util
 import os
 import pickle
+import datetime
 import time
 import re
 import traceback
@@ -8,9 +10,11 @@ from tqdm.notebook import tqdm
 from urllib.request import Request, urlopen
 from bs4 import BeautifulSoup
 from pathlib import Path
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
+from concurrent.futures import ThreadPoolExecutor
+
+from archive import ARCHIVE_HORSE_DIR, ARCHIVE_RACE_DIR, open_archive
+from fetch import Fetcher
+from metrics import metrics, stage
 
 
 # ディレクトリの設定（pathlib を使用）
@@ -22,12 +26,19 @@ HTML_DIR = DATA_DIR / "html"
 HTML_RASE_DIR = HTML_DIR / "race"
 HTML_HORSE_DIR = HTML_DIR / "horse"
 RAW_CSV_DIR = DATA_DIR / "csv"
+# create_rawが出力するCSVのディレクトリ（馬の最後の出走日を調べるのに使う）
+RAW_RACE_CSV_DIR = DATA_DIR / "raw_csv"
+FETCH_LOG_DIR = DATA_DIR / "fetch_log"
+# 月 -> 開催日のリスト、開催日 -> race_idのリストのキャッシュ
+KAISAI_DATE_CACHE_FILE = "kaisai_date_by_month.pickle"
+RACE_ID_CACHE_FILE = "race_id_by_kaisai_date.pickle"
 
 KAISAI_DATE_DIR.mkdir(parents=True, exist_ok=True)
 RACE_ID_DIR.mkdir(parents=True, exist_ok=True)
 HTML_RASE_DIR.mkdir(parents=True, exist_ok=True)
-HTML_RASE_DIR.mkdir(parents=True, exist_ok=True)
+HTML_HORSE_DIR.mkdir(parents=True, exist_ok=True)
 RAW_CSV_DIR.mkdir(parents=True, exist_ok=True)
+FETCH_LOG_DIR.mkdir(parents=True, exist_ok=True)
 
 
 def save_data(data, file_name, directory: Path):
@@ -40,90 +51,318 @@ def load_data(file_name, directory: Path):
         return pickle.load(f)
 
 
+def load_fetch_log(kind):
+    """
+    ページの種類（"horse"など）ごとの取得記録を読み込む。
+    取得記録はid -> {"fetched_at": 取得日時, "etag": ETag, "last_modified": Last-Modified} の辞書です。
+    """
+    try:
+        return load_data(f"{kind}_fetch_log.pickle", FETCH_LOG_DIR)
+    except FileNotFoundError:
+        return {}
+
+
+def save_fetch_log(fetch_log, kind):
+    save_data(fetch_log, f"{kind}_fetch_log.pickle", FETCH_LOG_DIR)
+
+
+def _response_header(response, name):
+    for key, value in response.headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def _conditional_headers(entry):
+    """前回の取得記録から、条件付きリクエストのヘッダーを作る"""
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def download_html(url_path_list, fetcher=None, archive=None, fetch_log=None):
+    """
+    _関数の意味と使い方_
+    (url, 保存先のパス) のリストを受け取り、Fetcherで並行して取得してbinファイルに保存する関数です。
+    レート制限・リトライ・接続の使い回しはFetcherが行います。
+    書き込み途中のファイルが残らないよう、一時ファイルに書いてから置き換えます。
+    archive（PageArchive）を渡すと、binファイルの代わりに保存先のファイル名（stem）をidとしてアーカイブに追記します。
+    取得に失敗したURLはエラーを表示してスキップし、リストで返します。
+    取得・失敗したページ数は保存先のディレクトリ名（race, horse）ごとにmetricsに記録します。
+    fetch_log（load_fetch_logの戻り値）を渡すと、保存済みのページには前回のETag, Last-Modifiedで
+    条件付きリクエストを送り、304（変更なし）なら保存済みのページをそのまま使います。
+    取得日時とサーバーが返したETag, Last-Modifiedはfetch_logに記録します。
+    """
+    fetcher = fetcher or Fetcher()
+    path_dict = dict(url_path_list)
+    url_headers = {}
+    if fetch_log is not None:
+        for url, html_file_path in path_dict.items():
+            entry = fetch_log.get(html_file_path.stem)
+            stored = html_file_path.exists() or (archive is not None and html_file_path.stem in archive)
+            if entry and stored:
+                url_headers[url] = _conditional_headers(entry)
+    failed_url_list = []
+    responses = fetcher.fetch_many(path_dict, url_headers=url_headers)
+    for url, response, error in tqdm(responses, total=len(path_dict)):
+        html_file_path = path_dict[url]
+        if error is not None:
+            print(f"Error: {url}")
+            print(error)
+            metrics.incr("pages_failed_total", kind=html_file_path.parent.name)
+            failed_url_list.append(url)
+            continue
+        if fetch_log is not None:
+            entry = fetch_log.setdefault(html_file_path.stem, {})
+            entry["fetched_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+            if response.status != 304:
+                entry["etag"] = _response_header(response, "ETag")
+                entry["last_modified"] = _response_header(response, "Last-Modified")
+        if response.status == 304:
+            metrics.incr("pages_not_modified_total", kind=html_file_path.parent.name)
+            continue
+        metrics.incr("pages_downloaded_total", kind=html_file_path.parent.name)
+        if archive is not None:
+            archive.put(html_file_path.stem, response.body)
+            continue
+        tmp_file_path = html_file_path.with_suffix(".tmp")
+        # ファイルに書き込み（書き込みモード "wb" を使用）
+        with open(tmp_file_path, "wb") as f:
+            f.write(response.body)
+        tmp_file_path.replace(html_file_path)
+    if archive is not None:
+        archive.flush()
+    return failed_url_list
+
+
+def _load_cache(file_name, directory):
+    try:
+        return load_data(file_name, directory)
+    except FileNotFoundError:
+        return {}
+
+
+def _date_range(from_, to_):
+    """
+    from_, to_（"2024-01"のような月でも"2024-01-15"のような日付でも可）を、
+    両端を含む日付の範囲 (開始日, 終了日) にする。月だけの場合はその月の初日・末日になります。
+    """
+    return (
+        pd.Period(from_).start_time.normalize(),
+        pd.Period(to_).end_time.normalize(),
+    )
+
+
+def _scrape_calendar_month(year, month):
+    """netkeiba.comのカレンダーページから、その月の開催日（"YYYYMMDD"）のリストを取得する"""
+    url = f"https://race.netkeiba.com/top/calendar.html?year={year}&month={month}"
+    req = Request(url, headers={"User-Agent": "Mozilla/5.0"})
+    html = urlopen(req).read()
+    time.sleep(1)
+    soup = BeautifulSoup(html, "lxml")
+    a_list = soup.find("table", class_="Calendar_Table").find_all("a")
+    return [re.findall(r"kaisai_date=(\d{8})", a["href"])[0] for a in a_list]
+
+
+@stage("scrape_kaisai_date")
 def scrape_kaisai_date(from_, to_):
     """
     _関数の意味と使い方_
     この関数は、指定した期間の開催日を取得する関数です。
     開催日は、netkeiba.comのカレンダーページから取得します。
-    この関数は、指定した期間の開催日をリストで返して保存します。
-    すでに保存されている場合は、保存されたデータを読み込みます。
-    tryでは、保存されたデータを読み込みます。読み込めない場合は、exceptに移動します。
+    取得した開催日は月ごとにKAISAI_DATE_CACHE_FILEにキャッシュし、
+    期間が前回と重なっていても、キャッシュにない月のカレンダーだけを取得します。
+    まだ終わっていない月（今月・来月以降）は開催日が増えることがあるのでキャッシュせず、毎回取得します。
+    この関数は、指定した期間の開催日をリストで返し、今まで通り期間ごとのpklファイルにも保存します。
+
+    Args:
+        from_ (str): 期間の開始。"2024-01"のような月か、"2024-01-15"のような日付
+        to_ (str): 期間の終了（その日・その月を含む）
     """
-    file_name = f"kaisai_date_list[{from_}_to_{to_}].pkl"
+    start, end = _date_range(from_, to_)
+    this_month = pd.Timestamp.today().to_period("M")
+    month_cache = _load_cache(KAISAI_DATE_CACHE_FILE, KAISAI_DATE_DIR)
+    kaisai_date_list = []
     try:
-        kaisai_date_list = load_data(file_name, KAISAI_DATE_DIR)
-    except Exception as e:
-        kaisai_date_list = []
-        for date in tqdm(pd.date_range(from_, to_, freq="MS")):
-            year = date.year
-            month = date.month
-            url = (
-                f"https://race.netkeiba.com/top/calendar.html?year={year}&month={month}"
-            )
-            req = Request(url, headers={"User-Agent": "Mozilla/5.0"})
-            html = urlopen(req).read()
-            time.sleep(1)
-            soup = BeautifulSoup(html, "lxml")
-            a_list = soup.find("table", class_="Calendar_Table").find_all("a")
-            for a in a_list:
-                kaisai_date = re.findall(r"kaisai_date=(\d{8})", a["href"])[0]
-                kaisai_date_list.append(kaisai_date)
-        save_data(kaisai_date_list, file_name, KAISAI_DATE_DIR)
+        for month in tqdm(pd.period_range(start, end, freq="M")):
+            key = str(month)
+            if key in month_cache:
+                metrics.incr("cache_hits_total", cache="kaisai_date")
+            else:
+                metrics.incr("cache_misses_total", cache="kaisai_date")
+                month_date_list = _scrape_calendar_month(month.year, month.month)
+                if month < this_month:
+                    month_cache[key] = month_date_list
+                else:
+                    kaisai_date_list.extend(month_date_list)
+                    continue
+            kaisai_date_list.extend(month_cache[key])
+    finally:
+        save_data(month_cache, KAISAI_DATE_CACHE_FILE, KAISAI_DATE_DIR)
+    start, end = start.strftime("%Y%m%d"), end.strftime("%Y%m%d")
+    kaisai_date_list = [date for date in kaisai_date_list if start <= date <= end]
+    save_data(kaisai_date_list, f"kaisai_date_list[{from_}_to_{to_}].pkl", KAISAI_DATE_DIR)
     return kaisai_date_list
 
 
-def scrape_race_id_list(from_, to_, kaisai_date_list=None):
+def _parse_race_id_list(html):
+    """レース一覧のhtmlから、.RaceList_DataItemごとに最初のリンクのrace_idを取り出す"""
+    soup = BeautifulSoup(html, "lxml")
+    race_id_list = []
+    for li in soup.select(".RaceList_DataItem"):
+        a = li.find("a", href=True)
+        if a is None:
+            continue
+        race_id = re.findall(r"race_id=(\d{12})", a["href"])
+        if race_id:
+            race_id_list.append(race_id[0])
+    return race_id_list
+
+
+def scrape_race_id_dict_http(kaisai_date_list, fetcher=None):
+    """
+    _関数の意味と使い方_
+    ブラウザを使わずに、開催日ごとのレースIDを取得する関数です。
+    race_list.htmlはJavaScriptで中身を読み込んでいるので、
+    その読み込み先のrace_list_sub.htmlを直接取得してパースします。
+    複数の開催日をFetcherで並行して取得します。
+
+    Returns:
+        dict: 開催日 -> レースIDのリスト。取得に失敗した開催日は含まれません。
+    """
+    fetcher = fetcher or Fetcher()
+    date_dict = {
+        f"https://race.netkeiba.com/top/race_list_sub.html?kaisai_date={kaisai_date}": kaisai_date
+        for kaisai_date in kaisai_date_list
+    }
+    race_id_dict = {}
+    for url, response, error in tqdm(fetcher.fetch_many(date_dict), total=len(date_dict)):
+        if error is not None:
+            print(f"Error: {date_dict[url]}")
+            print(error)
+            continue
+        race_id_dict[date_dict[url]] = _parse_race_id_list(response.body)
+    return race_id_dict
+
+
+def _scrape_race_id_dict_with_driver(kaisai_date_list):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.by import By
+
+    options = Options()
+    options.add_argument("--headless")
+    race_id_dict = {}
+    with webdriver.Chrome(options=options) as driver:
+        for kaisai_date in kaisai_date_list:
+            url = f"https://race.netkeiba.com/top/race_list.html?kaisai_date={kaisai_date}"
+            try:
+                driver.get(url)
+                time.sleep(1)
+                li_list = driver.find_elements(
+                    By.CSS_SELECTOR, ".RaceList_DataItem"
+                )
+                race_id_list = []
+                for li in li_list:
+                    href = li.find_element(By.TAG_NAME, "a").get_attribute("href")
+                    race_id = re.findall(r"race_id=(\d{12})", href)[0]
+                    race_id_list.append(race_id)
+                race_id_dict[kaisai_date] = race_id_list
+            except:
+                print(f"Error: {kaisai_date}")
+                print(traceback.format_exc())
+    return race_id_dict
+
+
+def selenium_available():
+    """seleniumがインストールされていて、Seleniumでの取得を使えるかどうか"""
+    return importlib.util.find_spec("selenium") is not None
+
+
+def scrape_race_id_dict_selenium(kaisai_date_list, n_drivers=1):
+    """
+    _関数の意味と使い方_
+    ヘッドレスChromeで開催日ごとのレースIDを取得する関数です。
+    JavaScriptを実行しないと取れないページ用です。
+    開催日をn_drivers個に分けて、それぞれ別のChromeで並行して取得します。
+
+    Returns:
+        dict: 開催日 -> レースIDのリスト。取得に失敗した開催日は含まれません。
+    """
+    n_drivers = max(1, min(n_drivers, len(kaisai_date_list)))
+    chunks = [kaisai_date_list[i::n_drivers] for i in range(n_drivers)]
+    race_id_dict = {}
+    with ThreadPoolExecutor(max_workers=n_drivers) as executor:
+        for chunk_dict in executor.map(_scrape_race_id_dict_with_driver, chunks):
+            race_id_dict.update(chunk_dict)
+    return race_id_dict
+
+
+@stage("scrape_race_id_list")
+def scrape_race_id_list(
+    from_, to_, kaisai_date_list=None, mode="http", fetcher=None, n_drivers=1, selenium_fallback=True
+):
     """
     _関数の意味と使い方_
     この関数は、指定した期間の開催日のレースIDを取得する関数です。
     開催日のレースIDは、netkeiba.comのレース一覧ページから取得します。
     この関数は、指定した期間の開催日のレースIDをリストで返して保存します。
-    すでに保存されている場合は、保存されたデータを読み込みます。
-    開催日は既存のデータを使用します。
-    既存のデータがない場合は、scrape_kaisai_date関数を使用して取得します。
+    レースIDは開催日ごとにRACE_ID_CACHE_FILEにキャッシュし、キャッシュにない開催日だけを取得します。
+    期間を1週間延ばした場合は、増えた開催日の分だけ取得します。
+    開催日はkaisai_date_listを渡さなければ、scrape_kaisai_date関数で取得します（こちらも月ごとのキャッシュを使います）。
+
+    開催日はカレンダーにある日なので、httpで取得したレース一覧が空なら、ページがJavaScriptで
+    描画されていて取れなかったものとして、取得に失敗した開催日と一緒にSeleniumで取り直します。
+    それでも空だった開催日（まだ発表されていない日など）は、次回取り直すのでキャッシュしません。
+
+    Args:
+        mode (str, optional): "http"ならブラウザを使わずに取得します。
+            "selenium"なら今まで通りすべてSeleniumで取得します。
+        fetcher (Fetcher, optional): mode="http"で使うFetcher
+        n_drivers (int, optional): Seleniumで同時に動かすChromeの数
+        selenium_fallback (bool, optional): mode="http"で取得に失敗した・レース一覧が空だった開催日を、
+            Seleniumで取り直すかどうか。seleniumがインストールされていない場合は取り直さずに、その開催日を表示します。
     """
-    kaisai_date_list_file = f"kaisai_date_list[{from_}_to_{to_}].pkl"
-    race_id_list_file = f"race_id_list[{from_}_to_{to_}].pkl"
+    if kaisai_date_list is None:
+        kaisai_date_list = scrape_kaisai_date(from_, to_)
 
-    try:
-        kaisai_date_list = load_data(kaisai_date_list_file, KAISAI_DATE_DIR)
-    except Exception as e:
-        print(
-            "kaisai_date_list が見つからなかったので、scrape_kaisai_date を呼び出します。"
+    # 開催日ごとのキャッシュにない開催日だけを取得する
+    race_id_cache = _load_cache(RACE_ID_CACHE_FILE, RACE_ID_DIR)
+    rest_date_list = [kaisai_date for kaisai_date in kaisai_date_list if kaisai_date not in race_id_cache]
+    metrics.incr("cache_hits_total", len(kaisai_date_list) - len(rest_date_list), cache="race_id")
+    metrics.incr("cache_misses_total", len(rest_date_list), cache="race_id")
+
+    def update_cache(race_id_dict):
+        # レース一覧がまだ出ていない開催日は、次回取り直すのでキャッシュしない
+        race_id_cache.update(
+            {kaisai_date: race_id_list for kaisai_date, race_id_list in race_id_dict.items() if race_id_list}
         )
-        # ここで外部関数 scrape_kaisai_date を呼び出す
-        kaisai_date_list = scrape_kaisai_date(from_, to_)
+        save_data(race_id_cache, RACE_ID_CACHE_FILE, RACE_ID_DIR)
 
-    try:
-        race_id_list = load_data(race_id_list_file, RACE_ID_DIR)
+    if rest_date_list and mode == "http":
+        race_id_dict = scrape_race_id_dict_http(rest_date_list, fetcher)
+        # Seleniumで取り直す前に、httpで取れた分を保存しておく
+        update_cache(race_id_dict)
+        failed_date_list = [kaisai_date for kaisai_date in rest_date_list if not race_id_dict.get(kaisai_date)]
+        if failed_date_list and selenium_fallback and selenium_available():
+            update_cache(scrape_race_id_dict_selenium(failed_date_list, n_drivers))
+        elif failed_date_list:
+            print(f"取得できなかった開催日: {failed_date_list}")
+    elif rest_date_list:
+        update_cache(scrape_race_id_dict_selenium(rest_date_list, n_drivers))
 
-    except Exception as e:
-        options = Options()
-        options.add_argument("--headless")
-        race_id_list = []
-
-        with webdriver.Chrome(options=options) as driver:
-            for kaisai_date in tqdm(kaisai_date_list):
-                url = f"https://race.netkeiba.com/top/race_list.html?kaisai_date={kaisai_date}"
-                try:
-                    driver.get(url)
-                    time.sleep(1)
-                    li_list = driver.find_elements(
-                        By.CSS_SELECTOR, ".RaceList_DataItem"
-                    )
-                    for li in li_list:
-                        href = li.find_element(By.TAG_NAME, "a").get_attribute("href")
-                        race_id = re.findall(r"race_id=(\d{12})", href)[0]
-                        race_id_list.append(race_id)
-                except:
-                    print(f"Error: {race_id}")
-                    print(traceback.format_exc())
-            save_data(race_id_list, race_id_list_file, RACE_ID_DIR)
-        return race_id_list
+    race_id_list = []
+    for kaisai_date in kaisai_date_list:
+        race_id_list.extend(race_id_cache.get(kaisai_date, []))
+    save_data(race_id_list, f"race_id_list[{from_}_to_{to_}].pkl", RACE_ID_DIR)
     return race_id_list
 
 
-def scrape_html_race(from_, to_, race_id_list=None):
+@stage("scrape_html_race")
+def scrape_html_race(from_, to_, race_id_list=None, fetcher=None, archive=False):
     """
     _関数の意味と使い方_
     この関数は、指定した期間のレースIDのHTMLを取得する関数です。
@@ -131,9 +370,11 @@ def scrape_html_race(from_, to_, race_id_list=None):
     この関数は、指定した期間のレースIDのHTMLをbinファイルで保存します。
     レースIDは既存のデータを使用します。
     既存のデータがない場合は、scrape_race_id_list関数を使用して取得します。
-    すでにbinファイルが存在する場合は、スキップします。
+    すでにbinファイルが存在する場合は、スキップします（スキップした数はmetricsに記録します）。
     存在しない場合は、取得して保存します。
     horse_idはhorse_id_list.pickleから取得します。
+    fetcherを渡すと、そのレート制限・同時接続数で取得します（省略時はFetcher()）。
+    archiveがTrueなら、binファイルではなくアーカイブ（ARCHIVE_*_DIR）に追記します。
     """
     race_id_list_file = f"race_id_list[{from_}_to_{to_}].pkl"
 
@@ -143,45 +384,118 @@ def scrape_html_race(from_, to_, race_id_list=None):
         print("race_id_listが見つからなかったのでscrape_race_id_listを呼び出します。")
         race_id_list = scrape_race_id_list(from_, to_)
 
-    for race_id in tqdm(race_id_list):
+    race_archive = open_archive(ARCHIVE_RACE_DIR) if archive else None
+    url_path_list = []
+    for race_id in race_id_list:
         url = f"https://db.netkeiba.com/race/{race_id}"
         html_file_path = HTML_RASE_DIR / f"{race_id}.bin"
-        req = Request(url, headers={"User-Agent": "Mozilla/5.0"})
         # ファイルが存在する場合はスキップ
-        if html_file_path.exists():
-            print(f"Skip: file exists ({html_file_path})")
+        if html_file_path.exists() or (archive and race_id in race_archive):
+            metrics.incr("pages_skipped_total", kind="race")
         # ファイルが存在しない場合は取得
         else:
-            time.sleep(1)
-            html = urlopen(req).read()
-            # ファイルに書き込み（書き込みモード "wb" を使用）
-            with open(html_file_path, "wb") as f:
-                f.write(html)
+            url_path_list.append((url, html_file_path))
+    n_skipped = len(race_id_list) - len(url_path_list)
+    if n_skipped:
+        print(f"Skip: {n_skipped} files exist")
+    download_html(url_path_list, fetcher, race_archive)
+
+
+def last_race_dates():
+    """
+    raw_race.csvとraw_race_info.csvから、馬ごとの最後の出走日（"YYYY-MM-DD"）を求める。
+    df_raceのもとになるテーブルなので、レースのページを取り込んだ時点で新しい出走が反映されます。
+
+    Returns:
+        pd.Series: horse_id -> 最後の出走日
+    """
+    race = pd.read_csv(
+        RAW_RACE_CSV_DIR / "raw_race.csv", sep="\t", usecols=["race_id", "horse_id"], dtype=str
+    )
+    info = pd.read_csv(
+        RAW_RACE_CSV_DIR / "raw_race_info.csv", sep="\t", usecols=["race_id", "date"], dtype=str
+    )
+    return race.merge(info, on="race_id").groupby("horse_id")["date"].max()
 
 
-def scrape_html_horse(skip: bool = True):
+def horses_to_refresh(horse_id_list, fetch_log, archive=None):
+    """
+    _関数の意味と使い方_
+    取り直しが必要な馬のidを返す関数です。
+    馬の過去成績はその馬が次に走るまで変わらないので、次の馬だけを取り直します。
+    ・保存したページ（binファイルかアーカイブ）がない馬。取得記録があっても取り直します
+    ・前回の取得日以降（取得日を含む）に出走した馬
+    取得日は取得記録から決め、取得記録がない保存済みのページは、
+    ファイル（アーカイブの場合は書き込み）の更新時刻を取得日とみなします。
+    """
+    last_dates = last_race_dates()
+    archive_dates = {}
+    if archive is not None:
+        archive_dates = {
+            page.stem: datetime.datetime.fromtimestamp(page.entry.mtime_ns / 1e9).date().isoformat()
+            for page in archive.pages()
+        }
+    refresh_id_list = []
+    for horse_id in horse_id_list:
+        horse_id = str(horse_id)
+        html_file_path = HTML_HORSE_DIR / f"{horse_id}.bin"
+        # 取得記録は保存済みのページの取得日を決めるためだけに使う
+        if html_file_path.exists():
+            stored_date = datetime.date.fromtimestamp(html_file_path.stat().st_mtime).isoformat()
+        else:
+            stored_date = archive_dates.get(horse_id)
+        if stored_date is None:
+            refresh_id_list.append(horse_id)
+            continue
+        entry = fetch_log.get(horse_id)
+        fetched_date = entry["fetched_at"][:10] if entry else stored_date
+        if last_dates.get(horse_id, "") >= fetched_date:
+            refresh_id_list.append(horse_id)
+    return refresh_id_list
+
+
+@stage("scrape_html_horse")
+def scrape_html_horse(skip: bool = True, fetcher=None, archive=False, refresh=False):
     """
     _関数の意味と使い方_
     この関数は、保存してあるhorse_idのHTMLを取得する関数です。
     horse_idのHTMLは、netkeiba.comのhorseページから取得します。
     この関数は、pickleファイルで保存してあるhorse_idのHTMLをHTML_HORSE_DIRにbinファイルで保存します。
     horse_idはhorse_id_list.pickleから取得します。
+    fetcherを渡すと、そのレート制限・同時接続数で取得します（省略時はFetcher()）。
+    archiveがTrueなら、binファイルではなくアーカイブ（ARCHIVE_*_DIR）に追記します。
+    取得日時とETag, Last-Modifiedは取得記録（FETCH_LOG_DIR）に保存します。
+
+    Args:
+        skip (bool, optional): Trueなら保存済みの馬はスキップし、Falseならすべて取り直す
+        refresh (bool, optional): Trueなら、保存していない馬と前回の取得以降に出走した馬だけを
+            条件付きリクエストで取り直す（horses_to_refresh参照）。skipより優先します。
     """
     
     horse_id_list = load_data("horse_id_list.pickle", HORSE_ID_DIR)
-    for horse_id in tqdm(horse_id_list):
+    horse_archive = open_archive(ARCHIVE_HORSE_DIR) if archive else None
+    fetch_log = load_fetch_log("horse")
+    if refresh:
+        target_id_set = set(horses_to_refresh(horse_id_list, fetch_log, horse_archive))
+    url_path_list = []
+    for horse_id in horse_id_list:
         url = f"https://db.netkeiba.com/horse/{horse_id}"
         html_file_path = HTML_HORSE_DIR / f"{horse_id}.bin"  # 保存先をHTML_HORSE_DIRに変更
-        req = Request(url, headers={"User-Agent": "Mozilla/5.0"})
-        # ファイルが存在する場合はスキップ
-        if html_file_path.exists() and skip:
-            print(f"Skip: file exists ({html_file_path})")
+        if refresh:
+            is_skipped = str(horse_id) not in target_id_set
+        else:
+            is_skipped = (html_file_path.exists() or (archive and horse_id in horse_archive)) and skip
+        # ファイルが存在する場合（refreshでは、前回の取得以降に出走していない場合）はスキップ
+        if is_skipped:
+            metrics.incr("pages_skipped_total", kind="horse")
         # ファイルが存在しない場合は取得
         else:
-            html = urlopen(req).read()
-            # ファイルに書き込み（書き込みモード "wb" を使用）
-            with open(html_file_path, "wb") as f:
-                f.write(html)
+            url_path_list.append((url, html_file_path))
+    n_skipped = len(horse_id_list) - len(url_path_list)
+    if n_skipped:
+        print(f"Skip: {n_skipped} files exist")
+    try:
+        download_html(url_path_list, fetcher, horse_archive, fetch_log)
+    finally:
+        save_fetch_log(fetch_log, "horse")
     return horse_id_list
-        
-    
\ No newline at end of file
@@ -0,0 +1,218 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+MAPPING_DIR = SRC_DIR.parent / "data" / "mapping"
+
+_work_dir = None
+
+
+def pytest_configure(config):
+    # srcのモジュールは作業ディレクトリからの相対パス（../data）を使い、import時にディレクトリを作るので、
+    # 一時ディレクトリにsrcとdata/mappingを用意して、そこで実行する（common/dataには書き込まない）
+    global _work_dir
+    _work_dir = Path(tempfile.mkdtemp(prefix="keiba_test_"))
+    (_work_dir / "src").mkdir()
+    shutil.copytree(MAPPING_DIR, _work_dir / "data" / "mapping")
+    os.chdir(_work_dir / "src")
+    sys.path.insert(0, str(SRC_DIR))
+
+
+def pytest_unconfigure(config):
+    if _work_dir is not None:
+        shutil.rmtree(_work_dir, ignore_errors=True)
+
+
+class FakeFetcher:
+    """
+    Fetcherの代わりに、url -> (status, body) の辞書から返すFetcher。
+    辞書にないURLは取得に失敗したものとして例外を返します。取得したURLはrequestsに記録します。
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    def fetch_many(self, urls, headers=None, url_headers=None):
+        from fetch import FetchError, Response
+
+        for url in urls:
+            self.requests.append(url)
+            if url in self.pages:
+                status, body = self.pages[url]
+                yield url, Response(url, status, {}, body), None
+            else:
+                yield url, None, FetchError(url, 404)
+
+
+@pytest.fixture
+def fake_fetcher():
+    return FakeFetcher
+
+
+# netkeibaのページと同じ構造の合成ページ。テストからは from conftest import race_page のように使います
+PLACES = ["札幌", "函館", "福島", "新潟", "東京", "中山", "中京", "京都", "阪神", "小倉"]
+RACE_HEADER = ["着順", "枠番", "馬番", "馬名", "性齢", "斤量", "騎手", "タイム", "着差", "単勝", "人気", "馬体重", "調教師"]
+HORSE_HEADER = [
+    "日付", "開催", "天気", "R", "レース名", "映像", "頭数", "枠番", "馬番", "オッズ", "人気", "着順", "騎手", "斤量",
+    "距離", "馬場", "馬場指数", "タイム", "着差", "タイム指数", "通過", "ペース", "上り", "馬体重", "厩舎コメント",
+    "備考", "勝ち馬", "賞金",
+]
+
+
+def wrap_page(body):
+    """本文をnetkeibaと同じEUC-JPのページにする"""
+    return (
+        '<html><head><meta http-equiv="Content-Type" content="text/html; charset=EUC-JP">'
+        f'</head><body><div id="page">{body}</div></body></html>'
+    ).encode("euc-jp")
+
+
+def race_page(seed, race_id="202406050811", n_horses=12):
+    """raceページ（race_table_01, data_intro, pay_block）の合成ページ。同じseedなら同じページです"""
+    rng = random.Random(seed)
+    surface, direction = rng.choice([("芝", "右"), ("芝", "左"), ("ダ", "右"), ("芝", "直"), ("障", "芝")])
+    place = int(race_id[4:6])
+    umaban_list = rng.sample(range(1, n_horses + 1), n_horses)
+    rows = []
+    for rank, umaban in enumerate(umaban_list, 1):
+        horse_id = f"20{seed % 10 + 10}{rank:06d}"
+        rank_text = "中" if rank == n_horses and seed % 2 else str(rank)
+        rows.append(
+            "<tr>"
+            f"<td>{rank_text}</td><td>{(umaban + 1) // 2}</td><td>{umaban}</td>"
+            f'<td><a href="/horse/{horse_id}/" title="馬{horse_id}">馬{horse_id}</a></td>'
+            f"<td>{rng.choice('牡牝セ')}{rng.randint(2, 7)}</td><td>{rng.choice(['54.0', '55.0', '57.0'])}</td>"
+            f'<td><a href="/jockey/result/recent/0{rng.randint(1000, 1999)}/">騎手{rng.randint(1, 200)}</a></td>'
+            f"<td>{rng.randint(1, 3)}:{rng.randint(0, 59):02d}.{rng.randint(0, 9)}</td>"
+            f"<td>{'' if rank == 1 else rng.choice(['クビ', 'ハナ', '1/2', '1.1/2', '2', '大'])}</td>"
+            f"<td>{rng.uniform(1.1, 300):.1f}</td><td>{rng.randint(1, n_horses)}</td>"
+            f"<td>{rng.randint(400, 540)}({rng.randint(-20, 20):+d})</td>"
+            f'<td>[{rng.choice("東西")}] <a href="/trainer/result/recent/0{rng.randint(1000, 1999)}/">調教師{rng.randint(1, 200)}</a></td>'
+            "</tr>"
+        )
+    header = "".join(f"<th>{name}</th>" for name in RACE_HEADER)
+    a, b, c = rng.sample(range(1, n_horses + 1), 3)
+    payouts = [
+        ("tan", "単勝", f"{a}", f"{rng.randint(110, 9000):,}", "1"),
+        ("fuku", "複勝", f"{a}<br />{b}<br />{c}", "<br />".join(f"{rng.randint(100, 2000):,}" for _ in range(3)), "1<br />2<br />3"),
+        ("waku", "枠連", f"{(a + 1) // 2} - {(b + 1) // 2}", f"{rng.randint(150, 9000):,}", "1"),
+        ("uren", "馬連", f"{a} - {b}", f"{rng.randint(150, 50000):,}", "1"),
+        ("wide", "ワイド", f"{a} - {b}<br />{a} - {c}<br />{b} - {c}", "<br />".join(f"{rng.randint(100, 9000):,}" for _ in range(3)), "1<br />2<br />3"),
+        ("utan", "馬単", f"{a} → {b}", f"{rng.randint(200, 90000):,}", "1"),
+        ("santan", "三連単", f"{a} → {b} → {c}", f"{rng.randint(500, 9000000):,}", "1"),
+    ]
+    pay_rows = [
+        f'<tr><th class="{cls}">{name}</th><td>{umaban}</td><td class="txt_r">{ret}</td><td class="txt_r">{pop}</td></tr>'
+        for cls, name, umaban, ret, pop in payouts
+    ]
+    title_class = rng.choice(["", "(1勝クラス)", "(OP)", "(G1)"])
+    body = (
+        '<div class="data_intro"><dl class="racedata fc">'
+        f"<dt>{int(race_id[10:])} R</dt><dd><h1>{PLACES[place - 1]}特別{title_class}</h1>"
+        f"<p><diary_snap_cut><span>{surface}{direction}{rng.choice([1200, 1600, 2000, 3000])}m"
+        f"&nbsp;/&nbsp;天候 : {rng.choice(['晴', '曇', '小雨'])}&nbsp;/&nbsp;{'ダート' if surface == 'ダ' else '芝'} : "
+        f"{rng.choice(['良', '稍重', '不良'])}&nbsp;/&nbsp;発走 : 15:40</span></diary_snap_cut></p></dd></dl>"
+        f'<p class="smalltxt">{race_id[:4]}年{rng.randint(1, 12)}月{rng.randint(1, 28)}日 '
+        f"{int(race_id[6:8])}回{PLACES[place - 1]}{int(race_id[8:10])}日目 "
+        f"{rng.choice(['2歳新馬', '3歳未勝利', '3歳以上2勝クラス'])}&nbsp;&nbsp;(混)(特指)(定量)</p></div>"
+        f'<table class="race_table_01 nk_tb_common" summary="レース結果"><tr>{header}</tr>{"".join(rows)}</table>'
+        '<dl class="pay_block"><dt>払い戻し</dt><dd>'
+        f'<table class="pay_table_01" summary="払い戻し">{"".join(pay_rows[:4])}</table>'
+        f'<table class="pay_table_01" summary="ワイド">{"".join(pay_rows[4:])}</table>'
+        "</dd></dl>"
+    )
+    return wrap_page(body)
+
+
+def horse_page(seed, n_rows):
+    """horseページ（db_h_race_results）の合成ページ。同じseedなら同じページです"""
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(n_rows):
+        rank = rng.randint(1, 16)
+        margin = -rng.randint(1, 9) / 10 if rank == 1 else rng.randint(0, 30) / 10
+        cells = [
+            f"{rng.randint(2010, 2024)}/{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}",
+            f"{rng.randint(1, 5)}{rng.choice(PLACES)}{rng.randint(1, 12)}",
+            rng.choice(["晴", "曇", "雨"]), str(rng.randint(1, 12)),
+            f"テスト特別{rng.choice(['', '(2勝クラス)', '(G2)'])}", "", str(rng.randint(8, 18)),
+            str(rng.randint(1, 8)), str(rng.randint(1, 18)), f"{rng.uniform(1.1, 300):.1f}",
+            str(rng.randint(1, 18)), str(rank) if rng.random() > 0.1 else "取消", "騎手", "57",
+            f"{rng.choice('芝ダ')}{rng.choice([1200, 1600, 2000])}", rng.choice(["良", "稍", "重", "不"]),
+            "**", f"1:{rng.randint(0, 59):02d}.{rng.randint(0, 9)}", f"{margin:.1f}", "**",
+            f"{rng.randint(1, 16)}-{rng.randint(1, 16)}", "35.0-35.8", f"{rng.uniform(33, 40):.1f}",
+            f"{rng.randint(400, 540)}({rng.randint(-20, 20):+d})", "", "", "勝ち馬",
+            f"{rng.randint(100, 20000):,}.0" if rank <= 5 else "",
+        ]
+        rows.append("<tr>" + "".join(f"<td>{cell}</td>" for cell in cells) + "</tr>")
+    header = "".join(f"<th>{name}</th>" for name in HORSE_HEADER)
+    return wrap_page(
+        f'<table class="db_h_race_results nk_tb_common"><thead><tr>{header}</tr></thead>'
+        f'<tbody>{"".join(rows)}</tbody></table>'
+    )
+
+
+# 3レース分のdf_csv。2019104308の馬と01170の騎手は複数のレースに出ています
+# 202401010101には中止した馬がいるので、n_horsesはdf_raceの行数より1多くなっています
+DF_RACE_CSV = """\
+race_id	horse_code	jockey_code	trainer_code	rank	umaban	wakuban	tansho_odds	popularity	impost	sex	age	weight	weight_diff
+202401010101	1	1	0	1	2	2	5.4	2	55.0	1	4	480	-2
+202401010101	0	0	0	2	1	1	2.1	1	57.0	0	5	502	4
+202401010101	2	2	1	3	3	3	12.8	3	54.0	2	3	440	0
+202401010102	3	0	1	1	1	1	1.8	1	56.0	0	4	470	2
+202401010102	4	1	0	2	2	2	3.5	2	56.0		4	466	-4
+202406050811	0	0	0	1	5	3	3.1	1	58.0	0	5	506	4
+202406050811	5	2	1	2	12	6	8.9	4	58.0	1	6	490	0
+"""
+DF_RACE_INFO_CSV = """\
+race_id	date	race_type	around	course_len	weather	ground_state	race_class	place	n_horses
+202401010101	2024-01-06	1	0	1200	1	0	1	1	4
+202401010102	2024-01-06	0		1800	1	0	2	1	2
+202406050811	2024-12-28	1	0	2500	0	1	8	6	2
+"""
+DF_RACE_RETURN_CSV = """\
+race_id	bet_type	win_umaban	return
+202401010101	単勝	2	540
+202401010101	馬連	1-2	480
+202401010102	単勝	1	180
+202406050811	単勝	5	310
+202406050811	馬単	5-12	1560
+"""
+ID_DICT_TSVS = {
+    "horse": [("2019104308", "馬A"), ("2020100001", "馬B"), ("2021100002", "馬C"),
+              ("2020100003", "馬D"), ("2021100004", "馬E"), ("2018100005", "馬F")],
+    "jockey": [("01170", "騎手A"), ("05339", "騎手B"), ("01126", "騎手C")],
+    "trainer": [("01061", "調教師A"), ("01157", "調教師B")],
+}
+
+
+@pytest.fixture
+def df_tables(tmp_path, monkeypatch):
+    """
+    tmp_pathにdf_csvとID辞書を書き、ID辞書はそこから開くようにする。
+    df_csvのディレクトリを返すので、テストする関数のモジュールのDF_CSV_DIRに設定してください。
+    """
+    import id_dict
+
+    df_csv_dir = tmp_path / "df_csv"
+    df_csv_dir.mkdir()
+    for name, text in [
+        ("df_race", DF_RACE_CSV), ("df_race_info", DF_RACE_INFO_CSV), ("df_race_return", DF_RACE_RETURN_CSV),
+    ]:
+        (df_csv_dir / f"{name}.csv").write_text(text, encoding="utf-8")
+    id_dict_dir = tmp_path / "id_dict"
+    id_dict_dir.mkdir()
+    for kind, rows in ID_DICT_TSVS.items():
+        lines = ["id\tname"] + [f"{id_}\t{name}" for id_, name in rows]
+        (id_dict_dir / f"{kind}.tsv").write_text("\n".join(lines) + "\n", encoding="utf-8")
+    monkeypatch.setattr(
+        id_dict, "_dictionaries", {kind: id_dict.IdDictionary(kind, id_dict_dir) for kind in ID_DICT_TSVS}
+    )
+    return df_csv_dir
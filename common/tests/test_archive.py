@@ -0,0 +1,61 @@
+import pickle
+
+import archive
+import scraping
+
+
+def test_archive_keys_are_strings(tmp_path):
+    page_archive = archive.PageArchive(tmp_path / "horse")
+    page_archive.put(2019104308, b"<html>horse</html>")
+    assert 2019104308 in page_archive
+    assert "2019104308" in page_archive
+    assert page_archive.get(2019104308) == b"<html>horse</html>"
+    assert page_archive.keys() == ["2019104308"]
+    page_archive.delete(2019104308)
+    assert 2019104308 not in page_archive
+    page_archive.close()
+
+
+def test_scrape_html_horse_with_archive_skips_stored_horses(tmp_path, fake_fetcher, monkeypatch):
+    horse_id_list = [2019104308, 2020100001, 2021100002]
+    (tmp_path / "horse_id").mkdir()
+    with open(tmp_path / "horse_id" / "horse_id_list.pickle", "wb") as f:
+        pickle.dump(horse_id_list, f)
+    (tmp_path / "html").mkdir()
+    (tmp_path / "fetch_log").mkdir()
+    monkeypatch.setattr(scraping, "HORSE_ID_DIR", tmp_path / "horse_id")
+    monkeypatch.setattr(scraping, "HTML_HORSE_DIR", tmp_path / "html")
+    monkeypatch.setattr(scraping, "FETCH_LOG_DIR", tmp_path / "fetch_log")
+    monkeypatch.setattr(scraping, "ARCHIVE_HORSE_DIR", tmp_path / "archive")
+    pages = {
+        f"https://db.netkeiba.com/horse/{horse_id}": (200, f"<html>{horse_id}</html>".encode())
+        for horse_id in horse_id_list
+    }
+
+    fetcher = fake_fetcher(pages)
+    scraping.scrape_html_horse(fetcher=fetcher, archive=True)
+    assert len(fetcher.requests) == 3
+
+    # 2回目はアーカイブにある馬を取り直さず、インデックスも増えない
+    fetcher = fake_fetcher(pages)
+    scraping.scrape_html_horse(fetcher=fetcher, archive=True)
+    assert fetcher.requests == []
+    index_lines = (tmp_path / "archive" / archive.INDEX_FILE_NAME).read_text().splitlines()
+    assert len(index_lines) == 3
+
+
+def test_compact_ignores_leftover_compact_dir(tmp_path):
+    # 前回のcompactが途中で止まって、作りかけのディレクトリが残っている
+    with archive.PageArchive(tmp_path / "horse.compact") as leftover:
+        leftover.put("2000000000", b"<html>stale</html>")
+
+    page_archive = archive.PageArchive(tmp_path / "horse")
+    page_archive.put("2019104308", b"<html>old</html>")
+    page_archive.put("2019104308", b"<html>new</html>")
+    page_archive.put("2020100001", b"<html>horse</html>")
+    page_archive.compact()
+    assert sorted(page_archive.keys()) == ["2019104308", "2020100001"]
+    assert page_archive.get("2019104308") == b"<html>new</html>"
+    assert not (tmp_path / "horse.compact").exists()
+    page_archive.close()
+    assert sorted(archive.PageArchive(tmp_path / "horse").keys()) == ["2019104308", "2020100001"]
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+import backtest
+
+
+def test_umaban_array_accepts_mixed_formats():
+    array = backtest._umaban_array([[5, 10], "7-12", "['1', '2', '3']", (4,), 9, "3→1"])
+    assert array.tolist() == [[5, 10, 0], [7, 12, 0], [1, 2, 3], [4, 0, 0], [9, 0, 0], [3, 1, 0]]
+
+
+def test_umaban_array_rejects_unknown_types():
+    with pytest.raises(TypeError, match="馬番の組み合わせ"):
+        backtest._umaban_array(["5-10", None])
+    with pytest.raises(ValueError, match="3頭まで"):
+        backtest._umaban_array(["1-2-3-4"])
+
+
+def test_combination_keys_ignore_order_for_unordered_bets():
+    keys = backtest.combination_keys(
+        [202401010101] * 4, ["馬連", "馬連", "馬単", "馬単"], ["5-10", [10, 5], "5-10", [10, 5]]
+    )
+    assert keys[0] == keys[1]
+    assert keys[2] != keys[3]
+    assert keys.dtype == np.int64
@@ -0,0 +1,18 @@
+import numpy as np
+
+import dataset
+
+
+def test_n_horses_counts_runners_missing_from_df_race(df_tables, tmp_path, monkeypatch):
+    feature_dir = tmp_path / "features"
+    feature_dir.mkdir()
+    (feature_dir / "horse_form.csv").write_text(
+        "race_id\thorse_code\tn_past_races\n202406050811\t0\t1\n", encoding="utf-8"
+    )
+    monkeypatch.setattr(dataset, "DF_CSV_DIR", df_tables)
+    monkeypatch.setattr(dataset, "FEATURE_DIR", feature_dir)
+    matrix = dataset.TrainingMatrix(dataset.build_training_matrix(tmp_path / "dataset"))
+    n_horses = np.asarray(matrix.features[:, matrix.feature_index("n_horses")])
+    # 202401010101はdf_raceに3頭しかいないが、中止の馬を含めて4頭
+    assert n_horses.tolist() == [4, 4, 4, 2, 2, 2, 2]
+    assert np.isnan(matrix.features[:, matrix.feature_index("n_past_races")]).sum() == 6
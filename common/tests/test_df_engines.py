@@ -0,0 +1,95 @@
+import pandas as pd
+import pytest
+
+import df
+import df_polars
+import id_dict
+
+RAW_RACE_CSV = """\
+race_id	着順	枠番	馬番	馬名	性齢	斤量	騎手	タイム	着差	単勝	人気	馬体重	調教師	horse_id	jockey_id	trainer_id
+202401010101	1	7	12	馬A	牝4	55.0	騎手A	1:10.1		5.4	2	480(-2)	[東] 調教師A	2019104308	01170	01061
+202401010101	2	1	1	馬B	牡5	57.0	騎手B	1:10.3	1	2.1	1	502(+4)	[西] 調教師B	2020100001	05339	01157
+202401010101	3	4	7	馬C	セ3	54.0	騎手C	1:10.5	1.1/2	12.8	3	440(0)	[東] 調教師A	2021100002	01126	01061
+202401010101	中止	2	3	馬D	牡4	56.0	騎手A			30.1	4	470(+2)	[西] 調教師B	2020100003	01170	01157
+202406050811	1	3	5	馬A	牝4	58.0	騎手A	2:32.0		3.1	1	506(+26)	[東] 調教師A	2019104308	01170	01061
+202406050811	2	6	11	馬E	牡6	58.0	騎手B	2:32.1	クビ	8.9	2	490(0)	[西] 調教師B	2018100005	05339	01157
+202406050811	3	8	16	馬F	牝5	56.0	騎手D	2:32.5	2	40.2	3	452(-4)	[東] 調教師A	2019100006		01061
+202406050811	取消	4	7	馬G	牡4	57.0	騎手B			8.0	4	460(0)	[西] 調教師B	2020100007	05339	01157
+"""
+RAW_HORSE_CSV = """\
+horse_id	日付	開催	天気	R	レース名	頭数	着順	距離	馬場	着差	賞金
+2019104308	2024/12/28	5中山8	晴	11	有馬記念(G1)	16	1	芝2500	良	-0.1	50000.0
+2019104308	2024/01/06	1中山1	曇	1	3歳未勝利	16	3	ダ1200	稍	0.4
+2020100001	2024/01/06	1中山1	小雨	1	ニューイヤーS(OP)	12	取消	ダ1200	不
+2020100001	2023/06/10	3東京2	雨	9	2勝クラス	10	2	芝1800	重	0.2	800.0
+"""
+RAW_RACE_INFO_CSV = """\
+race_id	title	surface	direction	distance	weather	going	date	class_text
+202401010101	3歳未勝利	ダ	右	1200	晴	良	2024-01-06	3歳未勝利 混
+202406050811	有馬記念(G1)	芝	右	2500	晴	良	2024-12-28	3歳以上オープン
+202408060405	2歳新馬	障		3140	曇	稍重	2024-11-10	障害4歳以上オープン
+"""
+RAW_RACE_RETURN_CSV = """\
+	race_id	0	1	2	3
+0	202401010101	単勝	12	540	2
+1	202401010101	複勝	12 1 7	120 110 280	2 1 3
+2	202401010101	枠連	1 - 7	460	1
+3	202401010101	馬単	12 → 1	1,230	4
+4	202401010101	三連単	12 → 1 → 7	12,340	20
+5	202406050811	ワイド	5 - 11 5 - 9	150 310	1 3
+"""
+
+
+@pytest.fixture
+def raw_csv_dir(tmp_path, monkeypatch):
+    raw_csv_dir = tmp_path / "raw_csv"
+    raw_csv_dir.mkdir()
+    for name, text in [
+        ("raw_race", RAW_RACE_CSV), ("raw_horse", RAW_HORSE_CSV),
+        ("raw_race_info", RAW_RACE_INFO_CSV), ("raw_race_return", RAW_RACE_RETURN_CSV),
+    ]:
+        (raw_csv_dir / f"{name}.csv").write_text(text, encoding="utf-8")
+    monkeypatch.setattr(df, "RAW_CSV_DIR", raw_csv_dir)
+    monkeypatch.setattr(df_polars, "RAW_CSV_DIR", raw_csv_dir)
+    monkeypatch.setattr(id_dict, "ID_DICT_DIR", tmp_path / "id_dict")
+    monkeypatch.setattr(id_dict, "_dictionaries", {})
+    return raw_csv_dir
+
+
+def test_engines_write_identical_tables(raw_csv_dir, tmp_path):
+    results = df_polars.compare_engines()
+    for name, result in results.items():
+        assert result["equal"], (name, result["first_diff"])
+    assert results["df_race"]["rows"] == 6
+    assert results["df_horse"]["rows"] == 3
+    # ID辞書はtmp_pathに書かれ、先頭の0も残る
+    assert (tmp_path / "id_dict" / "jockey.tsv").exists()
+    assert id_dict.open_id_dictionary("jockey").decode([0]).tolist() == ["01170"]
+    # jockey_idがない行はMISSING_CODEになり、ID辞書には入らない
+    table = df._transform("df_race", "polars")
+    assert table["jockey_code"].tolist()[-1] == id_dict.MISSING_CODE
+    assert len(id_dict.open_id_dictionary("jockey")) == 3
+
+
+@pytest.mark.parametrize("engine", df.ENGINES)
+def test_race_info_counts_runners_from_raw_race(raw_csv_dir, engine):
+    table = df._transform("df_race_info", engine)
+    # 中止の馬は数え、取消の馬は数えない。raw_race.csvに行のないレースはNA
+    assert table["n_horses"].tolist() == [4, 3, pd.NA]
+
+
+@pytest.mark.parametrize("engine", df.ENGINES)
+def test_race_return_keeps_combinations_as_strings(raw_csv_dir, engine):
+    table = df._transform("df_race_return", engine)
+    assert table["bet_type"].tolist() == ["単勝", "複勝", "複勝", "複勝", "馬単", "三連単", "ワイド", "ワイド"]
+    assert table["win_umaban"].tolist() == ["12", "12", "1", "7", "12-1", "12-1-7", "5-11", "5-9"]
+    assert table["return"].tolist() == [540, 120, 110, 280, 1230, 12340, 150, 310]
+
+
+def test_race_return_csv_round_trips_to_backtest_keys(raw_csv_dir, tmp_path):
+    import backtest
+
+    table = df._transform("df_race_return", "pandas")
+    table.to_csv(tmp_path / "df_race_return.csv", sep="\t", index=False)
+    payouts = backtest.load_payouts(pd.read_csv(tmp_path / "df_race_return.csv", sep="\t"))
+    assert len(payouts) == len(table)
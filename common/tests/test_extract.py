@@ -0,0 +1,170 @@
+import ast
+import re
+from io import StringIO
+
+import pandas as pd
+import pytest
+from bs4 import BeautifulSoup
+
+import df
+import extract
+from conftest import horse_page, race_page, wrap_page
+
+
+# 置き換える前（baseline）のcreate_rawの実装から、ページ1つ分を取り出す部分をそのまま抜き出したもの。
+# extract.pyの結果がこれと同じになることを確かめる。
+# baselineはテーブルがないページで例外になる（raw_race_csv）か、そのページを飛ばす
+# （raw_race_info_csv, raw_race_return_csv）ので、ここではどちらもNoneにしています。
+def _baseline_race_result(html, race_id):
+    soup = BeautifulSoup(html, "html.parser")
+    table = soup.find("table", class_="race_table_01")
+    if table is None:
+        return None
+    df_ = pd.read_html(StringIO(str(table)))[0]
+    a_list = soup.find_all("a", href=re.compile(r"^/horse/"))
+    df_["horse_id"] = [re.findall(r"/horse/(\d+)", a["href"])[0] for a in a_list]
+    a_list = soup.find_all("a", href=re.compile(r"^/jockey/result/recent/"))
+    df_["jockey_id"] = [re.findall(r"/jockey/result/recent/(\d+)", a["href"])[0] for a in a_list]
+    a_list = soup.find_all("a", href=re.compile(r"^/trainer/result/recent/"))
+    df_["trainer_id"] = [re.findall(r"/trainer/result/recent/(\d+)", a["href"])[0] for a in a_list]
+    df_.index = pd.Index([race_id] * len(df_))
+    return df_
+
+
+def _baseline_race_info(html, race_id):
+    """baselineのraw_race_info.csvの1行（title, info1, info2）"""
+    soup = BeautifulSoup(html, "lxml").find("div", class_="data_intro")
+    try:
+        info_dict = {}
+        info_dict["title"] = soup.find("h1").text
+        p_list = soup.find_all("p")
+        info_dict["info1"] = re.findall(r"[\w:]+", p_list[0].text.replace(" ", ""))
+        info_dict["info2"] = re.findall(r"\w+", p_list[1].text)
+    except (AttributeError, IndexError):
+        return None
+    df_ = pd.DataFrame().from_dict(info_dict, orient="index").T
+    df_.index = [race_id] * len(df_)
+    return df_
+
+
+def _baseline_df_race_info(raw_csv_path):
+    """baselineのdf.df_race_info_csvの変換（evalはliteral_evalに置き換え）"""
+    df_ = pd.read_csv(raw_csv_path, sep="\t")
+    df_["tmp"] = df_["info1"].map(lambda x: ast.literal_eval(x)[0])
+    df_["race_type"] = df_["tmp"].str[0].map(df.race_type_mapping)
+    df_["around"] = df_["tmp"].str[1].map(df.around_mapping)
+    df_["course_len"] = df_["tmp"].str.extract(r"(\d+)")
+    df_["weather"] = df_["info1"].str.extract(r"天候:(\w+)")[0].map(df.weather_mapping)
+    df_["ground_state"] = df_["info1"].str.extract(r"(芝|ダート|障害):(\w+)")[1].map(df.ground_state_mapping)
+    df_["date"] = pd.to_datetime(df_["info2"].map(lambda x: ast.literal_eval(x)[0]), format="%Y年%m月%d日")
+    regex_race_class = "|".join(df.race_class_mapping)
+    df_["race_class"] = (
+        df_["title"]
+        .str.extract(rf"({regex_race_class})")
+        .fillna(df_["info2"].str.extract(rf"({regex_race_class})"))[0]
+        .map(df.race_class_mapping)
+    )
+    df_["place"] = df_["race_id"].astype(str).str[4:6].astype(int)
+    df_ = df_[["race_id", "date", "race_type", "around", "course_len", "weather", "ground_state", "race_class", "place"]]
+    df_["course_len"] = pd.to_numeric(df_["course_len"])
+    return df_.astype({column: df.DF_SCHEMAS["df_race_info"][column] for column in df_.columns})
+
+
+def _baseline_race_return(html, race_id):
+    soup = BeautifulSoup(html.decode("euc-jp"), "html.parser")
+    pay_block = soup.find("dl", class_="pay_block")
+    if pay_block is None:
+        return None
+    df_ = pd.concat(pd.read_html(StringIO(str(pay_block))))
+    df_.insert(0, "race_id", race_id)
+    return df_
+
+
+def _baseline_horse_result(html, horse_id):
+    soup = BeautifulSoup(html, "html.parser")
+    table = soup.find("table", class_="db_h_race_results")
+    if table is None:
+        return None
+    df_ = pd.read_html(StringIO(str(table)))[0]
+    df_.index = [horse_id] * len(df_)
+    return df_
+
+
+def _replace(html, pattern, repl):
+    """合成ページ（EUC-JP）の一部を正規表現で書き換える"""
+    return re.sub(pattern, repl, html.decode("euc-jp"), flags=re.S).encode("euc-jp")
+
+
+def _assert_same(new, old):
+    if old is None:
+        assert new is None
+    else:
+        pd.testing.assert_frame_equal(new, old)
+
+
+RACE_PAGES = {
+    **{f"seed{seed}": race_page(seed) for seed in range(5)},
+    "no_result_table": _replace(race_page(5), r'<table class="race_table_01.*?</table>', ""),
+    "no_pay_block": _replace(race_page(6), r'<dl class="pay_block">.*?</dl>', ""),
+    "no_data_intro": _replace(race_page(7), r'<div class="data_intro">.*?</div>', ""),
+    "info_without_date": _replace(race_page(8), r'<p class="smalltxt">.*?</p>', ""),
+    # pd.read_htmlと同じく、display:noneのセルは除き、colspanのセルは繰り返す
+    "hidden_and_colspan": _replace(
+        _replace(race_page(9), r"(<td class=\"txt_r\">1</td></tr>)", r'<td style="display: none">x</td>\1'),
+        r"<th>調教師</th>", '<th colspan="1">調教師</th>',
+    ),
+}
+
+
+@pytest.mark.parametrize("name", list(RACE_PAGES))
+def test_race_result_and_return_match_baseline(name):
+    html = RACE_PAGES[name]
+    result, _, race_return = extract.parse_race_html(html, "202406050811")
+    _assert_same(result, _baseline_race_result(html, "202406050811"))
+    _assert_same(race_return, _baseline_race_return(html, "202406050811"))
+
+
+@pytest.mark.parametrize("name", list(RACE_PAGES))
+def test_race_info_matches_baseline_through_df(name, tmp_path, monkeypatch):
+    # raw_race_info.csvの列はbaselineから変わったので、dfのテーブルまで変換して比べる
+    html = RACE_PAGES[name]
+    result, info, _ = extract.parse_race_html(html, "202406050811")
+    baseline = _baseline_race_info(html, "202406050811")
+    if baseline is None:
+        assert info is None
+        return
+    info.to_csv(tmp_path / "raw_race_info.csv", sep="\t", index_label="race_id")
+    # n_horses（raw_race.csvから数える頭数）はbaselineにない列なので、比べる前に除く
+    (result if result is not None else pd.DataFrame(columns=["着順"])).to_csv(
+        tmp_path / "raw_race.csv", sep="\t", index_label="race_id"
+    )
+    baseline.to_csv(tmp_path / "baseline_raw_race_info.csv", sep="\t", index_label="race_id")
+    monkeypatch.setattr(df, "RAW_CSV_DIR", tmp_path)
+    pd.testing.assert_frame_equal(
+        df.PANDAS_TRANSFORMS["df_race_info"]().drop(columns="n_horses"),
+        _baseline_df_race_info(tmp_path / "baseline_raw_race_info.csv"),
+    )
+
+
+def test_race_result_ids_come_from_the_same_row():
+    # baselineはページ中の全リンクからidを集めるので、余計なリンクがあると行とずれる（長さが合わず例外になる）。
+    # 新しい実装は各行の最初のリンクのidを使うので、余計なリンクがないページのbaselineと同じになる
+    html = race_page(10)
+    noisy = _replace(html, r'(<div class="data_intro">)', r'<a href="/horse/2099999999/">注目馬</a>\1')
+    noisy = _replace(noisy, r'(<a href="/horse/\d+/"[^>]*>[^<]*</a>)', r'\1<a href="/horse/2088888888/"></a>')
+    new = extract.read_race_result(extract.parse_html(noisy), "202406050811")
+    pd.testing.assert_frame_equal(new, _baseline_race_result(html, "202406050811"))
+    with pytest.raises(ValueError):
+        _baseline_race_result(noisy, "202406050811")
+
+
+HORSE_PAGES = {
+    **{f"seed{seed}": horse_page(seed, 5 + seed * 5) for seed in range(5)},
+    "no_table": wrap_page("<div>データがありません</div>"),
+}
+
+
+@pytest.mark.parametrize("name", list(HORSE_PAGES))
+def test_parse_horse_html_matches_baseline(name):
+    html = HORSE_PAGES[name]
+    _assert_same(extract.parse_horse_html(html, "2019104308"), _baseline_horse_result(html, "2019104308"))
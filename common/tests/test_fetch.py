@@ -0,0 +1,143 @@
+import gzip
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import fetch
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """パスごとに決めたレスポンスを返すスタブ。keep-aliveのためにHTTP/1.1で応答します"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.counts[self.path] += 1
+            count = server.counts[self.path]
+            server.client_ports.append(self.client_address[1])
+        if self.path in ("/retry429", "/retry503"):
+            if count == 1:
+                self._send(int(self.path[-3:]), headers={"Retry-After": "2"})
+            else:
+                self._send(200, b"ok")
+        elif self.path == "/flaky500":
+            self._send(500 if count == 1 else 200, b"ok")
+        elif self.path == "/always503":
+            self._send(503)
+        elif self.path == "/redirect":
+            self._send(302, headers={"Location": "/page"})
+        elif self.path == "/gzip":
+            self._send(200, gzip.compress("馬".encode("euc-jp")), {"Content-Encoding": "gzip"})
+        elif self.path.startswith("/page"):
+            self._send(200, self.path.encode())
+        else:
+            self._send(404)
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.lock = threading.Lock()
+    server.counts = Counter()
+    server.client_ports = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """リトライの待ち時間を記録して、実際には待たない"""
+    recorded = []
+    monkeypatch.setattr(fetch.time, "sleep", recorded.append)
+    return recorded
+
+
+def test_retry_after_is_honored_for_429_and_503(stub_server, sleeps):
+    with fetch.Fetcher(rate=None, per_host_rate=None, backoff=0.01) as fetcher:
+        for path in ["/retry429", "/retry503"]:
+            response = fetcher.fetch(stub_server.base_url + path)
+            assert response.status == 200
+            assert stub_server.counts[path] == 2
+    assert sleeps == [2.0, 2.0]
+
+
+def test_backoff_without_retry_after_and_giving_up(stub_server, sleeps):
+    with fetch.Fetcher(rate=None, per_host_rate=None, retries=2, backoff=0.5) as fetcher:
+        assert fetcher.fetch(stub_server.base_url + "/flaky500").body == b"ok"
+        with pytest.raises(fetch.FetchError) as excinfo:
+            fetcher.fetch(stub_server.base_url + "/always503")
+    assert excinfo.value.status == 503
+    assert stub_server.counts["/always503"] == 3
+    # 1回目は0.5秒、以降は2倍ずつ（10%までのゆらぎあり）
+    assert 0.5 <= sleeps[0] <= 0.55
+    assert 0.5 <= sleeps[1] <= 0.55 and 1.0 <= sleeps[2] <= 1.1
+
+
+def test_4xx_is_not_retried(stub_server, sleeps):
+    with fetch.Fetcher(rate=None, per_host_rate=None) as fetcher:
+        with pytest.raises(fetch.FetchError) as excinfo:
+            fetcher.fetch(stub_server.base_url + "/missing")
+    assert excinfo.value.status == 404
+    assert stub_server.counts["/missing"] == 1
+    assert sleeps == []
+
+
+def test_redirect_and_gzip(stub_server):
+    with fetch.Fetcher(rate=None, per_host_rate=None) as fetcher:
+        response = fetcher.fetch(stub_server.base_url + "/redirect")
+        assert response.url == stub_server.base_url + "/page"
+        assert response.body == b"/page"
+        assert fetcher.fetch(stub_server.base_url + "/gzip").body == "馬".encode("euc-jp")
+
+
+def test_fetch_many_reuses_one_connection_and_closes_it(stub_server):
+    fetcher = fetch.Fetcher(rate=None, per_host_rate=None, max_in_flight=1)
+    urls = [f"{stub_server.base_url}/page{i}" for i in range(5)]
+    results = list(fetcher.fetch_many(urls))
+    assert sorted(response.body for _, response, _ in results) == [f"/page{i}".encode() for i in range(5)]
+    # keep-aliveで、5回とも同じ接続（同じクライアントのポート）から送られている
+    assert len(stub_server.client_ports) == 5
+    assert len(set(stub_server.client_ports)) == 1
+    # fetch_manyが終わったら、ワーカースレッドの接続は閉じてある
+    assert fetcher._thread_connections == []
+
+
+def test_close_closes_connections_and_fetch_reconnects(stub_server):
+    fetcher = fetch.Fetcher(rate=None, per_host_rate=None)
+    fetcher.fetch(stub_server.base_url + "/page0")
+    (connections,) = fetcher._thread_connections
+    (conn,) = connections.values()
+    fetcher.close()
+    assert conn.sock is None
+    assert fetcher.fetch(stub_server.base_url + "/page1").body == b"/page1"
+    assert len(set(stub_server.client_ports)) == 2
+    fetcher.close()
+
+
+def test_token_bucket_paces_requests():
+    bucket = fetch.TokenBucket(rate=20, capacity=1)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    # 最初の1つは貯まっている分、残りの4つは1/20秒ずつ待つ
+    assert time.monotonic() - start >= 4 / 20 * 0.9
@@ -0,0 +1,62 @@
+import numpy as np
+
+import id_dict
+
+
+def test_encode_decode_keeps_leading_zeros(tmp_path):
+    jockeys = id_dict.IdDictionary("jockey", directory=tmp_path)
+    codes = jockeys.encode(["01167", "05339", "01167"], ["騎手A", "騎手B", "騎手A"])
+    assert codes.tolist() == [0, 1, 0]
+    assert jockeys.decode(codes).tolist() == ["01167", "05339", "01167"]
+
+    # 整数で読んでしまったidも同じコードになる
+    assert jockeys.encode(np.array([1167, 5339]), add=False).tolist() == [0, 1]
+
+    # ファイルから読み直しても、先頭の0は残る
+    reloaded = id_dict.IdDictionary("jockey", directory=tmp_path)
+    assert reloaded.decode([0, 1]).tolist() == ["01167", "05339"]
+    assert reloaded.lookup_name([0, 1]).tolist() == ["騎手A", "騎手B"]
+
+
+def test_legacy_integer_ids_are_padded_on_load(tmp_path):
+    # 以前の辞書はidを整数で保存していた
+    (tmp_path / "trainer.tsv").write_text("id\tname\n1167\t調教師A\n", encoding="utf-8")
+    trainers = id_dict.IdDictionary("trainer", directory=tmp_path)
+    assert trainers.decode([0]).tolist() == ["01167"]
+    assert trainers.encode(["01167"], add=False).tolist() == [0]
+
+
+def test_missing_ids_get_missing_code_and_are_not_stored(tmp_path):
+    jockeys = id_dict.IdDictionary("jockey", directory=tmp_path)
+    codes = jockeys.encode(["01167", None, np.nan, "05339"], ["騎手A", "騎手B", "騎手C", "騎手D"])
+    assert codes.tolist() == [0, id_dict.MISSING_CODE, id_dict.MISSING_CODE, 1]
+    assert jockeys.decode(codes).tolist() == ["01167", None, None, "05339"]
+    assert jockeys.lookup_name(codes).tolist() == ["騎手A", None, None, "騎手D"]
+    # 欠損値のあるfloatの列（型推論で読んだCSV）でも同じ
+    assert jockeys.encode(np.array([1167.0, np.nan])).tolist() == [0, id_dict.MISSING_CODE]
+    lines = (tmp_path / "jockey.tsv").read_text(encoding="utf-8").splitlines()
+    assert lines == ["id\tname", "01167\t騎手A", "05339\t騎手D"]
+
+
+def test_create_id_list_skips_missing_ids(tmp_path, monkeypatch):
+    import create_raw
+
+    raw_csv_dir = tmp_path / "raw_csv"
+    raw_csv_dir.mkdir()
+    (raw_csv_dir / "raw_race.csv").write_text(
+        "race_id\t馬名\t騎手\t調教師\thorse_id\tjockey_id\ttrainer_id\n"
+        "202401010101\t馬A\t騎手A\t調教師A\t2019104308\t01170\t01061\n"
+        "202401010101\t馬B\t騎手B\t調教師B\t2020100001\t\t\n",
+        encoding="utf-8",
+    )
+    monkeypatch.setattr(create_raw, "RAW_CSV_DIR", raw_csv_dir)
+    for name in ["HORSE_ID_DIR", "JOCKEY_ID_DIR", "TRAINER_ID_DIR"]:
+        monkeypatch.setattr(create_raw, name, tmp_path)
+    monkeypatch.setattr(id_dict, "ID_DICT_DIR", tmp_path / "id_dict")
+    monkeypatch.setattr(id_dict, "_dictionaries", {})
+    horse_id_list, jockey_id_list, trainer_id_list = create_raw.create_id_list()
+    assert horse_id_list == ["2019104308", "2020100001"]
+    assert jockey_id_list == ["01170"]
+    assert trainer_id_list == ["01061"]
+    assert create_raw.load_data("jockey_id_list.pickle", tmp_path) == ["01170"]
+    assert len(id_dict.open_id_dictionary("trainer")) == 1
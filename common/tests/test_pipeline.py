@@ -0,0 +1,50 @@
+import datetime
+import os
+import time
+
+import pipeline
+
+STAGES = {stage.name: stage for stage in pipeline.STAGES}
+
+
+def _write(path, age_hours=0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"data")
+    mtime = time.time() - age_hours * 3600
+    os.utime(path, (mtime, mtime))
+
+
+def test_scrape_stage_reaching_this_month_is_rescraped_when_old(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "DATA_DIR", tmp_path)
+    stage = STAGES["scrape_kaisai_date"]
+    this_month = datetime.date.today().strftime("%Y-%m")
+    options = {"from_": "2024-01", "to_": this_month}
+    output = pipeline._stage_paths(stage.outputs, options)[0]
+
+    _write(output)
+    assert pipeline.is_up_to_date(stage, options, {})
+    _write(output, age_hours=24)
+    assert not pipeline.is_up_to_date(stage, options, {})
+
+    # 終わった月だけの期間は、古くても取り直さない
+    past = {"from_": "2024-01", "to_": "2024-02"}
+    _write(pipeline._stage_paths(stage.outputs, past)[0], age_hours=24)
+    assert pipeline.is_up_to_date(stage, past, {})
+
+
+def test_stages_reading_id_dict_take_its_lock():
+    for stage in pipeline.STAGES:
+        if "id_dict" in stage.inputs:
+            assert "id_dict" in stage.locks, stage.name
+
+
+def test_race_pages_are_parsed_by_one_stage():
+    options = {"from_": None, "to_": None}
+    readers = [stage.name for stage in pipeline.STAGES if "html/race" in stage.inputs]
+    assert readers == ["raw_race_all_csv"]
+    raw_all = STAGES["raw_race_all_csv"]
+    for name in ["df_race_csv", "df_race_info_csv", "df_race_return_csv", "create_id_list"]:
+        assert pipeline._depends_on(STAGES[name], raw_all, options), name
+    # df_race_info_csvとdf_race_return_csvはお互いに依存せず、同時に実行できる
+    assert not pipeline._depends_on(STAGES["df_race_return_csv"], STAGES["df_race_info_csv"], options)
+    assert not pipeline._depends_on(STAGES["df_race_info_csv"], STAGES["df_race_return_csv"], options)
@@ -0,0 +1,18 @@
+import gzip
+import json
+
+import race_shards
+
+
+def test_export_race_shards_writes_payouts_as_integer_arrays(df_tables, tmp_path, monkeypatch):
+    monkeypatch.setattr(race_shards, "DF_CSV_DIR", df_tables)
+    output_dir = tmp_path / "races"
+    index = race_shards.export_race_shards(output_dir)
+    assert sorted(index["races"]) == ["202401010101", "202401010102", "202406050811"]
+    assert index["dates"]["2024-01-06"] == {"1": ["202401010101", "202401010102"]}
+
+    race = json.loads(gzip.decompress((output_dir / "202406050811.json.gz").read_bytes()))
+    assert race["payouts"] == [["単勝", [5], 310], ["馬単", [5, 12], 1560]]
+    assert race["entries"]["umaban"] == [5, 12]
+    assert race["entries"]["horse_id"] == ["2019104308", "2018100005"]
+    assert race["entries"]["jockey_name"] == ["騎手A", "騎手C"]
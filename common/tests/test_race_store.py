@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+
+import race_store
+
+
+@pytest.fixture
+def store(df_tables, tmp_path, monkeypatch):
+    monkeypatch.setattr(race_store, "DF_CSV_DIR", df_tables)
+    return race_store.RaceStore(race_store.build_race_store(tmp_path / "race_store"))
+
+
+def test_race(store):
+    race = store.race(202401010101)
+    assert race["umaban"].tolist() == [1, 2, 3]
+    assert race["horse_id"].tolist() == ["2019104308", "2020100001", "2021100002"]
+    assert race["jockey_id"].tolist() == ["01170", "05339", "01126"]
+    assert (race["date"] == pd.Timestamp("2024-01-06")).all()
+    # 欠損値は-1で保存し、読むときにNAに戻す
+    assert store.race(202401010102)["sex"].isna().tolist() == [False, True]
+    assert store.race(202401010199).empty
+    assert store.race_info(202406050811)["course_len"] == 2500
+    assert store.race_info(202401010199) is None
+    # 文字列で渡したrace_idでも引ける
+    assert store.race("202401010101")["umaban"].tolist() == [1, 2, 3]
+    assert store.race_info("202406050811")["course_len"] == 2500
+    assert store.race_info("202401010199") is None
+
+
+def test_horse_history(store):
+    history = store.horse_history("2019104308")
+    assert history["race_id"].tolist() == [202406050811, 202401010101]
+    assert history["rank"].tolist() == [1, 2]
+    # 整数で渡したidでも引ける
+    assert store.horse_history(2019104308)["race_id"].tolist() == [202406050811, 202401010101]
+    assert store.horse_history("2019104308", n=1)["race_id"].tolist() == [202406050811]
+    assert store.horse_history("2019104308", before="2024-12-01")["race_id"].tolist() == [202401010101]
+    assert store.horse_history("2099999999").empty
+
+
+def test_jockey_rides(store):
+    rides = store.jockey_rides("01170")
+    assert rides["race_id"].tolist() == [202401010101, 202401010102, 202406050811]
+    assert store.jockey_rides(1170)["race_id"].tolist() == [202401010101, 202401010102, 202406050811]
+    assert store.jockey_rides("01170", date="2024-01-06")["race_id"].tolist() == [202401010101, 202401010102]
+    assert store.jockey_rides("01170", date="2024-06-01").empty
+    assert store.jockey_rides("09999").empty
+
+
+def test_races_on(store):
+    races = store.races_on("2024-01-06")
+    assert races["race_id"].tolist() == [202401010101, 202401010102]
+    # 頭数はdf_race_infoのもので、df_raceにない中止の馬も数える
+    assert races["n_horses"].tolist() == [4, 2]
+    assert store.races_on("2024-12-28", place=6)["race_id"].tolist() == [202406050811]
+    assert store.races_on("2024-01-06", place=6).empty
+    assert store.races_on("2024-02-01").empty
+
+
+def test_lookups_are_cached(store):
+    assert store.race(202401010101) is store.race(202401010101)
+    assert store.cache_info()["race"].hits == 1
+    store.clear_cache()
+    assert store.cache_info()["race"].currsize == 0
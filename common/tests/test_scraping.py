@@ -0,0 +1,105 @@
+import datetime
+
+import pytest
+
+import scraping
+
+RACE_LIST_URL = "https://race.netkeiba.com/top/race_list_sub.html?kaisai_date={}"
+
+
+def _race_list_html(race_id_list):
+    items = "".join(
+        f'<li class="RaceList_DataItem"><a href="../race/result.html?race_id={race_id}">R</a></li>'
+        for race_id in race_id_list
+    )
+    return f"<html><body><ul>{items}</ul></body></html>".encode()
+
+
+@pytest.fixture
+def race_id_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(scraping, "RACE_ID_DIR", tmp_path)
+    return tmp_path
+
+
+def test_scrape_race_id_list_keeps_http_results_without_selenium(race_id_dir, fake_fetcher, monkeypatch):
+    # 空の開催日と取得に失敗した開催日があっても、seleniumなしで取れた分をキャッシュに保存する
+    monkeypatch.setattr(scraping, "selenium_available", lambda: False)
+    fetcher = fake_fetcher({
+        RACE_LIST_URL.format("20240106"): (200, _race_list_html(["202406010101", "202406010102"])),
+        RACE_LIST_URL.format("20240107"): (200, _race_list_html([])),
+    })
+    race_id_list = scraping.scrape_race_id_list(
+        "2024-01-06", "2024-01-08", kaisai_date_list=["20240106", "20240107", "20240108"],
+        fetcher=fetcher, selenium_fallback=True,
+    )
+    assert race_id_list == ["202406010101", "202406010102"]
+    cache = scraping.load_data(scraping.RACE_ID_CACHE_FILE, race_id_dir)
+    assert cache == {"20240106": ["202406010101", "202406010102"]}
+
+
+def test_scrape_race_id_list_falls_back_for_failed_and_empty_dates(race_id_dir, fake_fetcher, monkeypatch):
+    selenium_calls = []
+
+    def fake_selenium(kaisai_date_list, n_drivers=1):
+        selenium_calls.append(list(kaisai_date_list))
+        # JavaScriptで描画されるページなら、Seleniumでは取れる
+        return {kaisai_date: ["202406010301"] if kaisai_date == "20240107" else [] for kaisai_date in kaisai_date_list}
+
+    monkeypatch.setattr(scraping, "selenium_available", lambda: True)
+    monkeypatch.setattr(scraping, "scrape_race_id_dict_selenium", fake_selenium)
+    fetcher = fake_fetcher({
+        RACE_LIST_URL.format("20240106"): (200, _race_list_html(["202406010101"])),
+        RACE_LIST_URL.format("20240107"): (200, _race_list_html([])),
+        RACE_LIST_URL.format("20240108"): (200, _race_list_html([])),
+    })
+    race_id_list = scraping.scrape_race_id_list(
+        "2024-01-06", "2024-01-09", kaisai_date_list=["20240106", "20240107", "20240108", "20240109"],
+        fetcher=fetcher,
+    )
+    # httpで空だった開催日も、取得に失敗した開催日も、デフォルトでSeleniumで取り直す
+    assert selenium_calls == [["20240107", "20240108", "20240109"]]
+    assert race_id_list == ["202406010101", "202406010301"]
+    # Seleniumでも空だった開催日はキャッシュせず、2回目はその開催日だけを取り直す
+    fetcher = fake_fetcher({})
+    scraping.scrape_race_id_list(
+        "2024-01-06", "2024-01-09", kaisai_date_list=["20240106", "20240107", "20240108", "20240109"],
+        fetcher=fetcher, selenium_fallback=False,
+    )
+    assert fetcher.requests == [RACE_LIST_URL.format("20240108"), RACE_LIST_URL.format("20240109")]
+
+
+def test_horses_to_refresh_refetches_missing_pages_despite_fetch_log(tmp_path, monkeypatch):
+    import os
+
+    import archive
+
+    raw_csv_dir = tmp_path / "raw_csv"
+    raw_csv_dir.mkdir()
+    (raw_csv_dir / "raw_race.csv").write_text(
+        "race_id\thorse_id\n202401010101\t2020100005\n202406050811\t2020100006\n", encoding="utf-8"
+    )
+    (raw_csv_dir / "raw_race_info.csv").write_text(
+        "race_id\tdate\n202401010101\t2024-01-06\n202406050811\t2024-12-28\n", encoding="utf-8"
+    )
+    html_dir = tmp_path / "html"
+    html_dir.mkdir()
+    monkeypatch.setattr(scraping, "RAW_RACE_CSV_DIR", raw_csv_dir)
+    monkeypatch.setattr(scraping, "HTML_HORSE_DIR", html_dir)
+    for horse_id in ["2020100001", "2020100005", "2020100006"]:
+        (html_dir / f"{horse_id}.bin").write_bytes(b"<html></html>")
+    # 取得記録のない2020100005のページは、最後の出走（2024-01-06）より前に保存した
+    old = datetime.datetime(2023, 12, 1).timestamp()
+    os.utime(html_dir / "2020100005.bin", (old, old))
+    horse_archive = archive.PageArchive(tmp_path / "archive")
+    horse_archive.put("2020100003", b"<html></html>")
+    recent = {"fetched_at": "2024-06-01T10:00:00"}
+    fetch_log = {
+        "2020100001": recent,  # ファイルがあり、取得以降に出走していない
+        "2020100002": recent,  # 取得記録はあるが、ページがどこにも残っていない
+        "2020100003": recent,  # アーカイブにある
+        "2020100006": recent,  # 取得以降に出走した
+    }
+    horse_id_list = [2020100001, 2020100002, 2020100003, 2020100004, 2020100005, 2020100006]
+    refresh_id_list = scraping.horses_to_refresh(horse_id_list, fetch_log, horse_archive)
+    assert refresh_id_list == ["2020100002", "2020100004", "2020100005", "2020100006"]
+    horse_archive.close()
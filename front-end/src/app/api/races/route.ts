@@ -1,8 +1,48 @@
-import { NextResponse } from 'next/server';
+import { NextRequest, NextResponse } from 'next/server';
+import { gunzipSync } from 'zlib';
 import { getHorsesData } from '@/lib/csv';
+import { getRaceIndex, isRaceId, readRaceShard } from '@/lib/races';
 
-export async function GET() {
+// GET /api/races?race_id=202408060405 : 1レース分（gzip済みのファイルをそのまま返す）
+async function getRace(request: NextRequest, raceId: string) {
+  const race = isRaceId(raceId) ? getRaceIndex().races[raceId] : undefined;
+  if (!race) {
+    return NextResponse.json({ error: 'レースが見つかりません' }, { status: 404 });
+  }
+  const etag = `"${race.etag}"`;
+  const headers: Record<string, string> = {
+    ETag: etag,
+    'Cache-Control': 'public, max-age=0, must-revalidate',
+    Vary: 'Accept-Encoding',
+  };
+  if (request.headers.get('if-none-match') === etag) {
+    return new NextResponse(null, { status: 304, headers });
+  }
+  const body = await readRaceShard(raceId);
+  headers['Content-Type'] = 'application/json; charset=utf-8';
+  if ((request.headers.get('accept-encoding') ?? '').includes('gzip')) {
+    headers['Content-Encoding'] = 'gzip';
+    return new NextResponse(new Uint8Array(body), { headers });
+  }
+  return new NextResponse(new Uint8Array(gunzipSync(body)), { headers });
+}
+
+// GET /api/races?date=2024-12-28 : その日の開催場所ごとのrace_id
+function getRaceIdsByDate(date: string) {
+  return NextResponse.json(getRaceIndex().dates[date] ?? {});
+}
+
+export async function GET(request: NextRequest) {
   try {
+    const { searchParams } = request.nextUrl;
+    const raceId = searchParams.get('race_id');
+    if (raceId) {
+      return await getRace(request, raceId);
+    }
+    const date = searchParams.get('date');
+    if (date) {
+      return getRaceIdsByDate(date);
+    }
     const horses = await getHorsesData();
     return NextResponse.json(horses);
   } catch (error) {
@@ -11,4 +51,4 @@ export async function GET() {
       { status: 500 }
     );
   }
-}
\ No newline at end of file
+}
@@ -0,0 +1,50 @@
+import fs from 'fs';
+import path from 'path';
+
+// common/src/race_shards.py が書き出すレースごとのJSON（gzip済み）と索引
+const RACE_DIR = path.join(process.cwd(), 'public/data/races');
+const RACE_ID_PATTERN = /^\d{12}$/;
+
+export interface RaceIndex {
+  generated_at: string;
+  races: Record<string, { date: string; place: number; etag: string }>;
+  dates: Record<string, Record<string, string[]>>;
+}
+
+// {race_id}.json.gz の中身。entriesは列名 -> 馬番順の値のリスト
+export interface RaceShard {
+  race_id: string;
+  info: {
+    date: string;
+    place: number;
+    race_type: number | null;
+    around: number | null;
+    course_len: number | null;
+    weather: number | null;
+    ground_state: number | null;
+    race_class: number | null;
+  };
+  entries: Record<string, (string | number | null)[]>;
+  // [券種, 馬番の組み合わせ, 100円あたりの払い戻し]
+  payouts: [string, number[], number][];
+}
+
+let cachedIndex: { mtimeMs: number; index: RaceIndex } | null = null;
+
+// 索引はファイルが更新されたときだけ読み直す
+export function getRaceIndex(): RaceIndex {
+  const filePath = path.join(RACE_DIR, 'index.json');
+  const { mtimeMs } = fs.statSync(filePath);
+  if (!cachedIndex || cachedIndex.mtimeMs !== mtimeMs) {
+    cachedIndex = { mtimeMs, index: JSON.parse(fs.readFileSync(filePath, 'utf8')) };
+  }
+  return cachedIndex.index;
+}
+
+export function isRaceId(raceId: string): boolean {
+  return RACE_ID_PATTERN.test(raceId);
+}
+
+export async function readRaceShard(raceId: string): Promise<Buffer> {
+  return fs.promises.readFile(path.join(RACE_DIR, `${raceId}.json.gz`));
+}